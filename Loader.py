@@ -1,25 +1,42 @@
 import os
 import re
+import signal
+import argparse
+import json
+import time
+import random
+import bisect
+import hashlib
 import logging
+import sqlite3
+import queue
+import threading
 import warnings
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Deque, Iterable, Iterator, Optional, Set, Tuple
 
 import chromadb
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
 from dotenv import load_dotenv # Used for loading API key from .env in main execution
 import tiktoken
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+
+import embeddings # Embedding backend shared with query.py (EMBEDDING_BACKEND: openai, local, onnx)
+import sections # Article/clause headings, shared with query.py
 
 # Document processing libraries
 from docx import Document
-from pdfminer.high_level import extract_text as pdfminer_extract_text
+from pdfminer.high_level import extract_pages
+from pdfminer.layout import LTTextContainer
 # import PyPDF2 # Fallback for PDF, pdfminer.six is generally preferred
 
 # OCR specific imports
 try:
     import pytesseract
-    from pdf2image import convert_from_path
+    from pdf2image import convert_from_path, pdfinfo_from_path
     from PIL import Image # Pillow for image manipulation
     OCR_CAPABLE = True
 except ImportError:
@@ -35,16 +52,33 @@ BASE_DIR = Path(__file__).resolve().parent
 HR_DOCS_DIR = BASE_DIR / "HR"  # Directory where your .pdf and .docx files are
 CHROMA_DB_DIR = BASE_DIR / "chroma_db_hr_ocr" # Persistent storage for ChromaDB
 
-COLLECTION_NAME = "hr_documents_ocr_production_v1" # Ensure this matches query.py
+COLLECTION_NAME = os.getenv("HR_COLLECTION_NAME", "hr_documents_ocr_production_v1") # Ensure this matches query.py
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-EMBEDDING_MODEL_NAME = "text-embedding-3-large" # Ensure this matches query.py
+EMBEDDING_MODEL_NAME = embeddings.get_model_name() # Set through EMBEDDING_BACKEND / EMBEDDING_MODEL, shared with query.py
 
 # Chunking Parameters
 TARGET_CHUNK_CHAR_SIZE = 1500  # Target character size for chunks
 CHUNK_CHAR_OVERLAP = 300     # Number of characters to overlap between chunks
 MAX_TOKENS_PER_CHUNK = 8000  # Maximum tokens per chunk (hard limit for embedding model)
 
+# Ingestion Pipeline Parameters
+LOADER_MAX_WORKERS = int(os.getenv("LOADER_MAX_WORKERS", max(1, (os.cpu_count() or 2) - 1))) # Extraction/OCR worker processes
+PIPELINE_QUEUE_SIZE = int(os.getenv("LOADER_QUEUE_SIZE", 8)) # Max files buffered between pipeline stages
+WRITE_BATCH_SIZE = int(os.getenv("LOADER_WRITE_BATCH_SIZE", 256)) # Max chunks per ChromaDB add() call
+# Embedding scheduler: chunks are packed into embedding requests by token count, several requests are
+# kept in flight, and throttled requests are retried with exponential backoff. Requests are kept small so
+# a typical corpus makes many of them (concurrent, overlapping with chunking) and a failure costs one batch.
+EMBEDDING_API_MAX_TOKENS = 300000 # API limit on tokens per request
+EMBEDDING_API_MAX_INPUTS = 2048 # API limit on inputs per request
+EMBEDDING_BATCH_MAX_TOKENS = min(int(os.getenv("LOADER_EMBEDDING_BATCH_TOKENS", 8000)), EMBEDDING_API_MAX_TOKENS) # Per request; a chunk can be up to MAX_TOKENS_PER_CHUNK on its own
+EMBEDDING_BATCH_MAX_INPUTS = min(int(os.getenv("LOADER_EMBEDDING_BATCH_INPUTS", 100)), EMBEDDING_API_MAX_INPUTS)
+EMBEDDING_CONCURRENCY = int(os.getenv("LOADER_EMBEDDING_CONCURRENCY", 4)) # Embedding requests in flight
+EMBEDDING_MAX_RETRIES = 6
+EMBEDDING_BACKOFF_BASE_SECONDS = 1.0
+EMBEDDING_BACKOFF_MAX_SECONDS = 60.0
+_PIPELINE_DONE = None # Sentinel passed down the pipeline queues when a stage has finished
+
 # Tesseract OCR Configuration (Update path if Tesseract is not in your system PATH)
 # Example for Windows:
 # TESSERACT_CMD_PATH = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
@@ -54,6 +88,50 @@ TESSERACT_CMD_PATH = None # Set this if pytesseract cannot find tesseract
 if OCR_CAPABLE and TESSERACT_CMD_PATH:
     pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD_PATH
 
+# Specify language(s) for Tesseract. 'spa' for Spanish, 'eng' for English.
+TESSERACT_CONFIG = r'--oem 3 --psm 6 -l spa+eng' # Adjust as needed
+
+# Page-streaming OCR: pages are rasterized OCR_PAGE_WINDOW at a time, so peak memory per worker is
+# roughly OCR_PAGE_WINDOW page images at OCR_DPI regardless of document length.
+OCR_PAGE_WINDOW = int(os.getenv("LOADER_OCR_PAGE_WINDOW", 4))
+# Parallel Tesseract calls per document. By default the cores are split between the extraction workers, so
+# workers x OCR_THREADS Tesseract processes don't oversubscribe the CPU (see ocr_threads_per_worker).
+OCR_THREADS_SETTING = int(os.getenv("LOADER_OCR_THREADS", 0)) # 0 = automatic
+OCR_DPI = 200 # pdf2image default resolution
+MIN_PAGE_TEXT_CHARS = 50 # Pages with fewer alphanumeric characters in their text layer are OCR'd
+PAGE_SEPARATOR = "\n\n[End of Page]\n\n"
+
+def ocr_threads_per_worker(worker_count: int) -> int:
+    return OCR_THREADS_SETTING or max(1, (os.cpu_count() or 2) // max(1, worker_count))
+
+OCR_THREADS = ocr_threads_per_worker(LOADER_MAX_WORKERS) # Set for the actual worker count by _init_extraction_worker
+
+def _init_extraction_worker(ocr_threads: int) -> None:
+    """Sets this process's share of the OCR thread budget (ProcessPoolExecutor initializer; also used in-process)."""
+    global OCR_THREADS
+    OCR_THREADS = ocr_threads
+    if OCR_THREADS > 1:
+        # Tesseract's own OpenMP threading fights with page-level parallelism; keep one thread per call.
+        os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+_init_extraction_worker(OCR_THREADS)
+
+# Extraction cache: pdfminer/OCR/DOCX output keyed by file content hash, page number and extractor config,
+# so touched, copied or force-reprocessed files are not re-OCR'd. Least recently used entries are evicted
+# once the cached text exceeds EXTRACTION_CACHE_MAX_BYTES.
+EXTRACTION_CACHE_ENABLED = os.getenv("LOADER_EXTRACTION_CACHE", "true").lower() in ['true', '1', 't']
+EXTRACTION_CACHE_PATH = BASE_DIR / "extraction_cache.sqlite3"
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("LOADER_EXTRACTION_CACHE_MAX_MB", 512)) * 1024 * 1024
+
+# Ingestion manifest: per-file size/mtime/content hash/chunk IDs, used instead of ChromaDB metadata scans
+MANIFEST_PATH = BASE_DIR / "ingestion_manifest.sqlite3"
+
+# Watch mode (python Loader.py --watch): poll HR_DOCS_DIR and re-index only the files that changed
+SUPPORTED_SUFFIXES = (".pdf", ".docx")
+WATCH_POLL_SECONDS = float(os.getenv("LOADER_WATCH_POLL_SECONDS", 5))
+WATCH_DEBOUNCE_SECONDS = float(os.getenv("LOADER_WATCH_DEBOUNCE_SECONDS", 3)) # Quiet period after the last change before indexing
+WATCH_MAX_RETRIES = 3 # Attempts for a file that keeps failing, until it changes again
+
 # Poppler path for pdf2image (Windows specific, often needed if Poppler is not in PATH)
 # POPPLER_PATH = r"C:\path\to\poppler-xxx\bin" # Example for Windows
 POPPLER_PATH = None
@@ -67,10 +145,11 @@ pil_logger = logging.getLogger('PIL') # Suppress verbose PIL logging if necessar
 pil_logger.setLevel(logging.INFO)
 
 # --- Helper Functions & Tokenizer ---
-def get_embedding_function() -> OpenAIEmbeddingFunction:
-    if not OPENAI_API_KEY:
+def get_embedding_function() -> Any:
+    if embeddings.backend_requires_api_key() and not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY not found in environment variables.")
-    return OpenAIEmbeddingFunction(api_key=OPENAI_API_KEY, model_name=EMBEDDING_MODEL_NAME)
+    logger.info(f"Embedding backend: {embeddings.get_backend_name()} ({EMBEDDING_MODEL_NAME})")
+    return embeddings.get_embedding_function(api_key=OPENAI_API_KEY)
 
 try:
     tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL_NAME)
@@ -81,124 +160,545 @@ except KeyError:
 def count_tokens(text: str) -> int:
     return len(tokenizer.encode(text))
 
+PARAGRAPH_SEPARATOR_TOKENS = count_tokens("\n\n")
+# Sentence ends and paragraph breaks; split_text_by_tokens cuts right after a match. The whitespace after
+# sentence punctuation is left out of the match because BPE attaches it to the following word's token.
+_TOKEN_SPLIT_BOUNDARY_PATTERN = re.compile(r'[.!?](?=\s)|\n\n')
+
+def compute_file_hash(file_path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class StageTimings:
+    """
+    Wall-clock seconds spent in each ingestion stage (extract, ocr, clean, chunk, embed, write) in this
+    process. Thread-safe: the concurrent embedding requests add to the same stage. Extraction worker
+    processes report their deltas back with each file (see _extraction_worker).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._seconds)
+
+stage_timings = StageTimings()
+
+class ExtractionCache:
+    """
+    Persistent, content-addressed cache for extracted page text (SQLite).
+    Entries are keyed by (content_hash, page_number, config); page 0 holds document-level
+    entries such as the pdfminer text layer of all pages or the text of a DOCX.
+    Safe to share between the extraction worker processes; each process opens its own connection.
+    Reads only refresh last_access when it is more than a day old, and the size budget is checked every
+    EVICT_EVERY_PUTS writes, so neither a cache hit nor a put pays for a write or a full-table SUM.
+    """
+    ACCESS_REFRESH_SECONDS = 24 * 3600 # LRU order at day granularity is enough to pick what to evict
+    EVICT_EVERY_PUTS = 100
+
+    def __init__(self, db_path: Path, max_bytes: int, enabled: bool = True):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None or self._conn_pid != os.getpid(): # Never reuse a connection inherited through fork
+            self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS page_text ("
+                " content_hash TEXT NOT NULL, page_number INTEGER NOT NULL, config TEXT NOT NULL,"
+                " text TEXT NOT NULL, size_bytes INTEGER NOT NULL, last_access REAL NOT NULL,"
+                " PRIMARY KEY (content_hash, page_number, config))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_page_text_last_access ON page_text (last_access)")
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, content_hash: str, page_number: int, config: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute(
+                    "SELECT text, last_access FROM page_text WHERE content_hash = ? AND page_number = ? AND config = ?",
+                    (content_hash, page_number, config)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                now = time.time()
+                if row[1] < now - self.ACCESS_REFRESH_SECONDS:
+                    conn.execute(
+                        "UPDATE page_text SET last_access = ? WHERE content_hash = ? AND page_number = ? AND config = ?",
+                        (now, content_hash, page_number, config)
+                    )
+                    conn.commit()
+                self.hits += 1
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning(f"Extraction cache read failed ({self.db_path.name}): {e}")
+            return None
+
+    def put(self, content_hash: str, page_number: int, config: str, text: str) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO page_text VALUES (?, ?, ?, ?, ?, ?)",
+                    (content_hash, page_number, config, text, len(text.encode("utf-8")), time.time())
+                )
+                self._puts += 1
+                # On the first put of this process and every EVICT_EVERY_PUTS after (short runs still get checked);
+                # a SUM over the whole table on every put is quadratic over a large OCR backfill.
+                if self._puts % self.EVICT_EVERY_PUTS == 1:
+                    self._evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Extraction cache write failed ({self.db_path.name}): {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM page_text").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        # Evict least recently used entries down to 90% of the budget so we don't evict on every insert.
+        bytes_to_free = total_bytes - int(self.max_bytes * 0.9)
+        freed = 0
+        evicted_keys = []
+        cursor = conn.execute("SELECT content_hash, page_number, config, size_bytes FROM page_text ORDER BY last_access")
+        for content_hash, page_number, config, size_bytes in cursor:
+            evicted_keys.append((content_hash, page_number, config))
+            freed += size_bytes
+            if freed >= bytes_to_free:
+                break
+        cursor.close()
+        conn.executemany("DELETE FROM page_text WHERE content_hash = ? AND page_number = ? AND config = ?", evicted_keys)
+        logger.info(f"Extraction cache evicted {len(evicted_keys)} entries ({freed} bytes).")
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+extraction_cache = ExtractionCache(EXTRACTION_CACHE_PATH, EXTRACTION_CACHE_MAX_BYTES, enabled=EXTRACTION_CACHE_ENABLED)
+
+class IngestionManifest:
+    """
+    Local record of what has been ingested (SQLite, next to the ChromaDB directory): per file path,
+    its size, mtime, content hash and chunk IDs. Answers skip/update decisions and supplies the stored
+    chunk IDs for the upsert diff without scanning ChromaDB metadata, and lets the loader purge the
+    chunks of files that were removed from HR_DOCS_DIR.
+    """
+    def __init__(self, db_path: Path, collection_name: str):
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " collection_name TEXT NOT NULL, file_path TEXT NOT NULL, file_name TEXT NOT NULL,"
+            " size_bytes INTEGER NOT NULL, mtime REAL NOT NULL, content_hash TEXT NOT NULL,"
+            " chunk_ids TEXT NOT NULL, updated_at REAL NOT NULL, sections_indexed INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (collection_name, file_path))"
+        )
+        if "sections_indexed" not in {row[1] for row in self._conn.execute("PRAGMA table_info(files)")}:
+            # Manifest from before the section index: its files are reprocessed once to fill it (without re-embedding).
+            self._conn.execute("ALTER TABLE files ADD COLUMN sections_indexed INTEGER NOT NULL DEFAULT 0")
+        # One row per collection, read by the Flask app (see HRAssistant.get_index_state) to notice index changes.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS index_state ("
+            " collection_name TEXT PRIMARY KEY, index_version INTEGER NOT NULL DEFAULT 0, changed_at REAL,"
+            " last_run_at REAL, last_run_stats TEXT, watcher_pid INTEGER, watcher_heartbeat_at REAL)"
+        )
+        # Article/clause -> chunk index (see sections.py), read by HRAssistant to fetch a cited section directly.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sections ("
+            " collection_name TEXT NOT NULL, file_path TEXT NOT NULL, section TEXT NOT NULL, chunk_id TEXT NOT NULL,"
+            " PRIMARY KEY (collection_name, file_path, section, chunk_id))"
+        )
+        self._conn.commit()
+
+    def get(self, file_path: Path) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_name, size_bytes, mtime, content_hash, chunk_ids, sections_indexed FROM files WHERE collection_name = ? AND file_path = ?",
+                (self.collection_name, str(file_path.resolve()))
+            ).fetchone()
+        if row is None:
+            return None
+        return {"file_name": row[0], "size_bytes": row[1], "mtime": row[2], "content_hash": row[3], "chunk_ids": json.loads(row[4]), "sections_indexed": bool(row[5])}
+
+    def record(self, file_path: Path, size_bytes: int, mtime: float, content_hash: str, chunk_ids: List[str], chunk_sections: Optional[List[Tuple[str, str]]] = None) -> None:
+        """
+        Stores a file's state and chunk IDs. chunk_sections ((section key, chunk ID) pairs) replaces its section
+        index entries; None means the sections are unknown and the file is reprocessed on the next run.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.collection_name, str(file_path.resolve()), file_path.name, size_bytes, mtime, content_hash, json.dumps(chunk_ids), time.time(),
+                 int(chunk_sections is not None))
+            )
+            self._delete_sections(file_path)
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO sections VALUES (?, ?, ?, ?)",
+                [(self.collection_name, str(file_path.resolve()), section, chunk_id) for section, chunk_id in chunk_sections or []]
+            )
+            self._conn.commit()
+
+    def _delete_sections(self, file_path: Path) -> None:
+        self._conn.execute("DELETE FROM sections WHERE collection_name = ? AND file_path = ?", (self.collection_name, str(file_path.resolve())))
+
+    def update_stat(self, file_path: Path, size_bytes: int, mtime: float) -> None:
+        """Refreshes size/mtime for a file that was touched or copied but whose content is unchanged."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET size_bytes = ?, mtime = ?, updated_at = ? WHERE collection_name = ? AND file_path = ?",
+                (size_bytes, mtime, time.time(), self.collection_name, str(file_path.resolve()))
+            )
+            self._conn.commit()
+
+    def invalidate(self, file_path: Path) -> None:
+        """
+        Marks a file whose chunks were only partly written: the next run reprocesses it (no size/mtime/hash
+        can match) and reads its stored chunk IDs back from ChromaDB (chunk_ids is unknown).
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, -1, -1, '', 'null', ?, 0)",
+                (self.collection_name, str(file_path.resolve()), file_path.name, time.time())
+            )
+            self._delete_sections(file_path) # Rebuilt when the file is reprocessed
+            self._conn.commit()
+
+    def forget(self, file_path: Path) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM files WHERE collection_name = ? AND file_path = ?", (self.collection_name, str(file_path.resolve())))
+            self._delete_sections(file_path)
+            self._conn.commit()
+
+    def file_paths(self) -> List[Path]:
+        with self._lock:
+            rows = self._conn.execute("SELECT file_path FROM files WHERE collection_name = ?", (self.collection_name,)).fetchall()
+        return [Path(row[0]) for row in rows]
+
+    def _ensure_index_state(self) -> None:
+        self._conn.execute("INSERT OR IGNORE INTO index_state (collection_name) VALUES (?)", (self.collection_name,))
+
+    def record_run(self, run_stats: Dict[str, Any], changed: bool) -> int:
+        """Stores the stats of a loader run; bumps the index version if the collection changed. Returns the version."""
+        now = time.time()
+        with self._lock:
+            self._ensure_index_state()
+            if changed:
+                self._conn.execute(
+                    "UPDATE index_state SET index_version = index_version + 1, changed_at = ? WHERE collection_name = ?",
+                    (now, self.collection_name)
+                )
+            self._conn.execute(
+                "UPDATE index_state SET last_run_at = ?, last_run_stats = ? WHERE collection_name = ?",
+                (now, json.dumps(run_stats), self.collection_name)
+            )
+            self._conn.commit()
+            return self._conn.execute("SELECT index_version FROM index_state WHERE collection_name = ?", (self.collection_name,)).fetchone()[0]
+
+    def record_watcher_heartbeat(self, watcher_pid: Optional[int]) -> None:
+        """Called on every watch-mode poll; watcher_pid None marks the watcher as stopped."""
+        with self._lock:
+            self._ensure_index_state()
+            self._conn.execute(
+                "UPDATE index_state SET watcher_pid = ?, watcher_heartbeat_at = ? WHERE collection_name = ?",
+                (watcher_pid, time.time() if watcher_pid else None, self.collection_name)
+            )
+            self._conn.commit()
+
+    def matches(self, file_path: Path, size_bytes: int, mtime: float) -> bool:
+        entry = self.get(file_path)
+        return entry is not None and entry["size_bytes"] == size_bytes and entry["mtime"] == mtime
+
+def get_ingestion_manifest(collection_to_load: chromadb.Collection) -> IngestionManifest:
+    return IngestionManifest(MANIFEST_PATH, collection_to_load.name)
+
 # --- Text Extraction with OCR ---
-def ocr_pdf_page(image: Image) -> str:
+def ocr_pdf_page(image: Image, raise_errors: bool = False) -> str:
     """Performs OCR on a single image (PDF page)."""
     if not OCR_CAPABLE:
         logger.warning("OCR called but not capable. Returning empty string.")
         return ""
     try:
         # Specify language(s) for Tesseract. 'spa' for Spanish, 'eng' for English.
-        custom_oem_psm_config = r'--oem 3 --psm 6 -l spa+eng' # Adjust as needed
-        text = pytesseract.image_to_string(image, config=custom_oem_psm_config)
+        text = pytesseract.image_to_string(image, config=TESSERACT_CONFIG)
         return text
     except Exception as e:
         logger.error(f"Tesseract OCR error on page: {e}")
+        if raise_errors:
+            raise
         return ""
 
-def extract_text_from_pdf_with_ocr(file_path: Path, force_ocr: bool = False) -> str:
-    logger.info(f"Extracting text from PDF (Force OCR: {force_ocr}): {file_path.name}")
-    digital_text = ""
-    
+def _ocr_pdf_page_or_none(image: Image) -> Optional[str]:
+    """Like ocr_pdf_page, but returns None on Tesseract errors so failures are not cached as blank pages."""
+    try:
+        return ocr_pdf_page(image, raise_errors=True)
+    except Exception:
+        return None
+
+def _poppler_kwargs() -> Dict[str, Any]:
+    if POPPLER_PATH and os.name == 'nt': # Windows check for Poppler path
+        return {"poppler_path": POPPLER_PATH}
+    return {} # Assumes Poppler is in PATH for other OS or if POPPLER_PATH is None
+
+def get_pdf_page_count(file_path: Path) -> int:
+    info = pdfinfo_from_path(str(file_path), **_poppler_kwargs())
+    return int(info.get("Pages", 0))
+
+def ocr_pdf_pages(file_path: Path, first_page: int, last_page: int) -> Iterator[Tuple[int, Optional[str]]]:
+    """
+    Rasterizes and OCRs pages first_page..last_page (1-based, inclusive), OCR_PAGE_WINDOW pages at a time.
+    Only one window of page images is held in memory at once, and the pages of a window are OCR'd
+    in parallel by OCR_THREADS Tesseract processes. Yields (page_number, text) in page order;
+    text is None for pages where Tesseract failed.
+    """
+    with ThreadPoolExecutor(max_workers=OCR_THREADS, thread_name_prefix="ocr") as ocr_executor:
+        for window_start in range(first_page, last_page + 1, OCR_PAGE_WINDOW):
+            window_end = min(window_start + OCR_PAGE_WINDOW - 1, last_page)
+            logger.debug(f"OCR'ing pages {window_start}-{window_end} of {last_page} for {file_path.name}...")
+            images = convert_from_path(str(file_path), dpi=OCR_DPI, first_page=window_start, last_page=window_end, **_poppler_kwargs())
+            try:
+                # map() preserves input order, so pages come back in document order.
+                for offset, page_ocr_text in enumerate(ocr_executor.map(_ocr_pdf_page_or_none, images)):
+                    yield window_start + offset, page_ocr_text
+            finally:
+                for image in images:
+                    image.close()
+
+def extract_digital_pages(file_path: Path) -> List[str]:
+    """Returns the pdfminer.six text layer of every page, in page order (one parse of the document)."""
+    pages = []
+    for page_layout in extract_pages(str(file_path)):
+        pages.append("".join(element.get_text() for element in page_layout if isinstance(element, LTTextContainer)))
+    return pages
+
+def has_usable_text_layer(page_text: str) -> bool:
+    return sum(1 for ch in page_text if ch.isalnum()) >= MIN_PAGE_TEXT_CHARS
+
+def _contiguous_runs(page_numbers: List[int]) -> List[Tuple[int, int]]:
+    """[1, 2, 3, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)]"""
+    runs: List[Tuple[int, int]] = []
+    for page_number in page_numbers:
+        if runs and runs[-1][1] == page_number - 1:
+            runs[-1] = (runs[-1][0], page_number)
+        else:
+            runs.append((page_number, page_number))
+    return runs
+
+def summarize_page_methods(pages: List[Tuple[int, str, str]]) -> str:
+    """Compact per-page method record for chunk metadata, e.g. 'digital:1-12,15;ocr:13-14'."""
+    pages_by_method: Dict[str, List[int]] = {}
+    for page_number, method, _ in pages:
+        pages_by_method.setdefault(method, []).append(page_number)
+    return ";".join(
+        f"{method}:" + ",".join(str(a) if a == b else f"{a}-{b}" for a, b in _contiguous_runs(page_numbers))
+        for method, page_numbers in pages_by_method.items()
+    )
+
+def extract_pdf_pages(file_path: Path, force_ocr: bool = False, content_hash: Optional[str] = None) -> List[Tuple[int, str, str]]:
+    """
+    Per-page hybrid extraction. Pages whose text layer has at least MIN_PAGE_TEXT_CHARS usable
+    characters keep their pdfminer text; only the remaining pages (scanned annexes, signature
+    pages, image-only tables) are rasterized and sent to Tesseract.
+    Returns (page_number, method, text) tuples in page order; method is 'digital', 'ocr' or 'empty'.
+    """
+    content_hash = content_hash or compute_file_hash(file_path)
+    ocr_cache_config = f"tesseract {TESSERACT_CONFIG} dpi={OCR_DPI}"
+    digital_pages: List[str] = []
     if not force_ocr:
+        cached_pages = extraction_cache.get(content_hash, 0, "pdfminer")
+        if cached_pages is not None:
+            digital_pages = json.loads(cached_pages)
+        else:
+            try:
+                digital_pages = extract_digital_pages(file_path)
+                extraction_cache.put(content_hash, 0, "pdfminer", json.dumps(digital_pages, ensure_ascii=False))
+            except Exception as e:
+                logger.warning(f"Error with digital text extraction for {file_path.name} (pdfminer): {e}. Proceeding with OCR.")
+
+    page_count = len(digital_pages)
+    if not page_count and OCR_CAPABLE:
         try:
-            digital_text = pdfminer_extract_text(str(file_path))
-            # Basic check for meaningful content
-            if digital_text and len(digital_text.strip()) > 200:
-                logger.info(f"Successfully extracted digital text from {file_path.name} using pdfminer.six. Length: {len(digital_text)} chars.")
-                return digital_text.strip()
-            else:
-                logger.info(f"Digital text extraction from {file_path.name} was minimal or empty. Proceeding with OCR attempt.")
+            page_count = get_pdf_page_count(file_path)
         except Exception as e:
-            logger.warning(f"Error with digital text extraction for {file_path.name} (pdfminer): {e}. Proceeding with OCR.")
+            logger.error(f"Could not read page count for {file_path.name}: {e}")
+    digital_pages += [""] * (page_count - len(digital_pages))
 
-    if not OCR_CAPABLE:
-        logger.warning(f"OCR is not available. Returning any digitally extracted text for {file_path.name}.")
-        return digital_text.strip()
-
-    logger.info(f"Performing OCR on {file_path.name}...")
-    ocr_text_parts = []
-    try:
-        if POPPLER_PATH and os.name == 'nt': # Windows check for Poppler path
-            images = convert_from_path(str(file_path), poppler_path=POPPLER_PATH)
+    pages: Dict[int, Tuple[str, str]] = {}
+    pages_to_ocr: List[int] = []
+    for page_number, page_text in enumerate(digital_pages, start=1):
+        if not force_ocr and has_usable_text_layer(page_text):
+            pages[page_number] = ("digital", page_text.strip())
         else:
-            images = convert_from_path(str(file_path)) # Assumes Poppler is in PATH for other OS or if POPPLER_PATH is None
-        
-        if not images:
-            logger.warning(f"pdf2image could not convert {file_path.name} to images. No OCR possible.")
-            return digital_text.strip() # Fallback
-
-        for i, page_image in enumerate(images):
-            logger.debug(f"OCR'ing page {i+1} of {len(images)} for {file_path.name}...")
-            page_ocr_text = ocr_pdf_page(page_image)
-            if page_ocr_text:
-                ocr_text_parts.append(page_ocr_text)
-        
-        full_ocr_text = "\n\n[End of Page]\n\n".join(ocr_text_parts) # Add page breaks
-        
-        if full_ocr_text.strip():
-            logger.info(f"Successfully extracted text from {file_path.name} using OCR. Length: {len(full_ocr_text)} chars.")
-            return full_ocr_text.strip()
-        else:
-            logger.warning(f"OCR yielded no text for {file_path.name}. Falling back to any digital text found.")
-            return digital_text.strip()
+            pages_to_ocr.append(page_number)
 
-    except Exception as e:
-        logger.error(f"Error during OCR processing for {file_path.name}: {e}")
-        return digital_text.strip() # Fallback
+    pages_to_ocr_uncached: List[int] = []
+    for page_number in pages_to_ocr:
+        cached_ocr_text = extraction_cache.get(content_hash, page_number, ocr_cache_config)
+        if cached_ocr_text is None:
+            pages_to_ocr_uncached.append(page_number)
+        elif cached_ocr_text:
+            pages[page_number] = ("ocr", cached_ocr_text)
+    if len(pages_to_ocr_uncached) < len(pages_to_ocr):
+        logger.info(f"Using cached OCR text for {len(pages_to_ocr) - len(pages_to_ocr_uncached)} page(s) of {file_path.name}.")
+    pages_to_ocr = pages_to_ocr_uncached
+
+    if pages_to_ocr and not OCR_CAPABLE:
+        logger.warning(f"OCR is not available. {len(pages_to_ocr)} page(s) of {file_path.name} without a usable text layer keep their digital text.")
+    elif pages_to_ocr:
+        logger.info(f"Performing OCR on {len(pages_to_ocr)} of {page_count} page(s) of {file_path.name}...")
+        with stage_timings.timed("ocr"):
+            for run_start, run_end in _contiguous_runs(pages_to_ocr):
+                try:
+                    for page_number, page_ocr_text in ocr_pdf_pages(file_path, run_start, run_end):
+                        if page_ocr_text is None:
+                            continue
+                        extraction_cache.put(content_hash, page_number, ocr_cache_config, page_ocr_text.strip())
+                        if page_ocr_text.strip():
+                            pages[page_number] = ("ocr", page_ocr_text.strip())
+                except Exception as e:
+                    logger.error(f"Error during OCR processing of pages {run_start}-{run_end} of {file_path.name}: {e}")
+
+    result: List[Tuple[int, str, str]] = []
+    for page_number, page_text in enumerate(digital_pages, start=1):
+        if page_number in pages:
+            method, text = pages[page_number]
+        else: # OCR unavailable or empty; fall back to whatever the text layer had
+            text = page_text.strip()
+            method = "digital" if text else "empty"
+        result.append((page_number, method, text))
+    return result
+
+def join_pdf_pages(pages: List[Tuple[int, str, str]]) -> str:
+    return PAGE_SEPARATOR.join(text for _, _, text in pages if text) # Add page breaks
+
+def extract_text_from_pdf_with_ocr(file_path: Path, force_ocr: bool = False) -> str:
+    logger.info(f"Extracting text from PDF (Force OCR: {force_ocr}): {file_path.name}")
+    pages = extract_pdf_pages(file_path, force_ocr=force_ocr)
+    full_text = join_pdf_pages(pages)
+    if full_text:
+        logger.info(f"Extracted text from {file_path.name}. Length: {len(full_text)} chars. Page methods: {summarize_page_methods(pages)}")
+    else:
+        logger.warning(f"No text could be extracted from {file_path.name}, digitally or with OCR.")
+    return full_text
 
-def extract_text_from_docx(file_path: Path) -> str:
+def extract_text_from_docx(file_path: Path, content_hash: Optional[str] = None) -> str:
     logger.info(f"Extracting text from DOCX: {file_path.name}")
     try:
+        content_hash = content_hash or compute_file_hash(file_path)
+        cached_text = extraction_cache.get(content_hash, 0, "python-docx")
+        if cached_text is not None:
+            logger.info(f"Using cached text for DOCX {file_path.name}. Length: {len(cached_text)} chars.")
+            return cached_text
         doc = Document(file_path)
         full_text = [p.text.strip() for p in doc.paragraphs if p.text.strip()]
         extracted_content = "\n\n".join(full_text) # Use double newline for paragraphs
         logger.info(f"Extracted text from DOCX {file_path.name}. Length: {len(extracted_content)} chars.")
+        extraction_cache.put(content_hash, 0, "python-docx", extracted_content)
         return extracted_content
     except Exception as e:
         logger.error(f"Error extracting text from DOCX {file_path.name}: {e}")
         return ""
 
 # --- Text Processing, Chunking, Metadata ---
+_WHITESPACE_RUN_PATTERN = re.compile(r'\s+')
+
+def _normalize_whitespace_run(match: re.Match) -> str:
+    run = match.group()
+    line_breaks = run.count('\n') or run.count('\r')
+    if not line_breaks and '\x0c' not in run:
+        return ' ' # Spaces/tabs inside a line
+    if line_breaks >= 2 or '\x0c' in run or sections.starts_section(match.string, match.end()):
+        return '\n\n' # Paragraph break: blank line, form feed (page break) or a line starting a new section (sections.py)
+    return '\n' # Plain line break inside a paragraph
+
 def clean_text(text: str) -> str:
-    text = re.sub(r'\s+', ' ', text) # Consolidate multiple whitespace characters
-    text = re.sub(r'\n\s*\n', '\n\n', text) # Normalize multiple newlines to consistent double newlines
-    return text.strip()
+    """
+    Normalizes whitespace in one regex pass while keeping document structure: runs of spaces inside a
+    line collapse to one space, single line breaks are kept, and blank lines, page breaks and section
+    headings become the "\n\n" paragraph breaks that split_text_into_chunks splits on.
+    """
+    return _WHITESPACE_RUN_PATTERN.sub(_normalize_whitespace_run, text).strip()
 
-def split_text_into_chunks(text: str, file_name: str) -> List[str]:
-    logger.debug(f"Splitting text for {file_name}, original length: {len(text)} chars, ~{count_tokens(text)} tokens")
+def split_text_into_chunks_with_tokens(text: str, file_name: str) -> List[Tuple[str, int]]:
+    """
+    Splits text into chunks along paragraph boundaries and returns (chunk_text, token_count) pairs.
+    Each paragraph is tokenized once; chunk token and character totals are tracked incrementally.
+    Summing paragraph counts plus one separator count per join is an upper bound, not an exact count:
+    with cl100k/o200k a paragraph ending in ".", ":" and the like can merge with the following "\n\n"
+    into a single token. The bound keeps every chunk within MAX_TOKENS_PER_CHUNK (and is safe for packing
+    embedding batches), so the returned counts are upper bounds; a chunk whose bound is over the limit is
+    re-counted exactly before being split, so it is only split if it really is too long.
+    """
+    if logger.isEnabledFor(logging.DEBUG): # Avoid tokenizing the whole document just for a log line
+        logger.debug(f"Splitting text for {file_name}, original length: {len(text)} chars, ~{count_tokens(text)} tokens")
     
     # Split by double newlines, assuming these are paragraph breaks after cleaning
     paragraphs = text.split('\n\n')
     paragraphs = [p.strip() for p in paragraphs if p.strip()]
 
-    chunks: List[str] = []
+    chunks: List[Tuple[str, int]] = []
     current_chunk_texts: List[str] = []
     current_char_count = 0
+    current_token_count = 0 # Upper bound on the tokens of "\n\n".join(current_chunk_texts)
+
+    def emit_chunk(chunk_text: str, chunk_tokens: int, reason: str) -> None:
+        if chunk_tokens > MAX_TOKENS_PER_CHUNK and "\n\n" in chunk_text:
+            chunk_tokens = count_tokens(chunk_text) # The running sum is only an upper bound once paragraphs are joined
+        if chunk_tokens > MAX_TOKENS_PER_CHUNK:
+            logger.warning(f"{reason} in {file_name} (char size {len(chunk_text)}) exceeds token limit. Splitting by tokens.")
+            chunks.extend(split_text_by_tokens_with_counts(chunk_text, MAX_TOKENS_PER_CHUNK))
+        else:
+            chunks.append((chunk_text, chunk_tokens))
     
-    for i, para in enumerate(paragraphs):
+    for para in paragraphs:
         para_char_count = len(para)
+        para_token_count = count_tokens(para) # The only tokenization of this paragraph
         # Check if adding the current paragraph would exceed size or token limits
         # +2 for potential "\n\n" joiner
         would_exceed_char_size = current_char_count + para_char_count + (len(current_chunk_texts) * 2) > TARGET_CHUNK_CHAR_SIZE
         
-        # Temporarily form candidate chunk to check token count
-        candidate_chunk_text = "\n\n".join(current_chunk_texts + [para]) if current_chunk_texts else para
-        candidate_tokens = count_tokens(candidate_chunk_text)
+        candidate_tokens = current_token_count + PARAGRAPH_SEPARATOR_TOKENS + para_token_count if current_chunk_texts else para_token_count
         would_exceed_token_limit = candidate_tokens > MAX_TOKENS_PER_CHUNK
 
         if current_chunk_texts and (would_exceed_char_size or would_exceed_token_limit):
             # Finalize the current chunk
             final_chunk_text = "\n\n".join(current_chunk_texts)
-            
-            if count_tokens(final_chunk_text) > MAX_TOKENS_PER_CHUNK:
-                logger.warning(f"Chunk for {file_name} (char size {len(final_chunk_text)}) was over token limit BEFORE adding new para. Splitting by tokens.")
-                token_sub_chunks = split_chunk_by_tokens_recursive(final_chunk_text, MAX_TOKENS_PER_CHUNK)
-                chunks.extend(token_sub_chunks)
-            else:
-                chunks.append(final_chunk_text)
+            emit_chunk(final_chunk_text, current_token_count, "Chunk (before adding new para)")
             
             # Start new chunk, considering overlap
+            current_chunk_texts = [para]
+            current_token_count = para_token_count
             if CHUNK_CHAR_OVERLAP > 0 and final_chunk_text:
                 # Get the last few paragraphs or characters for overlap
                 # This is a simplified overlap; more sophisticated methods exist.
@@ -208,33 +708,25 @@ def split_text_into_chunks(text: str, file_name: str) -> List[str]:
                 # Try to find a sensible break for overlap text
                 last_para_break = overlap_text.rfind("\n\n")
                 if last_para_break != -1 and len(overlap_text[last_para_break:].strip()) > 50 : # Meaningful paragraph
-                     current_chunk_texts = [overlap_text[last_para_break:].strip(), para]
-                else: # Fallback to char overlap or just the new para
-                     current_chunk_texts = [para] # Simplest: start new chunk with current para, can be improved.
-            else:
-                current_chunk_texts = [para]
+                     overlap_para = overlap_text[last_para_break:].strip()
+                     current_chunk_texts = [overlap_para, para]
+                     current_token_count = count_tokens(overlap_para) + PARAGRAPH_SEPARATOR_TOKENS + para_token_count
             current_char_count = sum(len(p) + 2 for p in current_chunk_texts) -2 if current_chunk_texts else 0
         
         else: # Add paragraph to current chunk if it doesn't exceed limits on its own
             if would_exceed_token_limit and not current_chunk_texts: # Current paragraph itself is too large
-                logger.warning(f"Single paragraph in {file_name} (char size {para_char_count}) exceeds token limit. Splitting by tokens.")
-                token_sub_chunks = split_chunk_by_tokens_recursive(para, MAX_TOKENS_PER_CHUNK)
-                chunks.extend(token_sub_chunks)
+                emit_chunk(para, para_token_count, "Single paragraph")
                 current_chunk_texts = [] # Reset as this paragraph has been processed
                 current_char_count = 0
+                current_token_count = 0
             else:
                 current_chunk_texts.append(para)
                 current_char_count += para_char_count + 2 # +2 for potential "\n\n"
+                current_token_count = candidate_tokens
 
     # Add the last remaining chunk
     if current_chunk_texts:
-        final_chunk_text = "\n\n".join(current_chunk_texts)
-        if count_tokens(final_chunk_text) > MAX_TOKENS_PER_CHUNK:
-            logger.warning(f"Final chunk for {file_name} (char size {len(final_chunk_text)}) exceeded token limit. Splitting by tokens.")
-            token_sub_chunks = split_chunk_by_tokens_recursive(final_chunk_text, MAX_TOKENS_PER_CHUNK)
-            chunks.extend(token_sub_chunks)
-        else:
-            chunks.append(final_chunk_text)
+        emit_chunk("\n\n".join(current_chunk_texts), current_token_count, "Final chunk")
             
     logger.info(f"Split {file_name} into {len(chunks)} chunks.")
     if not chunks and text: # If text existed but no chunks were made (e.g. single huge paragraph)
@@ -242,44 +734,48 @@ def split_text_into_chunks(text: str, file_name: str) -> List[str]:
 
     return chunks
 
-def split_chunk_by_tokens_recursive(text: str, max_tokens: int) -> List[str]:
-    """Splits text into sub-chunks if it exceeds max_tokens, recursively."""
-    if count_tokens(text) <= max_tokens:
-        return [text]
+def split_text_into_chunks(text: str, file_name: str) -> List[str]:
+    return [chunk_text for chunk_text, _ in split_text_into_chunks_with_tokens(text, file_name)]
 
-    logger.debug(f"Recursively splitting chunk by tokens (original tokens: {count_tokens(text)})")
-    # Simple split: find midpoint by characters (approximation) and then decode.
-    # More advanced: split at sentence boundaries using the tokenizer.
+def split_text_by_tokens_with_counts(text: str, max_tokens: int) -> List[Tuple[str, int]]:
+    """
+    Splits text into pieces of at most max_tokens tokens, preferring to cut at sentence ends or
+    paragraph breaks in the second half of each window. The text is encoded once; a token->character
+    offset map turns boundary positions into token indices, so pieces are cut by token index and
+    sliced from the original text with no decode/re-encode round trips.
+    Returns (piece_text, token_count) pairs.
+    """
     tokens = tokenizer.encode(text)
-    sub_chunks: List[str] = []
-    
-    current_pos = 0
-    while current_pos < len(tokens):
-        end_pos = min(current_pos + max_tokens, len(tokens))
-        # Try to find a sentence break near end_pos if not at the very end
-        # This is a simplified approach; proper sentence tokenization is more robust
-        if end_pos < len(tokens):
-            temp_decode_for_break = tokenizer.decode(tokens[current_pos:end_pos])
-            last_sentence_end = -1
-            for marker in ['. ', '! ', '? ', '\n\n']: # Prefer paragraph breaks
-                idx = temp_decode_for_break.rfind(marker)
-                if idx > last_sentence_end:
-                    last_sentence_end = idx + len(marker) # Include the marker
-            
-            if last_sentence_end > len(temp_decode_for_break) / 2 : # If break is reasonably far in
-                 # Re-encode up to the break to get accurate token count for this segment
-                adjusted_segment_tokens = tokenizer.encode(temp_decode_for_break[:last_sentence_end])
-                end_pos = current_pos + len(adjusted_segment_tokens)
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))]
 
+    logger.debug(f"Splitting chunk by tokens (original tokens: {len(tokens)})")
+    decoded_text, token_offsets = tokenizer.decode_with_offsets(tokens) # token_offsets[i] = char start of token i
+    # Token index of the first token at or after each sentence/paragraph boundary, in ascending order.
+    boundary_token_indices = sorted({
+        bisect.bisect_left(token_offsets, match.end()) for match in _TOKEN_SPLIT_BOUNDARY_PATTERN.finditer(decoded_text)
+    })
 
-        chunk_tokens = tokens[current_pos:end_pos]
-        decoded_chunk = tokenizer.decode(chunk_tokens)
-        if decoded_chunk.strip(): # Avoid empty chunks
-            sub_chunks.append(decoded_chunk)
-        current_pos = end_pos
-        
-    logger.debug(f"Resulted in {len(sub_chunks)} token-based sub-chunks.")
-    return sub_chunks
+    pieces: List[Tuple[str, int]] = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        if end < len(tokens):
+            # Last boundary inside the window; only used if it is reasonably far in.
+            boundary_pos = bisect.bisect_right(boundary_token_indices, end) - 1
+            if boundary_pos >= 0 and boundary_token_indices[boundary_pos] > start + (end - start) // 2:
+                end = boundary_token_indices[boundary_pos]
+        char_end = token_offsets[end] if end < len(tokens) else len(decoded_text)
+        piece = decoded_text[token_offsets[start]:char_end]
+        if piece.strip(): # Avoid empty chunks
+            pieces.append((piece, end - start))
+        start = end
+
+    logger.debug(f"Resulted in {len(pieces)} token-based sub-chunks.")
+    return pieces
+
+def split_text_by_tokens(text: str, max_tokens: int) -> List[str]:
+    return [piece for piece, _ in split_text_by_tokens_with_counts(text, max_tokens)]
 
 
 def get_file_metadata(file_path: Path) -> Dict[str, Any]:
@@ -301,144 +797,658 @@ def initialize_chroma_client() -> chromadb.ClientAPI: # Or simply chromadb.Clien
         CHROMA_DB_DIR.mkdir(parents=True, exist_ok=True)
     return chromadb.PersistentClient(path=str(CHROMA_DB_DIR))
 
-def get_or_create_collection(client: chromadb.ClientAPI, embedding_fx: OpenAIEmbeddingFunction) -> chromadb.Collection:
+def get_or_create_collection(client: chromadb.ClientAPI, embedding_fx: Any) -> chromadb.Collection:
     logger.info(f"Getting or creating ChromaDB collection: {COLLECTION_NAME}")
-    return client.get_or_create_collection(
+    collection = client.get_or_create_collection(
         name=COLLECTION_NAME,
         embedding_function=embedding_fx, # Critical for both adding and querying
-        metadata={"hnsw:space": "cosine"} # Using cosine distance
+        # Using cosine distance. The backend signature is only stored when the collection is created.
+        metadata={"hnsw:space": "cosine", **embeddings.backend_signature(embedding_fx)}
     )
+    embeddings.check_collection_backend(collection, embedding_fx) # Never mix vectors from different models
+    return collection
+
+def extract_text_from_file(file_path: Path, force_ocr: bool = False) -> Tuple[str, Dict[str, Any]]:
+    """
+    Dispatches text extraction by file type. Runs inside the extraction worker processes.
+    Returns the text and extraction metadata that is stored alongside every chunk of the file.
+    """
+    file_suffix = file_path.suffix.lower()
+    content_hash = compute_file_hash(file_path)
+    if file_suffix == ".pdf":
+        logger.info(f"Extracting text from PDF (Force OCR: {force_ocr}): {file_path.name}")
+        pages = extract_pdf_pages(file_path, force_ocr=force_ocr, content_hash=content_hash)
+        page_methods = [method for _, method, _ in pages]
+        distinct_methods = set(page_methods) - {"empty"}
+        extraction_metadata = {
+            "content_hash": content_hash,
+            "extraction_method": distinct_methods.pop() if len(distinct_methods) == 1 else ("hybrid" if distinct_methods else "empty"),
+            "page_extraction_methods": summarize_page_methods(pages),
+            "pages_digital": page_methods.count("digital"),
+            "pages_ocr": page_methods.count("ocr"),
+        }
+        full_text = join_pdf_pages(pages)
+        logger.info(f"Extracted text from {file_path.name}. Length: {len(full_text)} chars. Page methods: {extraction_metadata['page_extraction_methods']}")
+        return full_text, extraction_metadata
+    elif file_suffix == ".docx":
+        return extract_text_from_docx(file_path, content_hash=content_hash), {"content_hash": content_hash, "extraction_method": "docx"}
+    return "", {"content_hash": content_hash}
+
+def _extraction_worker(file_path: Path, force_ocr: bool) -> Tuple[str, Dict[str, Any], Dict[str, Any]]:
+    """
+    Process-pool entry point: extract_text_from_file plus this file's extraction cache hits/misses and
+    its extract/OCR seconds (extract excludes the time spent in OCR).
+    """
+    stats_before, timings_before = extraction_cache.stats(), stage_timings.snapshot()
+    with stage_timings.timed("extract"):
+        full_text, extraction_metadata = extract_text_from_file(file_path, force_ocr)
+    stats_after, timings_after = extraction_cache.stats(), stage_timings.snapshot()
+    worker_stats: Dict[str, Any] = {key: stats_after[key] - stats_before[key] for key in stats_after}
+    ocr_seconds = timings_after.get("ocr", 0.0) - timings_before.get("ocr", 0.0)
+    worker_stats["ocr_seconds"] = ocr_seconds
+    worker_stats["extract_seconds"] = timings_after["extract"] - timings_before.get("extract", 0.0) - ocr_seconds
+    return full_text, extraction_metadata, worker_stats
+
+def make_chunk_id(file_name: str, chunk_text: str) -> str:
+    """Deterministic, content-addressed chunk ID: the same text in the same file always maps to the same ID."""
+    return f"{file_name}_chunk_{hashlib.sha256(chunk_text.encode('utf-8')).hexdigest()[:24]}"
+
+def build_chunk_batch(file_name: str, chunks: List[Tuple[str, int]], file_metadata: Dict[str, Any]) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+    """Builds the documents, metadatas and ids lists for all (chunk_text, token_count) chunks of one file."""
+    batch_documents, batch_metadatas, batch_ids = [], [], []
+    seen_ids: Dict[str, int] = {}
+    current_section = None # Article/clause still running at the end of the previous chunk
+    for i, (chunk_text, chunk_token_count) in enumerate(chunks):
+        chunk_id = make_chunk_id(file_name, chunk_text)
+        # Identical chunks within one file (repeated boilerplate) get an occurrence suffix to stay unique.
+        occurrence = seen_ids.get(chunk_id, 0)
+        seen_ids[chunk_id] = occurrence + 1
+        if occurrence:
+            chunk_id = f"{chunk_id}_{occurrence}"
+
+        # Article/clause headings in this chunk, plus the section continued from the previous chunk.
+        chunk_sections = sections.find_section_headings(chunk_text)
+        if current_section and not sections.starts_with_section_heading(chunk_text) and current_section not in chunk_sections:
+            chunk_sections.insert(0, current_section)
+        if chunk_sections:
+            current_section = chunk_sections[-1]
+
+        chunk_meta = {
+            # Standard metadata for retrieval and filtering
+            "file_name": file_name, # Critical for identifying source file
+            "chunk_number": i,
+            "total_chunks_in_doc": len(chunks),
+            "chunk_char_length": len(chunk_text),
+            "chunk_token_count": chunk_token_count,
+            "chunk_preview": chunk_text[:150].strip().replace("\n", " ") + "...",
+            "sections": ",".join(chunk_sections), # e.g. "clausula:38,clausula:39"; indexed in the manifest's sections table
+            # Include all file-level metadata for potential future use or detailed inspection
+            **file_metadata
+        }
+        batch_documents.append(chunk_text)
+        batch_metadatas.append(chunk_meta)
+        batch_ids.append(chunk_id)
+    return batch_documents, batch_metadatas, batch_ids
+
+def _chunking_stage(extracted_queue: queue.Queue, write_queue: queue.Queue) -> None:
+    """Pipeline stage 2: cleans and chunks extracted text, then hands batches to the writer."""
+    try:
+        while True:
+            item = extracted_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            file_path, file_metadata, full_text = item
+            file_name = file_path.name
+            try:
+                if not full_text or not full_text.strip():
+                    logger.warning(f"No text extracted from {file_name}. Skipping.")
+                    write_queue.put((file_path, file_metadata, [], [], [])) # Still lets the writer drop the file's stale chunks
+                    continue
+
+                with stage_timings.timed("clean"):
+                    cleaned_text = clean_text(full_text)
+                with stage_timings.timed("chunk"):
+                    chunks = split_text_into_chunks_with_tokens(cleaned_text, file_name)
+
+                if not chunks:
+                    logger.warning(f"No chunks generated for {file_name} after splitting. Skipping.")
+                    write_queue.put((file_path, file_metadata, [], [], []))
+                    continue
+
+                write_queue.put((file_path, file_metadata, *build_chunk_batch(file_name, chunks, file_metadata)))
+            except Exception as e:
+                logger.error(f"Error chunking {file_name}: {e}", exc_info=True)
+    finally:
+        write_queue.put(_PIPELINE_DONE) # Always release the writer, even if this stage fails
+
+def _is_retryable_embedding_error(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)):
+        return True
+    message = str(error).lower()
+    return "429" in message or "rate limit" in message
+
+class EmbeddingScheduler:
+    """
+    Embeds chunks ahead of the ChromaDB write instead of letting collection.add() embed each batch opaquely.
+    Chunks are packed into requests of at most EMBEDDING_BATCH_MAX_TOKENS tokens (using the chunk_token_count
+    already in their metadata) or EMBEDDING_BATCH_MAX_INPUTS chunks; a partial request is also sent when the
+    writer has nothing else queued (flush_if_idle). Up to EMBEDDING_CONCURRENCY requests run concurrently
+    across files, and throttled requests are retried with exponential backoff. Precomputed vectors are written by the caller's
+    thread, so there is still a single ChromaDB writer.
+    """
+    def __init__(self, collection_to_load: chromadb.Collection, embedding_fx: Any, stats: Dict[str, int]):
+        self.collection = collection_to_load
+        self.embedding_fx = embedding_fx
+        self.stats = stats
+        self.executor = ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix="embed")
+        self.in_flight: Deque[Tuple[Future, List[str], List[str], List[Dict[str, Any]]]] = deque()
+        self.buffer_ids: List[str] = []
+        self.buffer_documents: List[str] = []
+        self.buffer_metadatas: List[Dict[str, Any]] = []
+        self.buffer_tokens = 0
+        self.failed_paths = set() # absolute_path_str of files with chunks that could not be embedded or written
+
+    def add(self, chunk_id: str, document: str, metadata: Dict[str, Any]) -> None:
+        tokens = metadata.get("chunk_token_count") or count_tokens(document)
+        if self.buffer_ids and (self.buffer_tokens + tokens > EMBEDDING_BATCH_MAX_TOKENS or len(self.buffer_ids) >= EMBEDDING_BATCH_MAX_INPUTS):
+            self._submit()
+        self.buffer_ids.append(chunk_id)
+        self.buffer_documents.append(document)
+        self.buffer_metadatas.append(metadata)
+        self.buffer_tokens += tokens
+
+    def _submit(self) -> None:
+        future = self.executor.submit(self._embed_with_retry, self.buffer_documents)
+        self.in_flight.append((future, self.buffer_ids, self.buffer_documents, self.buffer_metadatas))
+        self.buffer_ids, self.buffer_documents, self.buffer_metadatas, self.buffer_tokens = [], [], [], 0
+        # Bound the number of embedded-but-unwritten requests held in memory.
+        while len(self.in_flight) > EMBEDDING_CONCURRENCY * 2:
+            self._write_oldest()
 
-def process_and_load_documents(collection_to_load: chromadb.Collection, force_ocr_all_pdfs: bool = False, force_reprocess_all_files: bool = False):
-    logger.info(f"Starting document processing from: {HR_DOCS_DIR}. Force OCR all PDFs: {force_ocr_all_pdfs}. Force reprocess all: {force_reprocess_all_files}")
+    def _embed_with_retry(self, documents: List[str]) -> List[Any]:
+        for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+            try:
+                with stage_timings.timed("embed"):
+                    return self.embedding_fx(documents)
+            except Exception as e:
+                if attempt >= EMBEDDING_MAX_RETRIES or not _is_retryable_embedding_error(e):
+                    raise
+                delay = min(EMBEDDING_BACKOFF_MAX_SECONDS, EMBEDDING_BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logger.warning(f"Embedding request for {len(documents)} chunks was throttled ({e}). Retrying in {delay:.1f}s (attempt {attempt + 1}/{EMBEDDING_MAX_RETRIES}).")
+                time.sleep(delay)
+
+    def _write_oldest(self) -> None:
+        future, ids, documents, metadatas = self.in_flight.popleft()
+        try:
+            embeddings = future.result()
+        except Exception as e:
+            logger.error(f"Embedding request for {len(ids)} chunks failed after retries: {e}")
+            self.stats["embedding_failures"] += len(ids)
+            self.failed_paths.update(meta["absolute_path_str"] for meta in metadatas)
+            return
+        for start in range(0, len(ids), WRITE_BATCH_SIZE):
+            end = start + WRITE_BATCH_SIZE
+            try:
+                logger.info(f"Adding {len(ids[start:end])} embedded chunks to ChromaDB.")
+                with stage_timings.timed("write"):
+                    self.collection.add(ids=ids[start:end], documents=documents[start:end], metadatas=metadatas[start:end], embeddings=embeddings[start:end])
+                self.stats["new_chunks_added"] += len(ids[start:end])
+            except Exception as e:
+                logger.error(f"Error adding batch to ChromaDB: {e}")
+                self.failed_paths.update(meta["absolute_path_str"] for meta in metadatas[start:end])
+
+    def flush_if_idle(self, write_queue: queue.Queue) -> None:
+        """Sends the buffered chunks now if no other file is waiting to be written, instead of waiting for a full request."""
+        if self.buffer_ids and write_queue.empty():
+            self._submit()
+
+    def write_completed(self) -> None:
+        """Writes every request that has already finished, in submission order, without blocking."""
+        while self.in_flight and self.in_flight[0][0].done():
+            self._write_oldest()
+
+    def close(self) -> None:
+        if self.buffer_ids:
+            self._submit()
+        while self.in_flight:
+            self._write_oldest()
+        self.executor.shutdown()
+
+def _writer_stage(collection_to_load: chromadb.Collection, write_queue: queue.Queue, stats: Dict[str, int], embedding_fx: Any = None, manifest: Optional[IngestionManifest] = None) -> None:
+    """
+    Pipeline stage 3: the single ChromaDB writer. Diffs each file's chunk IDs against the stored ones:
+    only new or changed chunks are added (and embedded), unchanged chunks get a metadata-only update,
+    and chunks that disappeared from the file are deleted. New chunks are accumulated across files
+    and inserted in batches; with an embedding_fx they go through the EmbeddingScheduler instead.
+    Once everything is written, each file's new chunk IDs are recorded in the ingestion manifest;
+    files with chunks that failed to write are invalidated so the next run picks them up again.
+    """
+    scheduler = EmbeddingScheduler(collection_to_load, embedding_fx, stats) if embedding_fx is not None else None
+    failed_paths = scheduler.failed_paths if scheduler is not None else set()
+    written_files: Dict[str, Tuple[Path, Dict[str, Any], List[str], List[Tuple[str, str]]]] = {}
+    pending_documents: List[str] = []
+    pending_metadatas: List[Dict[str, Any]] = []
+    pending_ids: List[str] = []
+    pending_files: List[str] = []
+
+    def flush() -> None:
+        if not pending_ids:
+            return
+        for start in range(0, len(pending_ids), WRITE_BATCH_SIZE):
+            end = start + WRITE_BATCH_SIZE
+            try:
+                logger.info(f"Adding {len(pending_ids[start:end])} chunks to ChromaDB (files: {', '.join(pending_files)}).")
+                with stage_timings.timed("write"): # Includes ChromaDB's own embedding call when no embedding_fx is given
+                    collection_to_load.add(documents=pending_documents[start:end], metadatas=pending_metadatas[start:end], ids=pending_ids[start:end])
+                stats["new_chunks_added"] += len(pending_ids[start:end])
+                logger.info(f"Successfully added/updated {len(pending_ids[start:end])} chunks.")
+            except Exception as e:
+                logger.error(f"Error adding batch to ChromaDB for {', '.join(pending_files)}: {e}")
+                failed_paths.update(meta["absolute_path_str"] for meta in pending_metadatas[start:end])
+        pending_documents.clear()
+        pending_metadatas.clear()
+        pending_ids.clear()
+        pending_files.clear()
+
+    while True:
+        item = write_queue.get()
+        if item is _PIPELINE_DONE:
+            break
+        file_path, file_metadata, batch_documents, batch_metadatas, batch_ids = item
+        file_name = file_path.name
+        chunk_sections = [(section, chunk_id) for chunk_id, meta in zip(batch_ids, batch_metadatas) for section in meta["sections"].split(",") if section]
+        written_files[file_metadata["absolute_path_str"]] = (file_path, file_metadata, batch_ids, chunk_sections)
+        manifest_entry = manifest.get(file_path) if manifest is not None else None
+        if manifest_entry is not None and manifest_entry["chunk_ids"] is not None:
+            existing_ids = set(manifest_entry["chunk_ids"])
+        else:
+            try:
+                existing_ids = set(collection_to_load.get(where={"file_name": file_name}, include=[])['ids'])
+            except Exception as e:
+                logger.error(f"Could not read existing chunk IDs for {file_name}: {e}. Treating all chunks as new.")
+                existing_ids = set()
+
+        new_ids = set(batch_ids)
+        stale_ids = sorted(existing_ids - new_ids)
+        if stale_ids:
+            try:
+                logger.info(f"Deleting {len(stale_ids)} stale chunks for {file_name}.")
+                with stage_timings.timed("write"):
+                    collection_to_load.delete(ids=stale_ids)
+                stats["stale_chunks_deleted"] += len(stale_ids)
+            except Exception as e:
+                logger.error(f"Error deleting stale chunks for {file_name}: {e}")
+
+        if not batch_ids:
+            continue
+        stats["processed_files"] += 1
+
+        unchanged = [(chunk_id, meta) for chunk_id, meta in zip(batch_ids, batch_metadatas) if chunk_id in existing_ids]
+        if unchanged:
+            try:
+                # Metadata-only update: no documents are passed, so nothing is re-embedded.
+                with stage_timings.timed("write"):
+                    collection_to_load.update(ids=[chunk_id for chunk_id, _ in unchanged], metadatas=[meta for _, meta in unchanged])
+                stats["chunks_metadata_updated"] += len(unchanged) # Same text and vector: not an index change
+                stats["embeddings_skipped"] += len(unchanged)
+            except Exception as e:
+                logger.error(f"Error updating metadata of unchanged chunks for {file_name}: {e}")
+
+        logger.info(f"{file_name}: {len(batch_ids) - len(unchanged)} new/changed chunks, {len(unchanged)} unchanged, {len(stale_ids)} removed.")
+        if scheduler is not None:
+            for chunk_id, document, meta in zip(batch_ids, batch_documents, batch_metadatas):
+                if chunk_id not in existing_ids:
+                    scheduler.add(chunk_id, document, meta)
+            scheduler.flush_if_idle(write_queue) # Embed while the next file is still being extracted/chunked
+            scheduler.write_completed()
+            continue
+        for chunk_id, document, meta in zip(batch_ids, batch_documents, batch_metadatas):
+            if chunk_id not in existing_ids:
+                pending_ids.append(chunk_id)
+                pending_documents.append(document)
+                pending_metadatas.append(meta)
+        pending_files.append(file_name)
+        if len(pending_ids) >= WRITE_BATCH_SIZE:
+            flush()
+    if scheduler is not None:
+        scheduler.close()
+    flush()
+
+    if manifest is None:
+        return
+    for absolute_path_str, (file_path, file_metadata, chunk_ids, chunk_sections) in written_files.items():
+        if absolute_path_str in failed_paths:
+            manifest.invalidate(file_path)
+        elif file_metadata.get("content_hash"):
+            manifest.record(file_path, file_metadata["file_size_bytes"], file_metadata["modified_at_timestamp"], file_metadata["content_hash"], chunk_ids, chunk_sections)
+
+def _run_ingestion_pipeline(collection_to_load: chromadb.Collection, files_to_process: List[Tuple[Path, Dict[str, Any]]], force_ocr: bool, max_workers: int, embedding_fx: Any = None, manifest: Optional[IngestionManifest] = None) -> Dict[str, int]:
+    """
+    Runs the staged ingestion pipeline over the files that need (re)processing:
+      1. extraction/OCR in a process pool (max_workers processes),
+      2. cleaning and chunking in a dedicated thread,
+      3. a single writer thread that batches inserts into the collection (embedding them
+         ahead of time through the EmbeddingScheduler when embedding_fx is given).
+    Stages are connected by bounded queues so a slow stage applies backpressure
+    instead of buffering every extracted document in memory.
+    """
+    stats = {
+        "processed_files": 0, "new_chunks_added": 0, "chunks_metadata_updated": 0, "embeddings_skipped": 0, "embedding_failures": 0, "stale_chunks_deleted": 0,
+        "extraction_cache_hits": 0, "extraction_cache_misses": 0, "pages_digital": 0, "pages_ocr": 0,
+        # Seconds per stage, summed across worker processes and threads (so they can exceed the elapsed time)
+        "extract_seconds": 0.0, "ocr_seconds": 0.0, "clean_seconds": 0.0, "chunk_seconds": 0.0, "embed_seconds": 0.0, "write_seconds": 0.0,
+    }
+    if not files_to_process:
+        return stats
+
+    def add_worker_stats(worker_stats: Dict[str, Any], extraction_metadata: Dict[str, Any]) -> None:
+        stats["extraction_cache_hits"] += worker_stats["hits"]
+        stats["extraction_cache_misses"] += worker_stats["misses"]
+        stats["extract_seconds"] += worker_stats["extract_seconds"]
+        stats["ocr_seconds"] += worker_stats["ocr_seconds"]
+        stats["pages_digital"] += extraction_metadata.get("pages_digital", 0)
+        stats["pages_ocr"] += extraction_metadata.get("pages_ocr", 0)
+
+    # Clean/chunk/embed/write run in this process; extract/OCR times come back from the workers.
+    timings_before = stage_timings.snapshot()
+
+    extracted_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    write_queue: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    chunker = threading.Thread(target=_chunking_stage, args=(extracted_queue, write_queue), name="loader-chunker", daemon=True)
+    writer = threading.Thread(target=_writer_stage, args=(collection_to_load, write_queue, stats, embedding_fx, manifest), name="loader-writer", daemon=True)
+    chunker.start()
+    writer.start()
+
+    logger.info(f"Extracting {len(files_to_process)} files with {max_workers} worker process(es).")
+    try:
+        if max_workers <= 1:
+            # In-process extraction; useful for debugging and on platforms where spawning is expensive.
+            _init_extraction_worker(ocr_threads_per_worker(1))
+            for file_path, file_metadata in files_to_process:
+                try:
+                    full_text, extraction_metadata, worker_stats = _extraction_worker(file_path, force_ocr)
+                    add_worker_stats(worker_stats, extraction_metadata)
+                except Exception as e:
+                    logger.error(f"Error extracting text from {file_path.name}: {e}")
+                    full_text, extraction_metadata = "", {}
+                extracted_queue.put((file_path, {**file_metadata, **extraction_metadata}, full_text))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_extraction_worker, initargs=(ocr_threads_per_worker(max_workers),)) as executor:
+                pending_files = iter(files_to_process)
+                in_flight = {}
+
+                def submit_next() -> None:
+                    next_file = next(pending_files, None)
+                    if next_file is not None:
+                        in_flight[executor.submit(_extraction_worker, next_file[0], force_ocr)] = next_file
+
+                # Keep at most 2 files per worker in flight so results never pile up in memory.
+                for _ in range(max_workers * 2):
+                    submit_next()
+
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        file_path, file_metadata = in_flight.pop(future)
+                        try:
+                            full_text, extraction_metadata, worker_stats = future.result()
+                            add_worker_stats(worker_stats, extraction_metadata)
+                        except Exception as e:
+                            logger.error(f"Error extracting text from {file_path.name}: {e}")
+                            full_text, extraction_metadata = "", {}
+                        # Blocks while the chunker is behind
+                        extracted_queue.put((file_path, {**file_metadata, **extraction_metadata}, full_text))
+                        submit_next()
+    finally:
+        extracted_queue.put(_PIPELINE_DONE)
+        chunker.join()
+        writer.join()
+
+    timings_after = stage_timings.snapshot()
+    for stage in ("clean", "chunk", "embed", "write"):
+        stats[f"{stage}_seconds"] += timings_after.get(stage, 0.0) - timings_before.get(stage, 0.0)
+    return stats
+
+def _file_needs_update(collection_to_load: chromadb.Collection, manifest: IngestionManifest, file_path: Path, current_file_metadata: Dict[str, Any]) -> bool:
+    file_name = file_path.name
+    current_mod_time = current_file_metadata['modified_at_timestamp']
+    entry = manifest.get(file_path)
+    if entry is not None:
+        unchanged = entry["size_bytes"] == current_file_metadata['file_size_bytes'] and entry["mtime"] == current_mod_time
+        if not unchanged and compute_file_hash(file_path) == entry["content_hash"]:
+            logger.info(f"File {file_name} was touched or copied but its content is unchanged.")
+            manifest.update_stat(file_path, current_file_metadata['file_size_bytes'], current_mod_time)
+            unchanged = True
+        if unchanged:
+            if entry["sections_indexed"]:
+                logger.info(f"File {file_name} has not been modified since last load (Timestamp: {current_mod_time}). Skipping.")
+                return False
+            # Loaded before the article/clause index existed; the ID diff keeps its chunks from being re-embedded.
+            logger.info(f"File {file_name} is unchanged but has no article/clause index yet. Reprocessing.")
+            return True
+        logger.info(f"File {file_name} has been modified (Current: {current_mod_time}, Stored: {entry['mtime']}). Reprocessing.")
+        return True
+
+    # Not in the manifest yet (e.g. a collection built before the manifest existed):
+    # fall back to the stored chunk metadata once, and record the file if it is up to date.
+    try:
+        existing_data = collection_to_load.get(
+            where={"file_name": file_name}, # Query by 'file_name' stored in metadata
+            include=["metadatas"]
+        )
+        if existing_data and existing_data['ids']:
+            # This assumes all chunks from the same file version have the same original file mod time
+            stored_mod_time = existing_data['metadatas'][0].get('modified_at_timestamp')
+            if stored_mod_time == current_mod_time:
+                logger.info(f"File {file_name} has not been modified since last load (Timestamp: {stored_mod_time}). Skipping.")
+                stored_metadatas = existing_data['metadatas']
+                chunk_sections = None # Chunks loaded before the section index have no "sections" metadata
+                if all("sections" in meta for meta in stored_metadatas):
+                    chunk_sections = [(section, chunk_id) for chunk_id, meta in zip(existing_data['ids'], stored_metadatas) for section in meta["sections"].split(",") if section]
+                manifest.record(file_path, current_file_metadata['file_size_bytes'], current_mod_time, compute_file_hash(file_path), existing_data['ids'], chunk_sections)
+                return False
+            logger.info(f"File {file_name} has been modified (Current: {current_mod_time}, Stored: {stored_mod_time}). Reprocessing.")
+        else:
+            logger.info(f"No existing chunks found for {file_name}. Will process as new.")
+    except Exception as e:
+        logger.warning(f"Could not reliably check existing chunks for {file_name} due to: {e}. Will process.")
+    return True
+
+def purge_deleted_files(collection_to_load: chromadb.Collection, manifest: IngestionManifest) -> Tuple[int, int]:
+    """Deletes the chunks of every manifest file that no longer exists on disk. Returns (files, chunks) purged."""
+    purged_files, purged_chunks = 0, 0
+    for file_path in manifest.file_paths():
+        if file_path.exists():
+            continue
+        entry = manifest.get(file_path)
+        chunk_ids = entry["chunk_ids"] if entry else []
+        try:
+            if chunk_ids is None: # Invalidated entry; chunk IDs have to be looked up
+                chunk_ids = collection_to_load.get(where={"file_name": file_path.name}, include=[])['ids']
+            if chunk_ids:
+                collection_to_load.delete(ids=chunk_ids)
+            manifest.forget(file_path)
+            logger.info(f"File {file_path.name} was removed from {HR_DOCS_DIR.name}/. Purged its {len(chunk_ids)} chunks.")
+            purged_files += 1
+            purged_chunks += len(chunk_ids)
+        except Exception as e:
+            logger.error(f"Error purging chunks for deleted file {file_path.name}: {e}")
+    return purged_files, purged_chunks
+
+def process_and_load_documents(collection_to_load: chromadb.Collection, force_ocr_all_pdfs: bool = False, force_reprocess_all_files: bool = False, max_workers: Optional[int] = None, embedding_fx: Any = None, file_paths: Optional[Iterable[Path]] = None) -> Dict[str, Any]:
+    """
+    Loads new and modified documents from HR_DOCS_DIR and purges the chunks of deleted ones.
+    file_paths restricts the check to those files (watch mode passes the files that changed);
+    by default every file in HR_DOCS_DIR is checked. Returns the run stats.
+    """
+    max_workers = max_workers if max_workers is not None else LOADER_MAX_WORKERS
+    logger.info(f"Starting document processing from: {HR_DOCS_DIR}. Force OCR all PDFs: {force_ocr_all_pdfs}. Force reprocess all: {force_reprocess_all_files}. Workers: {max_workers}")
+    run_stats: Dict[str, Any] = {"checked_files": 0, "files_to_process": 0, "purged_files": 0, "purged_chunks": 0}
     if not HR_DOCS_DIR.exists():
         logger.error(f"Documents directory not found: {HR_DOCS_DIR}. Please create it and add .pdf or .docx files.")
         HR_DOCS_DIR.mkdir(parents=True, exist_ok=True) # Create if not exists
         logger.info(f"{HR_DOCS_DIR} created. Please add documents and re-run.")
-        return
+        return run_stats
 
     processed_files_count = 0
     new_chunks_added_this_run = 0
+    files_to_process: List[Tuple[Path, Dict[str, Any]]] = []
+    manifest = get_ingestion_manifest(collection_to_load)
+    current_paths = set()
+    items = HR_DOCS_DIR.iterdir() if file_paths is None else (path for path in file_paths if path.exists())
 
-    for item in HR_DOCS_DIR.iterdir():
+    for item in items:
         if item.is_file():
             file_path = item
             file_name = item.name
             file_suffix = item.suffix.lower()
-            logger.info(f"--- Processing file: {file_name} ---")
+            logger.info(f"--- Checking file: {file_name} ---")
 
-            if not (file_suffix == ".pdf" or file_suffix == ".docx"):
+            if file_suffix not in SUPPORTED_SUFFIXES:
                 logger.info(f"Skipping unsupported file type: {file_name}")
                 continue
 
             current_file_metadata = get_file_metadata(file_path)
+            current_paths.add(file_path.resolve())
+            run_stats["checked_files"] += 1
             
             # Check if file needs update
             needs_update = True # Assume it needs update by default
             if not force_reprocess_all_files:
-                # Query for chunks from this file_name and check their 'modified_at_timestamp'
-                # This assumes 'file_name' is unique and 'modified_at_timestamp' is stored reliably.
-                try:
-                    existing_data = collection_to_load.get(
-                        where={"file_name": file_name}, # Query by 'file_name' stored in metadata
-                        include=["metadatas"]
-                    )
-                    if existing_data and existing_data['ids']:
-                        # Check the mod time of the first retrieved chunk's metadata for this file
-                        # This assumes all chunks from the same file version have the same original file mod time
-                        stored_mod_time = existing_data['metadatas'][0].get('modified_at_timestamp')
-                        if stored_mod_time == current_file_metadata['modified_at_timestamp']:
-                            logger.info(f"File {file_name} has not been modified since last load (Timestamp: {stored_mod_time}). Skipping.")
-                            needs_update = False
-                        else:
-                            logger.info(f"File {file_name} has been modified (Current: {current_file_metadata['modified_at_timestamp']}, Stored: {stored_mod_time}). Reprocessing.")
-                    else:
-                        logger.info(f"No existing chunks found for {file_name}. Will process as new.")
-                except Exception as e:
-                    logger.warning(f"Could not reliably check existing chunks for {file_name} due to: {e}. Will process.")
-
-
-            if needs_update or force_reprocess_all_files:
-                if not needs_update and force_reprocess_all_files: # Log if forced
-                    logger.info(f"Force reprocessing enabled for {file_name}.")
-                
-                # If updating, delete old chunks for this file first
-                if needs_update: # Also true if force_reprocess_all_files caused needs_update to remain true
-                    try:
-                        ids_to_delete = collection_to_load.get(where={"file_name": file_name}, include=[])['ids']
-                        if ids_to_delete:
-                            logger.info(f"Deleting {len(ids_to_delete)} old chunks for updated file: {file_name}")
-                            collection_to_load.delete(ids=ids_to_delete)
-                        else:
-                             logger.info(f"No old chunks found to delete for {file_name} (might be new or already cleared).")
-                    except Exception as e:
-                        logger.error(f"Error deleting old chunks for {file_name}: {e}. Continuing with adding new chunks.")
-
-
-                full_text = ""
-                if file_suffix == ".pdf":
-                    full_text = extract_text_from_pdf_with_ocr(file_path, force_ocr=force_ocr_all_pdfs)
-                elif file_suffix == ".docx":
-                    full_text = extract_text_from_docx(file_path)
+                needs_update = _file_needs_update(collection_to_load, manifest, file_path, current_file_metadata)
 
-                if not full_text or not full_text.strip():
-                    logger.warning(f"No text extracted from {file_name}. Skipping.")
-                    continue
-                
-                cleaned_text = clean_text(full_text)
-                chunks = split_text_into_chunks(cleaned_text, file_name)
-                
-                if not chunks:
-                    logger.warning(f"No chunks generated for {file_name} after splitting. Skipping.")
-                    continue
-                
-                batch_documents, batch_metadatas, batch_ids = [], [], []
-                for i, chunk_text in enumerate(chunks):
-                    # Create a more robust unique ID, e.g., using file name and chunk index + timestamp
-                    chunk_id = f"{file_name}_chunk_{i}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
-                    
-                    chunk_meta = {
-                        # Standard metadata for retrieval and filtering
-                        "file_name": file_name, # Critical for identifying source file
-                        "chunk_number": i,
-                        "total_chunks_in_doc": len(chunks),
-                        "chunk_char_length": len(chunk_text),
-                        "chunk_token_count": count_tokens(chunk_text),
-                        "chunk_preview": chunk_text[:150].strip().replace("\n", " ") + "...",
-                        # Include all file-level metadata for potential future use or detailed inspection
-                        **current_file_metadata 
-                    }
-                    batch_documents.append(chunk_text)
-                    batch_metadatas.append(chunk_meta)
-                    batch_ids.append(chunk_id)
-                
-                if batch_documents:
-                    try:
-                        logger.info(f"Adding {len(batch_documents)} chunks for {file_name} to ChromaDB.")
-                        collection_to_load.add(documents=batch_documents, metadatas=batch_metadatas, ids=batch_ids)
-                        logger.info(f"Successfully added/updated chunks for {file_name}.")
-                        new_chunks_added_this_run += len(batch_documents)
-                    except Exception as e:
-                        logger.error(f"Error adding batch to ChromaDB for {file_name}: {e}")
-            processed_files_count +=1
+            if not needs_update:
+                processed_files_count += 1
+                continue
+
+            if force_reprocess_all_files:
+                logger.info(f"Force reprocessing enabled for {file_name}.")
+
+            # Old chunks are not deleted up front: the writer stage diffs them against the new chunks.
+            files_to_process.append((file_path, current_file_metadata))
         else: # Is a directory or other non-file item
             logger.debug(f"Skipping item (not a file): {item.name}")
 
+    purged_files, purged_chunks = purge_deleted_files(collection_to_load, manifest)
+    pipeline_stats = _run_ingestion_pipeline(collection_to_load, files_to_process, force_ocr_all_pdfs, max_workers, embedding_fx, manifest)
+    run_stats.update(pipeline_stats, files_to_process=len(files_to_process), purged_files=purged_files, purged_chunks=purged_chunks)
+    processed_files_count += pipeline_stats["processed_files"]
+    new_chunks_added_this_run += pipeline_stats["new_chunks_added"]
 
     logger.info("--- Document Loading Summary ---")
     logger.info(f"Total files checked/processed in this run: {processed_files_count}")
-    logger.info(f"New chunks added/updated in collection in this run: {new_chunks_added_this_run}")
+    logger.info(f"New chunks added to collection in this run: {new_chunks_added_this_run}")
+    logger.info(f"Unchanged chunks with updated metadata: {pipeline_stats['chunks_metadata_updated']}")
+    logger.info(f"Embeddings skipped for unchanged chunks: {pipeline_stats['embeddings_skipped']}. Stale chunks deleted: {pipeline_stats['stale_chunks_deleted']}")
+    if purged_files:
+        logger.info(f"Files removed from {HR_DOCS_DIR.name}/: {purged_files} (purged {purged_chunks} chunks)")
+    if pipeline_stats["embedding_failures"]:
+        logger.error(f"Chunks that could not be embedded (their files will be reprocessed on the next run): {pipeline_stats['embedding_failures']}")
+    if files_to_process:
+        logger.info("Stage timings (s, summed across workers/threads): " + ", ".join(
+            f"{stage} {pipeline_stats[f'{stage}_seconds']:.2f}" for stage in ("extract", "ocr", "clean", "chunk", "embed", "write")))
+    if EXTRACTION_CACHE_ENABLED:
+        cache_lookups = pipeline_stats["extraction_cache_hits"] + pipeline_stats["extraction_cache_misses"]
+        hit_rate = pipeline_stats["extraction_cache_hits"] / cache_lookups if cache_lookups else 0.0
+        logger.info(f"Extraction cache: {pipeline_stats['extraction_cache_hits']} hits, {pipeline_stats['extraction_cache_misses']} misses (hit rate {hit_rate:.0%}).")
     try:
         total_chunks_in_collection = collection_to_load.count()
+        run_stats["total_chunks"] = total_chunks_in_collection
         logger.info(f"Total chunks now in '{COLLECTION_NAME}': {total_chunks_in_collection}")
     except Exception as e:
         logger.error(f"Could not get total count from collection '{COLLECTION_NAME}': {e}")
 
+    # Metadata-only updates of unchanged chunks (touched files, --force-reprocess) leave every text and vector as it
+    # was, so they don't bump the index version (which flushes the answer cache and reloads every HRAssistant).
+    index_changed = bool(pipeline_stats["new_chunks_added"] or pipeline_stats["stale_chunks_deleted"] or purged_chunks)
+    run_stats["index_version"] = manifest.record_run(run_stats, index_changed)
+    if index_changed:
+        logger.info(f"Index version is now {run_stats['index_version']}.")
+    return run_stats
+
+def snapshot_documents_dir() -> Dict[Path, Tuple[int, float]]:
+    """(size, mtime) of every supported document in HR_DOCS_DIR; comparing two snapshots gives the changed files."""
+    snapshot = {}
+    if not HR_DOCS_DIR.is_dir():
+        return snapshot
+    for item in HR_DOCS_DIR.iterdir():
+        try:
+            if item.is_file() and item.suffix.lower() in SUPPORTED_SUFFIXES:
+                stat = item.stat()
+                snapshot[item.resolve()] = (stat.st_size, stat.st_mtime)
+        except OSError: # Removed between iterdir() and stat()
+            continue
+    return snapshot
+
+def watch_and_load_documents(collection_to_load: chromadb.Collection, force_ocr_all_pdfs: bool = False, max_workers: Optional[int] = None, embedding_fx: Any = None,
+                             poll_seconds: float = WATCH_POLL_SECONDS, debounce_seconds: float = WATCH_DEBOUNCE_SECONDS, stop_event: Optional[threading.Event] = None) -> None:
+    """
+    Watch mode: after one full pass, polls HR_DOCS_DIR every poll_seconds and re-indexes only the files that
+    were added, modified or deleted. A burst of changes (e.g. copying a folder of documents) is debounced:
+    indexing starts once the directory has been unchanged for debounce_seconds. Every run bumps the index
+    version in the manifest when the collection changed, which is how the Flask app notices new content.
+    Runs until stop_event is set (or SIGINT/SIGTERM when run from the command line).
+    """
+    stop_event = stop_event or threading.Event()
+    manifest = get_ingestion_manifest(collection_to_load)
+    logger.info(f"Watch mode: polling {HR_DOCS_DIR} every {poll_seconds:g}s (debounce {debounce_seconds:g}s).")
+
+    indexed_snapshot = snapshot_documents_dir()
+    process_and_load_documents(collection_to_load, force_ocr_all_pdfs=force_ocr_all_pdfs, max_workers=max_workers, embedding_fx=embedding_fx)
+    last_seen_snapshot, last_change_at = indexed_snapshot, None
+    failure_counts: Dict[Path, int] = {}
+
+    try:
+        manifest.record_watcher_heartbeat(os.getpid())
+        while not stop_event.wait(poll_seconds):
+            manifest.record_watcher_heartbeat(os.getpid())
+            current_snapshot = snapshot_documents_dir()
+            if current_snapshot != last_seen_snapshot:
+                # Still changing; restart the quiet period
+                last_seen_snapshot, last_change_at = current_snapshot, time.monotonic()
+                continue
+            if current_snapshot == indexed_snapshot or (last_change_at is not None and time.monotonic() - last_change_at < debounce_seconds):
+                continue
+
+            changed_paths: Set[Path] = {path for path in current_snapshot.keys() | indexed_snapshot.keys() if current_snapshot.get(path) != indexed_snapshot.get(path)}
+            logger.info(f"Watch mode: {len(changed_paths)} changed file(s): {', '.join(sorted(path.name for path in changed_paths))}")
+            try:
+                process_and_load_documents(collection_to_load, force_ocr_all_pdfs=force_ocr_all_pdfs, max_workers=max_workers, embedding_fx=embedding_fx, file_paths=changed_paths)
+            except Exception as e:
+                logger.error(f"Watch mode: error while indexing changed files: {e}", exc_info=True)
+
+            # Files that were not recorded (extraction or embedding failed) stay pending and are retried on the next poll.
+            indexed_snapshot = dict(current_snapshot)
+            for path in changed_paths:
+                signature = current_snapshot.get(path)
+                if signature is None or manifest.matches(path, *signature):
+                    failure_counts.pop(path, None)
+                    continue
+                failure_counts[path] = failure_counts.get(path, 0) + 1
+                if failure_counts[path] < WATCH_MAX_RETRIES:
+                    indexed_snapshot.pop(path, None)
+                else:
+                    logger.error(f"Watch mode: giving up on {path.name} after {WATCH_MAX_RETRIES} attempts; it will be retried when it changes.")
+                    failure_counts.pop(path)
+            last_change_at = None
+    finally:
+        manifest.record_watcher_heartbeat(None)
+        logger.info("Watch mode stopped.")
+
 # --- Main Execution ---
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Load the HR documents into ChromaDB.")
+    arg_parser.add_argument("--watch", action="store_true", help="Keep running and re-index files as they are added, modified or deleted")
+    arg_parser.add_argument("--force-ocr", action="store_true", help="OCR all PDFs regardless of digital text extraction success")
+    arg_parser.add_argument("--force-reprocess", action="store_true", help="Reprocess all files even if not modified")
+    arg_parser.add_argument("--workers", type=int, default=None, help=f"Extraction/OCR worker processes (default {LOADER_MAX_WORKERS})")
+    arg_parser.add_argument("--poll-seconds", type=float, default=WATCH_POLL_SECONDS)
+    arg_parser.add_argument("--debounce-seconds", type=float, default=WATCH_DEBOUNCE_SECONDS)
+    args = arg_parser.parse_args()
+
     logger.info("Starting HR Document Loader script with OCR capabilities.")
     
-    if not OPENAI_API_KEY:
+    if embeddings.backend_requires_api_key() and not OPENAI_API_KEY:
         logger.error("CRITICAL: OPENAI_API_KEY environment variable not set. This is required for embeddings. Exiting.")
         exit(1)
     
@@ -471,21 +1481,40 @@ if __name__ == "__main__":
             logger.error(f"Could not create dummy .docx file: {e}")
 
 
-    # You can add an argument parser here to control force_ocr_all_pdfs from command line
-    # For example: `python loader.py --force-ocr --force-reprocess`
-    FORCE_OCR_ALL_PDFS = False # Set to True to OCR all PDFs regardless of digital text extraction success
-    FORCE_REPROCESS_ALL = False # Set to True to reprocess all files even if not modified
+    FORCE_OCR_ALL_PDFS = args.force_ocr
+    FORCE_REPROCESS_ALL = args.force_reprocess
 
     try:
         openai_embedding_function = get_embedding_function()
         chroma_client_instance = initialize_chroma_client()
         hr_collection_instance = get_or_create_collection(chroma_client_instance, openai_embedding_function)
         
-        process_and_load_documents(
-            hr_collection_instance,
-            force_ocr_all_pdfs=FORCE_OCR_ALL_PDFS,
-            force_reprocess_all_files=FORCE_REPROCESS_ALL
-        )
+        if args.watch:
+            if FORCE_REPROCESS_ALL:
+                process_and_load_documents(hr_collection_instance, force_ocr_all_pdfs=FORCE_OCR_ALL_PDFS, force_reprocess_all_files=True,
+                                           max_workers=args.workers, embedding_fx=openai_embedding_function)
+            stop_watching = threading.Event()
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop_watching.set())
+            try:
+                watch_and_load_documents(
+                    hr_collection_instance,
+                    force_ocr_all_pdfs=FORCE_OCR_ALL_PDFS,
+                    max_workers=args.workers,
+                    embedding_fx=openai_embedding_function,
+                    poll_seconds=args.poll_seconds,
+                    debounce_seconds=args.debounce_seconds,
+                    stop_event=stop_watching
+                )
+            except KeyboardInterrupt:
+                logger.info("Watch mode interrupted.")
+        else:
+            process_and_load_documents(
+                hr_collection_instance,
+                force_ocr_all_pdfs=FORCE_OCR_ALL_PDFS,
+                force_reprocess_all_files=FORCE_REPROCESS_ALL,
+                max_workers=args.workers,
+                embedding_fx=openai_embedding_function
+            )
         
         logger.info("HR Document Loader script finished successfully.")
     
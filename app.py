@@ -1,9 +1,15 @@
 from flask import Flask, render_template, request, jsonify, session, Response
 from query import HRAssistant # Importar la CLASE HRAssistant
+from embeddings import backend_requires_api_key
+from conversations import get_conversation_store, new_session_id
+from app_common import (
+    ERROR_MESSAGES_NO_QUESTION, ERROR_MESSAGES_NO_API_KEY, ERROR_MESSAGES_GENERATION, ERROR_MESSAGES_NO_API_KEY_TRANSLATE,
+    CONVERSATION_CLEARED_MESSAGES, ASSISTANT_NOT_CONFIGURED_MESSAGE, INVALID_API_KEY_MESSAGE, SSE_DONE,
+    localized, is_api_key_error, sse_token, build_translation_messages, translation_error_message
+)
 import os
 import secrets
 from datetime import timedelta
-import json
 from openai import OpenAI, Timeout # Cliente de OpenAI para traducción y validación de clave API
 from dotenv import load_dotenv # Para cargar archivos .env
 
@@ -24,18 +30,22 @@ app.config.update(
     SESSION_REFRESH_EACH_REQUEST=True # Refrescar la sesión en cada petición
 )
 
+# El historial de la conversación se guarda en el servidor (CONVERSATION_STORE: sqlite o memory), indexado por un
+# identificador de sesión opaco; la cookie solo lleva ese identificador (y la clave API del usuario).
+conversation_store = get_conversation_store()
+
 # --- Inicializar HRAssistant ---
 # MODIFICACIÓN: Esta clave es para ChromaDB y debe ser la misma que usó loader.py
 OPENAI_API_KEY_FOR_CHROMA = os.getenv("OPENAI_API_KEY")
 
 assistant = None
-if not OPENAI_API_KEY_FOR_CHROMA:
-    # Esto ahora es un error crítico para el arranque de la aplicación.
+if not OPENAI_API_KEY_FOR_CHROMA and backend_requires_api_key():
+    # Esto ahora es un error crítico para el arranque de la aplicación (salvo con un backend de embeddings local).
     app.logger.error("CRÍTICO: OPENAI_API_KEY para ChromaDB no encontrada en el entorno. La aplicación no puede arrancar correctamente.")
 else:
     try:
         # MODIFICACIÓN: Pasamos la clave específica para ChromaDB al inicializar.
-        assistant = HRAssistant(chroma_api_key=OPENAI_API_KEY_FOR_CHROMA)
+        assistant = HRAssistant(chroma_api_key=OPENAI_API_KEY_FOR_CHROMA, conversation_store=conversation_store)
     except Exception as e:
         app.logger.error(f"CRÍTICO: Falló la inicialización de HRAssistant. Error: {e}")
 
@@ -43,11 +53,12 @@ else:
 @app.before_request
 def before_request_func():
     """Asegura que las variables de sesión estén inicializadas antes de cada petición."""
-    if 'conversation' not in session:
-        session['conversation'] = []
+    if 'sid' not in session:
+        session['sid'] = new_session_id()
+        session.permanent = True # La cookie dura PERMANENT_SESSION_LIFETIME, igual que la conversación guardada
     if 'openai_api_key' not in session:
         session['openai_api_key'] = None # Explícitamente None si no está establecida
-    session.modified = True # Asegura que los cambios en objetos mutables de la sesión se guarden
+    session.pop('conversation', None) # Cookies anteriores guardaban aquí el historial completo
 
 @app.route('/')
 def home():
@@ -62,61 +73,36 @@ def ask_question_route():
     """
     # MODIFICACIÓN: Si el asistente no se pudo inicializar, retorna un error
     if assistant is None:
-        return jsonify({'error': 'La aplicación no está configurada correctamente. Falta la clave API del servidor.'}), 500
+        return jsonify({'error': ASSISTANT_NOT_CONFIGURED_MESSAGE}), 500
 
     data = request.get_json()
     question_text = data.get('question', '').strip()
     language = data.get('language', 'english')
     api_key_from_session = session.get('openai_api_key')
 
-    # Define error messages for different languages for better UX
-    error_messages_no_question = {
-        'english': "No question provided. Please enter your query.",
-        'spanish': "No se proporcionó ninguna pregunta. Por favor, ingrese su consulta.",
-        'chinese_simplified': "未提供问题。请输入您的问题。(简)",
-        'chinese_traditional': "未提供問題。請輸入您的問題。(繁)"
-    }
-    error_messages_no_api_key = {
-        'english': "API key not configured. Please go to Settings to enter your API key.",
-        'spanish': "Clave API no configurada. Por favor, vaya a Configuración para ingresar su clave API.",
-        'chinese_simplified': "API 密钥未配置。请前往“设置”输入您的 API 密钥。(简)",
-        'chinese_traditional': "API 金鑰未設定。請前往「設定」輸入您的 API 金鑰。(繁)"
-    }
-    error_messages_generation = {
-        'english': "An error occurred while generating the response",
-        'spanish': "Ocurrió un error al generar la respuesta",
-        'chinese_simplified': "生成响应时出错 (简)",
-        'chinese_traditional': "產生回覆時出錯 (繁)"
-    }
-
     if not question_text:
-        error_msg = error_messages_no_question.get(language, error_messages_no_question['english'])
-        return jsonify({'error': error_msg}), 400
+        return jsonify({'error': localized(ERROR_MESSAGES_NO_QUESTION, language)}), 400
     
     if not api_key_from_session:
-        error_msg = error_messages_no_api_key.get(language, error_messages_no_api_key['english'])
-        return jsonify({'error': error_msg}), 401 # 401 Unauthorized
+        return jsonify({'error': localized(ERROR_MESSAGES_NO_API_KEY, language)}), 401 # 401 Unauthorized
 
     try:
-        session['conversation'].append({'role': 'user', 'content': question_text, 'language': language})
-        if len(session['conversation']) > 20:
-            session['conversation'] = session['conversation'][-20:]
-        session.modified = True
+        session_id = session['sid']
+        conversation_history = conversation_store.get(session_id) # Sin la pregunta actual, que va aparte en el prompt
+        user_message = {'role': 'user', 'content': question_text, 'language': language}
         
         # MODIFICACIÓN: Llamamos a ask_question pasando la clave del usuario en el parámetro `chat_api_key`.
+        # El asistente recorta el historial a HISTORY_TOKEN_BUDGET y resume los turnos antiguos (resumen guardado por conversación).
         response_stream = assistant.ask_question(
             question=question_text,
             language=language, 
-            conversation_history=session['conversation'][-4:],
-            chat_api_key=api_key_from_session # El nombre del parámetro cambió
+            conversation_history=conversation_history,
+            chat_api_key=api_key_from_session, # El nombre del parámetro cambió
+            conversation_id=session_id
         )
         
         if isinstance(response_stream, str):
-            api_key_error_substrings = [
-                "api key not provided", "clave api no proporcionada", "api 密钥未提供", "api 金鑰未設定",
-                "api key not configured", "invalid api key"
-            ]
-            if any(sub.lower() in response_stream.lower() for sub in api_key_error_substrings):
+            if is_api_key_error(response_stream):
                  return jsonify({'error': response_stream}), 401
             return jsonify({'error': response_stream}), 500
             
@@ -125,38 +111,32 @@ def ask_question_route():
             try:
                 for token in response_stream:
                     full_response_content += token
-                    yield f"data: {json.dumps({'token': token})}\n\n"
+                    yield sse_token(token)
                 
-                with app.app_context():
-                    session['conversation'].append({
-                        'role': 'assistant', 'content': full_response_content, 'language': language
-                    })
-                    if len(session['conversation']) > 20:
-                        session['conversation'] = session['conversation'][-20:]
-                    session.modified = True
+                # La cookie de sesión ya se envió con los encabezados; el historial se guarda en el servidor.
+                # Pregunta y respuesta se guardan juntas solo si la respuesta terminó: un error o una desconexión
+                # no deja en el historial una pregunta sin respuesta.
+                conversation_store.append(session_id, user_message, {
+                    'role': 'assistant', 'content': full_response_content, 'language': language
+                })
             except GeneratorExit:
                 app.logger.info("El cliente se desconectó durante la transmisión de la respuesta.")
             except Exception as stream_ex:
                 app.logger.error(f"Excepción durante la transmisión de la respuesta: {str(stream_ex)}")
             finally:
-                yield f"data: [DONE]\n\n"
+                yield SSE_DONE
 
         return Response(generate_response_stream(), mimetype='text/event-stream')
         
     except Exception as e:
-        error_msg = error_messages_generation.get(language, error_messages_generation['english'])
+        error_msg = localized(ERROR_MESSAGES_GENERATION, language)
         app.logger.error(f"Error General de API en la ruta /ask para el idioma {language}: {str(e)}", exc_info=True)
         return jsonify({'error': f"{error_msg}: {str(e)}"}), 500
 
 @app.route('/translate', methods=['POST'])
 def translate_text_route():
     """
-<<<<<<< HEAD
     Traduce un texto dado a un idioma objetivo usando OpenAI, transmitiendo la respuesta.
-=======
-    Translate a given text to a target language using OpenAI, streaming the response.
-    The source language can be provided or detected by the AI.
->>>>>>> d3040a4b4227ba28a6e99808c9f67fdb8fd7213a
     """
     data = request.get_json()
     text_to_translate = data.get('text', '').strip()
@@ -167,121 +147,38 @@ def translate_text_route():
     if not text_to_translate:
         return jsonify({'error': 'No text provided for translation.'}), 400
 
-    error_messages_no_api_key_translate = {
-        'english': "API key not configured. Please set it in Settings.",
-        'spanish': "Clave API no configurada. Por favor, configúrela en Ajustes.",
-        'chinese_simplified': "API 密钥未配置。请在“设置”中进行设置。(简)",
-        'chinese_traditional': "API 金鑰未設定。請在「設定」中進行設定。(繁)"
-    }
     if not api_key_from_session:
-        error_msg = error_messages_no_api_key_translate.get(target_language_key, error_messages_no_api_key_translate['english'])
-        return jsonify({'error': error_msg}), 401
+        return jsonify({'error': localized(ERROR_MESSAGES_NO_API_KEY_TRANSLATE, target_language_key)}), 401
 
     try:
-<<<<<<< HEAD
-        translation_client = OpenAI(api_key=api_key_from_session, timeout=Timeout(45.0, connect=5.0))
-=======
-        translation_client = OpenAI(api_key=api_key_from_session)
->>>>>>> d3040a4b4227ba28a6e99808c9f67fdb8fd7213a
-        
-        language_names_for_openai_prompt = {
-            "english": "English", "spanish": "Spanish",
-            "chinese_simplified": "Simplified Chinese", "chinese_traditional": "Traditional Chinese"
-        }
-        
-<<<<<<< HEAD
-        prompt_target_language_name = language_names_for_openai_prompt.get(target_language_key, target_language_key.capitalize())
-        
-        if source_language_key and source_language_key in language_names_for_openai_prompt:
-            prompt_source_language_name = language_names_for_openai_prompt[source_language_key]
-            prompt_content = f"Translate the following text from {prompt_source_language_name} to {prompt_target_language_name}. Preserve all original formatting. Respond ONLY with the translated text itself.\n\nOriginal text:\n{text_to_translate}"
+        if assistant: # Reutiliza el cliente (y sus conexiones) del pool del asistente
+            translation_client = assistant.get_openai_client(api_key_from_session).with_options(timeout=Timeout(45.0, connect=5.0))
         else:
-            prompt_content = f"Detect the language of the following text and then translate it to {prompt_target_language_name}. Preserve all original formatting. Respond ONLY with the translated text itself.\n\nText to translate:\n{text_to_translate}"
-        
+            translation_client = OpenAI(api_key=api_key_from_session, timeout=Timeout(45.0, connect=5.0))
+
         response_stream = translation_client.chat.completions.create(
             model=assistant.OPENAI_CHAT_MODEL if assistant else "gpt-4.1-mini-2025-04-14",
-=======
-        prompt_target_language_name = language_names_for_openai_prompt.get(
-            target_language_key, target_language_key.capitalize()
-        )
-        
-        if source_language_key and source_language_key in language_names_for_openai_prompt:
-            prompt_source_language_name = language_names_for_openai_prompt[source_language_key]
-            prompt_content = (
-                f"Translate the following text from {prompt_source_language_name} to {prompt_target_language_name}. "
-                f"Preserve all original formatting, including markdown, HTML tags, lists, newlines, and special characters. "
-                f"Respond ONLY with the translated text itself, without any surrounding text, explanations, or conversational remarks.\n\n"
-                f"Original text:\n{text_to_translate}"
-            )
-        else:
-            prompt_content = (
-                f"Detect the language of the following text and then translate it to {prompt_target_language_name}. "
-                f"Preserve all original formatting, including markdown, HTML tags, lists, newlines, and special characters. "
-                f"Respond ONLY with the translated text itself, without any surrounding text, explanations, or conversational remarks.\n\n"
-                f"Text to translate:\n{text_to_translate}"
-            )
-        
-        # The key change is to add stream=True
-        response_stream = translation_client.chat.completions.create(
-            model=assistant.OPENAI_CHAT_MODEL,
->>>>>>> d3040a4b4227ba28a6e99808c9f67fdb8fd7213a
-            messages=[
-                {"role": "system", "content": "You are a highly proficient multilingual translator. Your task is to translate text accurately, maintaining all original formatting. Respond only with the translation itself."},
-                {"role": "user", "content": prompt_content}
-            ],
-<<<<<<< HEAD
+            messages=build_translation_messages(text_to_translate, target_language_key, source_language_key),
             temperature=0.1, max_tokens=3500, stream=True
         )
 
         def generate_translation_stream():
             """Función generadora para transmitir la respuesta de traducción."""
-=======
-            temperature=0.1,
-            max_tokens=3500,
-            stream=True  # Enable streaming
-        )
-
-        def generate_translation_stream():
-            """Generator function to stream the translation response."""
->>>>>>> d3040a4b4227ba28a6e99808c9f67fdb8fd7213a
             try:
                 for chunk in response_stream:
                     if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
                         token = chunk.choices[0].delta.content
-<<<<<<< HEAD
-                        yield f"data: {json.dumps({'token': token})}\n\n"
+                        yield sse_token(token)
             except Exception as stream_ex:
                 app.logger.error(f"Excepción durante la transmisión de la traducción: {str(stream_ex)}")
             finally:
-                yield f"data: [DONE]\n\n"
+                yield SSE_DONE
 
         return Response(generate_translation_stream(), mimetype='text/event-stream')
 
     except Exception as e:
         app.logger.error(f"Error de API de Traducción: {str(e)}", exc_info=True)
-        error_msg_server = f"Translation error: {str(e)}"
-        if "authentication" in str(e).lower() or "api key" in str(e).lower():
-             error_msg_server = "La traducción falló debido a una clave API inválida o un problema de autenticación."
-=======
-                        # Yield each token in the Server-Sent Events (SSE) format
-                        yield f"data: {json.dumps({'token': token})}\n\n"
-            except Exception as stream_ex:
-                app.logger.error(f"Exception during translation streaming: {str(stream_ex)}")
-            finally:
-                # Signal the end of the stream to the client
-                yield f"data: [DONE]\n\n"
-
-        # Return a streaming response
-        return Response(generate_translation_stream(), mimetype='text/event-stream')
-
-    except Exception as e:
-        app.logger.error(f"Translation API Error: {str(e)}", exc_info=True)
-        error_msg_server = f"Translation error: {str(e)}"
-        if "authentication" in str(e).lower() or "api key" in str(e).lower():
-             error_msg_server = "Translation failed due to an invalid API key or authentication issue. Please check your API key in Settings."
-        # This error will now be caught by the frontend's `.catch()` block
->>>>>>> d3040a4b4227ba28a6e99808c9f67fdb8fd7213a
-        return jsonify({'error': error_msg_server}), 500
+        return jsonify({'error': translation_error_message(e)}), 500
 
 
 @app.route('/set_api_key', methods=['POST'])
@@ -295,8 +192,11 @@ def set_api_key_route():
     
     try:
         if api_key_value:
-            test_client = OpenAI(api_key=api_key_value, timeout=Timeout(15.0, connect=5.0))
-            test_client.models.list()
+            if assistant: # Las claves ya validadas no se vuelven a comprobar durante API_KEY_VALIDATION_TTL_SECONDS
+                assistant.validate_api_key(api_key_value)
+            else:
+                test_client = OpenAI(api_key=api_key_value, timeout=Timeout(15.0, connect=5.0))
+                test_client.models.list()
             
             session['openai_api_key'] = api_key_value
             session.modified = True
@@ -308,24 +208,29 @@ def set_api_key_route():
     except Exception as e: 
         session.pop('openai_api_key', None)
         session.modified = True
-        error_msg_server = "The provided API key is invalid. Please check your key and try again."
         app.logger.error(f"API Key Validation Error: {str(e)}", exc_info=True)
-        return jsonify({'error': error_msg_server}), 400
+        return jsonify({'error': INVALID_API_KEY_MESSAGE}), 400
+
+@app.route('/stats', methods=['GET'])
+def stats_route():
+    """
+    Estado del índice de documentos: versión (cambia cada vez que loader.py, p. ej. en modo --watch,
+    modifica la colección), estadísticas de la última carga y si el proceso de vigilancia está activo;
+    además, las estadísticas de las cachés del asistente (aciertos y latencia ahorrada) y de sus
+    pools de clientes (tamaño y reutilización) y del índice léxico (BM25) usado en la búsqueda híbrida,
+    y del almacén de conversaciones.
+    """
+    if assistant is None:
+        return jsonify({'error': ASSISTANT_NOT_CONFIGURED_MESSAGE}), 500
+    return jsonify({'index': assistant.get_index_state(), 'caches': assistant.get_cache_stats(), 'pools': assistant.get_pool_stats(),
+                    'retrieval': assistant.get_retrieval_stats(), 'conversations': conversation_store.stats()})
 
 @app.route('/clear', methods=['POST'])
 def clear_conversation_route():
     """Limpia el historial de la conversación de la sesión."""
-    session['conversation'] = []
-    session.modified = True
+    conversation_store.clear(session['sid'])
     language = request.json.get('language', 'english') if request.is_json else 'english'
-    
-    message_map = {
-        'english': 'Conversation history has been cleared.',
-        'spanish': 'El historial de la conversación ha sido reiniciado.',
-        'chinese_simplified': '对话历史已清除。(简)',
-        'chinese_traditional': '對話歷史已清除。(繁)'
-    }
-    response_message = message_map.get(language, message_map['english'])
+    response_message = localized(CONVERSATION_CLEARED_MESSAGES, language)
     return jsonify({'status': 'success', 'message': response_message})
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+"""
+Mensajes, prompts de traducción y formato SSE compartidos por los dos servidores web:
+app.py (Flask, WSGI) y asgi_app.py (Starlette, ASGI). Ambos deben responder igual a static/script.js.
+"""
+import json
+from typing import Dict, List, Optional
+
+ERROR_MESSAGES_NO_QUESTION = {
+    'english': "No question provided. Please enter your query.",
+    'spanish': "No se proporcionó ninguna pregunta. Por favor, ingrese su consulta.",
+    'chinese_simplified': "未提供问题。请输入您的问题。(简)",
+    'chinese_traditional': "未提供問題。請輸入您的問題。(繁)"
+}
+ERROR_MESSAGES_NO_API_KEY = {
+    'english': "API key not configured. Please go to Settings to enter your API key.",
+    'spanish': "Clave API no configurada. Por favor, vaya a Configuración para ingresar su clave API.",
+    'chinese_simplified': "API 密钥未配置。请前往“设置”输入您的 API 密钥。(简)",
+    'chinese_traditional': "API 金鑰未設定。請前往「設定」輸入您的 API 金鑰。(繁)"
+}
+ERROR_MESSAGES_GENERATION = {
+    'english': "An error occurred while generating the response",
+    'spanish': "Ocurrió un error al generar la respuesta",
+    'chinese_simplified': "生成响应时出错 (简)",
+    'chinese_traditional': "產生回覆時出錯 (繁)"
+}
+ERROR_MESSAGES_NO_API_KEY_TRANSLATE = {
+    'english': "API key not configured. Please set it in Settings.",
+    'spanish': "Clave API no configurada. Por favor, configúrela en Ajustes.",
+    'chinese_simplified': "API 密钥未配置。请在“设置”中进行设置。(简)",
+    'chinese_traditional': "API 金鑰未設定。請在「設定」中進行設定。(繁)"
+}
+CONVERSATION_CLEARED_MESSAGES = {
+    'english': 'Conversation history has been cleared.',
+    'spanish': 'El historial de la conversación ha sido reiniciado.',
+    'chinese_simplified': '对话历史已清除。(简)',
+    'chinese_traditional': '對話歷史已清除。(繁)'
+}
+ASSISTANT_NOT_CONFIGURED_MESSAGE = 'La aplicación no está configurada correctamente. Falta la clave API del servidor.'
+INVALID_API_KEY_MESSAGE = "The provided API key is invalid. Please check your key and try again."
+TRANSLATION_AUTH_ERROR_MESSAGE = "La traducción falló debido a una clave API inválida o un problema de autenticación."
+
+# Fragmentos de los mensajes de error de HRAssistant que indican un problema con la clave API (respuesta 401)
+_API_KEY_ERROR_SUBSTRINGS = [
+    "api key not provided", "clave api no proporcionada", "api 密钥未提供", "api 金鑰未設定",
+    "api key not configured", "invalid api key"
+]
+LANGUAGE_NAMES_FOR_OPENAI_PROMPT = {
+    "english": "English", "spanish": "Spanish",
+    "chinese_simplified": "Simplified Chinese", "chinese_traditional": "Traditional Chinese"
+}
+TRANSLATION_SYSTEM_PROMPT = "You are a highly proficient multilingual translator. Your task is to translate text accurately, maintaining all original formatting. Respond only with the translation itself."
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def localized(messages: Dict[str, str], language: str) -> str:
+    return messages.get(language, messages['english'])
+
+
+def is_api_key_error(message: str) -> bool:
+    return any(sub.lower() in message.lower() for sub in _API_KEY_ERROR_SUBSTRINGS)
+
+
+def sse_token(token: str) -> str:
+    return f"data: {json.dumps({'token': token})}\n\n"
+
+
+def build_translation_messages(text_to_translate: str, target_language_key: str, source_language_key: Optional[str]) -> List[Dict[str, str]]:
+    """Mensajes para el modelo de chat que traduce un texto (con o sin idioma de origen conocido)."""
+    prompt_target_language_name = LANGUAGE_NAMES_FOR_OPENAI_PROMPT.get(target_language_key, target_language_key.capitalize())
+
+    if source_language_key and source_language_key in LANGUAGE_NAMES_FOR_OPENAI_PROMPT:
+        prompt_source_language_name = LANGUAGE_NAMES_FOR_OPENAI_PROMPT[source_language_key]
+        prompt_content = f"Translate the following text from {prompt_source_language_name} to {prompt_target_language_name}. Preserve all original formatting. Respond ONLY with the translated text itself.\n\nOriginal text:\n{text_to_translate}"
+    else:
+        prompt_content = f"Detect the language of the following text and then translate it to {prompt_target_language_name}. Preserve all original formatting. Respond ONLY with the translated text itself.\n\nText to translate:\n{text_to_translate}"
+    return [
+        {"role": "system", "content": TRANSLATION_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt_content}
+    ]
+
+
+def translation_error_message(e: Exception) -> str:
+    if "authentication" in str(e).lower() or "api key" in str(e).lower():
+        return TRANSLATION_AUTH_ERROR_MESSAGE
+    return f"Translation error: {str(e)}"
@@ -0,0 +1,287 @@
+"""
+Modo asíncrono (ASGI) de la aplicación web: mismas rutas, sesión y formato SSE que app.py, servido con
+Starlette y uvicorn:
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 4
+
+En app.py cada respuesta en streaming ocupa un hilo del servidor durante toda la generación (20-30 s); con
+muchos usuarios a la vez (cambios de turno) se agotan los hilos. Aquí las respuestas de /ask y /translate se
+transmiten con AsyncOpenAI sin ocupar un hilo, y solo la recuperación (embeddings, ChromaDB, resumen del
+historial) se ejecuta en un pool de hilos acotado (ASGI_RETRIEVAL_WORKERS), para que no se lancen más
+consultas a ChromaDB de las que puede atender.
+
+La cookie de sesión tiene el mismo contenido que en app.py (identificador de sesión y clave API del usuario),
+pero el formato de firma de Starlette es distinto: al cambiar de servidor los usuarios vuelven a introducir su
+clave. El historial está en el mismo almacén (CONVERSATION_STORE), así que se conserva.
+"""
+import os
+import asyncio
+import secrets
+import logging
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
+try:
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.sessions import SessionMiddleware
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Mount, Route
+    from starlette.staticfiles import StaticFiles
+    from starlette.templating import Jinja2Templates
+except ImportError as e:
+    raise ImportError("El modo ASGI necesita starlette y uvicorn: pip install starlette uvicorn (o use app.py con Flask).") from e
+from openai import AsyncOpenAI, Timeout
+from dotenv import load_dotenv
+
+from query import HRAssistant
+from embeddings import backend_requires_api_key
+from conversations import get_conversation_store, new_session_id
+from app_common import (
+    ERROR_MESSAGES_NO_QUESTION, ERROR_MESSAGES_NO_API_KEY, ERROR_MESSAGES_GENERATION, ERROR_MESSAGES_NO_API_KEY_TRANSLATE,
+    CONVERSATION_CLEARED_MESSAGES, ASSISTANT_NOT_CONFIGURED_MESSAGE, INVALID_API_KEY_MESSAGE, SSE_DONE,
+    localized, is_api_key_error, sse_token, build_translation_messages, translation_error_message
+)
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent
+ASGI_RETRIEVAL_WORKERS = int(os.getenv("ASGI_RETRIEVAL_WORKERS", 8)) # Preguntas en fase de recuperación a la vez, por proceso
+SESSION_LIFETIME = timedelta(weeks=1) # Igual que PERMANENT_SESSION_LIFETIME en app.py
+TRANSLATION_TIMEOUT = Timeout(45.0, connect=5.0)
+
+retrieval_executor = ThreadPoolExecutor(max_workers=ASGI_RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+conversation_store = get_conversation_store()
+templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+
+# --- Inicializar HRAssistant (igual que en app.py) ---
+OPENAI_API_KEY_FOR_CHROMA = os.getenv("OPENAI_API_KEY")
+
+assistant = None
+if not OPENAI_API_KEY_FOR_CHROMA and backend_requires_api_key():
+    logger.error("CRÍTICO: OPENAI_API_KEY para ChromaDB no encontrada en el entorno. La aplicación no puede arrancar correctamente.")
+else:
+    try:
+        assistant = HRAssistant(chroma_api_key=OPENAI_API_KEY_FOR_CHROMA, conversation_store=conversation_store)
+    except Exception as e:
+        logger.error(f"CRÍTICO: Falló la inicialización de HRAssistant. Error: {e}")
+
+
+def _session(request: Request) -> dict:
+    """La sesión de la petición, con las mismas variables inicializadas que before_request_func en app.py."""
+    session = request.session
+    if 'sid' not in session:
+        session['sid'] = new_session_id()
+    if 'openai_api_key' not in session:
+        session['openai_api_key'] = None
+    session.pop('conversation', None)
+    return session
+
+
+async def _in_executor(func, *args):
+    """Ejecuta una llamada bloqueante (p. ej. el almacén de conversaciones en SQLite) en el pool de recuperación, fuera del bucle de eventos."""
+    return await asyncio.get_running_loop().run_in_executor(retrieval_executor, func, *args)
+
+
+async def _json_body(request: Request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def home(request: Request):
+    """Renderiza la página HTML principal para el Asistente de RH."""
+    _session(request)
+    # index.html usa url_for('static', filename=...) de Flask
+    return templates.TemplateResponse(request, "index.html", {"url_for": lambda endpoint, filename: f"/static/{filename}"})
+
+
+async def ask_question_route(request: Request):
+    """Como /ask en app.py: la respuesta se transmite con AsyncOpenAI; la recuperación va al pool acotado."""
+    session = _session(request)
+    if assistant is None:
+        return JSONResponse({'error': ASSISTANT_NOT_CONFIGURED_MESSAGE}, status_code=500)
+
+    data = await _json_body(request)
+    question_text = data.get('question', '').strip()
+    language = data.get('language', 'english')
+    api_key_from_session = session.get('openai_api_key')
+
+    if not question_text:
+        return JSONResponse({'error': localized(ERROR_MESSAGES_NO_QUESTION, language)}, status_code=400)
+    if not api_key_from_session:
+        return JSONResponse({'error': localized(ERROR_MESSAGES_NO_API_KEY, language)}, status_code=401)
+
+    try:
+        # El almacén de conversaciones puede ser SQLite (disco, bloqueo entre procesos): nunca en el bucle de eventos
+        session_id = session['sid']
+        conversation_history = await _in_executor(conversation_store.get, session_id)
+        user_message = {'role': 'user', 'content': question_text, 'language': language}
+
+        response_stream = await assistant.ask_question_async(
+            question=question_text,
+            language=language,
+            conversation_history=conversation_history,
+            chat_api_key=api_key_from_session,
+            conversation_id=session_id,
+            executor=retrieval_executor
+        )
+
+        if isinstance(response_stream, str):
+            return JSONResponse({'error': response_stream}, status_code=401 if is_api_key_error(response_stream) else 500)
+
+        async def generate_response_stream():
+            full_response_content = ""
+            try:
+                async for token in response_stream:
+                    full_response_content += token
+                    yield sse_token(token)
+                # Pregunta y respuesta juntas, solo con la respuesta completa (como en app.py)
+                await _in_executor(conversation_store.append, session_id, user_message,
+                                   {'role': 'assistant', 'content': full_response_content, 'language': language})
+            except (asyncio.CancelledError, GeneratorExit):
+                logger.info("El cliente se desconectó durante la transmisión de la respuesta.")
+                await response_stream.aclose() # Cierra también la respuesta de OpenAI (deja de generar)
+                raise
+            except Exception as stream_ex:
+                logger.error(f"Excepción durante la transmisión de la respuesta: {str(stream_ex)}")
+            yield SSE_DONE
+
+        return StreamingResponse(generate_response_stream(), media_type='text/event-stream')
+
+    except Exception as e:
+        error_msg = localized(ERROR_MESSAGES_GENERATION, language)
+        logger.error(f"Error General de API en la ruta /ask para el idioma {language}: {str(e)}", exc_info=True)
+        return JSONResponse({'error': f"{error_msg}: {str(e)}"}, status_code=500)
+
+
+async def translate_text_route(request: Request):
+    """Como /translate en app.py, con un cliente AsyncOpenAI."""
+    session = _session(request)
+    data = await _json_body(request)
+    text_to_translate = data.get('text', '').strip()
+    target_language_key = data.get('target_language', 'english')
+    source_language_key = data.get('source_language')
+    api_key_from_session = session.get('openai_api_key')
+
+    if not text_to_translate:
+        return JSONResponse({'error': 'No text provided for translation.'}, status_code=400)
+    if not api_key_from_session:
+        return JSONResponse({'error': localized(ERROR_MESSAGES_NO_API_KEY_TRANSLATE, target_language_key)}, status_code=401)
+
+    try:
+        if assistant: # Reutiliza el cliente (y sus conexiones) del pool del asistente
+            translation_client = assistant.get_async_openai_client(api_key_from_session).with_options(timeout=TRANSLATION_TIMEOUT)
+        else:
+            translation_client = AsyncOpenAI(api_key=api_key_from_session, timeout=TRANSLATION_TIMEOUT)
+
+        response_stream = await translation_client.chat.completions.create(
+            model=assistant.OPENAI_CHAT_MODEL if assistant else "gpt-4.1-mini-2025-04-14",
+            messages=build_translation_messages(text_to_translate, target_language_key, source_language_key),
+            temperature=0.1, max_tokens=3500, stream=True
+        )
+
+        async def generate_translation_stream():
+            try:
+                async for chunk in response_stream:
+                    if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                        yield sse_token(chunk.choices[0].delta.content)
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception as stream_ex:
+                logger.error(f"Excepción durante la transmisión de la traducción: {str(stream_ex)}")
+            finally:
+                await response_stream.close()
+            yield SSE_DONE
+
+        return StreamingResponse(generate_translation_stream(), media_type='text/event-stream')
+
+    except Exception as e:
+        logger.error(f"Error de API de Traducción: {str(e)}", exc_info=True)
+        return JSONResponse({'error': translation_error_message(e)}, status_code=500)
+
+
+async def set_api_key_route(request: Request):
+    """Como /set_api_key en app.py; la validación (llamada HTTP bloqueante) se ejecuta en un hilo."""
+    session = _session(request)
+    data = await _json_body(request)
+    api_key_value = data.get('api_key', '').strip()
+
+    try:
+        if api_key_value:
+            if assistant: # Las claves ya validadas no se vuelven a comprobar durante API_KEY_VALIDATION_TTL_SECONDS
+                await asyncio.get_running_loop().run_in_executor(None, assistant.validate_api_key, api_key_value)
+            else:
+                await AsyncOpenAI(api_key=api_key_value, timeout=Timeout(15.0, connect=5.0)).models.list()
+            session['openai_api_key'] = api_key_value
+            return JSONResponse({'status': 'success', 'message': 'API key validated and stored successfully.'})
+        session.pop('openai_api_key', None)
+        return JSONResponse({'status': 'success', 'message': 'API key cleared successfully.'})
+    except Exception as e:
+        session.pop('openai_api_key', None)
+        logger.error(f"API Key Validation Error: {str(e)}", exc_info=True)
+        return JSONResponse({'error': INVALID_API_KEY_MESSAGE}, status_code=400)
+
+
+async def stats_route(request: Request):
+    """Como /stats en app.py, más el tamaño del pool de recuperación."""
+    if assistant is None:
+        return JSONResponse({'error': ASSISTANT_NOT_CONFIGURED_MESSAGE}, status_code=500)
+
+    def collect():
+        return {'index': assistant.get_index_state(), 'caches': assistant.get_cache_stats(), 'pools': assistant.get_pool_stats(),
+                'retrieval': assistant.get_retrieval_stats(), 'conversations': conversation_store.stats(),
+                'server': {'mode': 'asgi', 'retrieval_workers': ASGI_RETRIEVAL_WORKERS}}
+    return JSONResponse(await asyncio.get_running_loop().run_in_executor(None, collect))
+
+
+async def clear_conversation_route(request: Request):
+    """Limpia el historial de la conversación de la sesión."""
+    session = _session(request)
+    await _in_executor(conversation_store.clear, session['sid'])
+    data = await _json_body(request)
+    language = data.get('language', 'english')
+    return JSONResponse({'status': 'success', 'message': localized(CONVERSATION_CLEARED_MESSAGES, language)})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    retrieval_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route('/', home),
+        Route('/ask', ask_question_route, methods=['POST']),
+        Route('/translate', translate_text_route, methods=['POST']),
+        Route('/set_api_key', set_api_key_route, methods=['POST']),
+        Route('/stats', stats_route, methods=['GET']),
+        Route('/clear', clear_conversation_route, methods=['POST']),
+        Mount('/static', app=StaticFiles(directory=str(BASE_DIR / "static")), name='static'),
+    ],
+    middleware=[
+        Middleware(
+            SessionMiddleware,
+            secret_key=os.getenv("FLASK_SECRET_KEY", secrets.token_hex(32)), # La misma variable que app.py
+            max_age=int(SESSION_LIFETIME.total_seconds()),
+            same_site='lax',
+            https_only=os.getenv("FLASK_ENV", "development") == "production"
+        )
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    host = os.getenv("FLASK_HOST", "0.0.0.0")
+    port = int(os.getenv("FLASK_PORT", 8000))
+    logger.info(f"Iniciando aplicación ASGI en http://127.0.0.1:{port}")
+    uvicorn.run(app, host=host, port=port)
@@ -0,0 +1,184 @@
+"""
+Microbenchmark for Loader.split_text_into_chunks and Loader.clean_text.
+
+Compares the current chunker (one tokenization per paragraph, incremental totals) with the
+previous implementation, which re-joined and re-tokenized the candidate chunk for every
+paragraph and split oversized chunks with the recursive decode/re-encode splitter. A second table
+compares that splitter with Loader.split_text_by_tokens on its own (first --splitter-mb of each
+document, as one oversized text). A third table runs clean_text + chunking end to end and compares the old
+whitespace-flattening clean_text with the structure-preserving one (chunk counts and time).
+Runs on the PDFs in HR/ and on a synthetic ~10 MB document.
+
+Usage: python benchmarks/bench_chunking.py [--synthetic-mb 10] [--splitter-mb 1] [--repeat 3]
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import Loader  # noqa: E402
+
+
+def legacy_split_chunk_by_tokens_recursive(text: str, max_tokens: int) -> List[str]:
+    """Loader's token splitter before the single-encode offset map: a decode and re-encode per window."""
+    tokenizer = Loader.tokenizer
+    if Loader.count_tokens(text) <= max_tokens:
+        return [text]
+    tokens = tokenizer.encode(text)
+    sub_chunks: List[str] = []
+    current_pos = 0
+    while current_pos < len(tokens):
+        end_pos = min(current_pos + max_tokens, len(tokens))
+        if end_pos < len(tokens):
+            temp_decode_for_break = tokenizer.decode(tokens[current_pos:end_pos])
+            last_sentence_end = -1
+            for marker in ['. ', '! ', '? ', '\n\n']:
+                idx = temp_decode_for_break.rfind(marker)
+                if idx > last_sentence_end:
+                    last_sentence_end = idx + len(marker)
+            if last_sentence_end > len(temp_decode_for_break) / 2:
+                adjusted_segment_tokens = tokenizer.encode(temp_decode_for_break[:last_sentence_end])
+                end_pos = current_pos + len(adjusted_segment_tokens)
+        decoded_chunk = tokenizer.decode(tokens[current_pos:end_pos])
+        if decoded_chunk.strip():
+            sub_chunks.append(decoded_chunk)
+        current_pos = end_pos
+    return sub_chunks
+
+
+def legacy_split_text_into_chunks(text: str, file_name: str) -> List[str]:
+    """The chunker as it was before incremental token accounting, kept as the baseline."""
+    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
+    chunks: List[str] = []
+    current_chunk_texts: List[str] = []
+    current_char_count = 0
+    for para in paragraphs:
+        para_char_count = len(para)
+        would_exceed_char_size = current_char_count + para_char_count + (len(current_chunk_texts) * 2) > Loader.TARGET_CHUNK_CHAR_SIZE
+        candidate_chunk_text = "\n\n".join(current_chunk_texts + [para]) if current_chunk_texts else para
+        would_exceed_token_limit = Loader.count_tokens(candidate_chunk_text) > Loader.MAX_TOKENS_PER_CHUNK
+        if current_chunk_texts and (would_exceed_char_size or would_exceed_token_limit):
+            final_chunk_text = "\n\n".join(current_chunk_texts)
+            if Loader.count_tokens(final_chunk_text) > Loader.MAX_TOKENS_PER_CHUNK:
+                chunks.extend(legacy_split_chunk_by_tokens_recursive(final_chunk_text, Loader.MAX_TOKENS_PER_CHUNK))
+            else:
+                chunks.append(final_chunk_text)
+            overlap_text = final_chunk_text[-Loader.CHUNK_CHAR_OVERLAP:]
+            last_para_break = overlap_text.rfind("\n\n")
+            if last_para_break != -1 and len(overlap_text[last_para_break:].strip()) > 50:
+                current_chunk_texts = [overlap_text[last_para_break:].strip(), para]
+            else:
+                current_chunk_texts = [para]
+            current_char_count = sum(len(p) + 2 for p in current_chunk_texts) - 2
+        elif would_exceed_token_limit and not current_chunk_texts:
+            chunks.extend(legacy_split_chunk_by_tokens_recursive(para, Loader.MAX_TOKENS_PER_CHUNK))
+            current_chunk_texts, current_char_count = [], 0
+        else:
+            current_chunk_texts.append(para)
+            current_char_count += para_char_count + 2
+    if current_chunk_texts:
+        final_chunk_text = "\n\n".join(current_chunk_texts)
+        if Loader.count_tokens(final_chunk_text) > Loader.MAX_TOKENS_PER_CHUNK:
+            chunks.extend(legacy_split_chunk_by_tokens_recursive(final_chunk_text, Loader.MAX_TOKENS_PER_CHUNK))
+        else:
+            chunks.append(final_chunk_text)
+    # The old metadata step tokenized every chunk once more for chunk_token_count.
+    for chunk_text in chunks:
+        Loader.count_tokens(chunk_text)
+    return chunks
+
+
+def legacy_clean_text(text: str) -> str:
+    """clean_text before it kept line and paragraph breaks: every whitespace run became one space."""
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\n\s*\n', '\n\n', text)
+    return text.strip()
+
+
+def current_split_text_into_chunks(text: str, file_name: str) -> List[str]:
+    # Token counts come back with the chunks, so there is no metadata re-tokenization to add here.
+    return [chunk_text for chunk_text, _ in Loader.split_text_into_chunks_with_tokens(text, file_name)]
+
+
+def synthetic_document(target_mb: float, seed: int = 7) -> str:
+    rng = random.Random(seed)
+    words = ("trabajador empresa sindicato salario jornada vacaciones aguinaldo cláusula artículo "
+             "prestaciones contrato colectivo días descanso obligatorio prima dominical antigüedad "
+             "bono puntualidad asistencia reglamento interior sanción suspensión goce sueldo").split()
+    paragraphs, size, clause = [], 0, 1
+    while size < target_mb * 1024 * 1024:
+        if rng.random() < 0.1:
+            paragraph = f"ARTÍCULO {clause}.-"
+            clause += 1
+        else:
+            sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(8, 30))).capitalize() + "."
+                         for _ in range(rng.randint(1, 6))]
+            paragraph = " ".join(sentences)
+        if rng.random() < 0.3:
+            # Wrap like extracted PDF text: single line breaks and ragged spacing inside the paragraph.
+            paragraph = re.sub(r'(\S+ \S+ \S+ \S+ \S+ \S+ \S+ \S+) ', lambda m: m.group(1) + "  \n", paragraph)
+        paragraphs.append(paragraph)
+        size += len(paragraph.encode("utf-8")) + 2
+    return "\n\n".join(paragraphs)
+
+
+def best_time(fn: Callable[[str, str], List[str]], text: str, name: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text, name)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic-mb", type=float, default=10.0)
+    parser.add_argument("--splitter-mb", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    Loader.logger.setLevel("WARNING")
+    documents = []
+    for pdf_path in sorted(Loader.HR_DOCS_DIR.glob("*.pdf")):
+        # Chunk the extracted text directly so the benchmark measures the chunker, not extraction.
+        documents.append((pdf_path.name, Loader.extract_text_from_pdf_with_ocr(pdf_path)))
+    documents.append((f"synthetic-{args.synthetic_mb:g}MB", synthetic_document(args.synthetic_mb)))
+
+    print(f"{'document':<40} {'chars':>10} {'chunks':>7} {'legacy s':>10} {'current s':>10} {'speedup':>8}")
+    for name, text in documents:
+        repeat = 1 if len(text) > 1_000_000 else args.repeat
+        legacy_seconds = best_time(legacy_split_text_into_chunks, text, name, repeat)
+        current_seconds = best_time(current_split_text_into_chunks, text, name, repeat)
+        chunk_count = len(current_split_text_into_chunks(text, name))
+        print(f"{name:<40} {len(text):>10} {chunk_count:>7} {legacy_seconds:>10.3f} {current_seconds:>10.3f} {legacy_seconds / current_seconds:>7.1f}x")
+
+    print()
+    print(f"{'token splitter':<40} {'chars':>10} {'pieces':>7} {'legacy s':>10} {'current s':>10} {'speedup':>8}")
+    for name, text in documents:
+        text = text[:int(args.splitter_mb * 1024 * 1024)]
+        legacy_seconds = best_time(lambda t, n: legacy_split_chunk_by_tokens_recursive(t, Loader.MAX_TOKENS_PER_CHUNK), text, name, args.repeat)
+        current_seconds = best_time(lambda t, n: Loader.split_text_by_tokens(t, Loader.MAX_TOKENS_PER_CHUNK), text, name, args.repeat)
+        piece_count = len(Loader.split_text_by_tokens(text, Loader.MAX_TOKENS_PER_CHUNK))
+        print(f"{name:<40} {len(text):>10} {piece_count:>7} {legacy_seconds:>10.3f} {current_seconds:>10.3f} {legacy_seconds / current_seconds:>7.1f}x")
+
+    print()
+    print(f"{'clean + chunk':<40} {'legacy chunks':>13} {'chunks':>7} {'paragraphs':>10} {'legacy s':>10} {'current s':>10}")
+    for name, text in documents:
+        repeat = 1 if len(text) > 1_000_000 else args.repeat
+        legacy_clean_chunk = lambda t, n: current_split_text_into_chunks(legacy_clean_text(t), n)
+        current_clean_chunk = lambda t, n: current_split_text_into_chunks(Loader.clean_text(t), n)
+        legacy_seconds = best_time(legacy_clean_chunk, text, name, repeat)
+        current_seconds = best_time(current_clean_chunk, text, name, repeat)
+        cleaned = Loader.clean_text(text)
+        paragraph_count = sum(1 for p in cleaned.split("\n\n") if p.strip())
+        print(f"{name:<40} {len(legacy_clean_chunk(text, name)):>13} {len(current_split_text_into_chunks(cleaned, name)):>7} "
+              f"{paragraph_count:>10} {legacy_seconds:>10.3f} {current_seconds:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
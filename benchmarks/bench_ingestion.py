@@ -0,0 +1,264 @@
+"""
+Ingestion throughput benchmark for Loader.process_and_load_documents, fully offline.
+
+Generates synthetic DOCX files, digital PDFs (real text layer) and scanned-style PDFs (page images
+only, so every page goes through OCR) at several page counts, then loads each set into a throwaway
+ChromaDB collection with a deterministic local embedding function instead of OpenAIEmbeddingFunction.
+Each scenario runs in its own subprocess so its peak RSS is not mixed with the others'.
+
+Reports pages/sec, chunks/sec, seconds per stage (extract, ocr, clean, chunk, embed, write; summed
+across worker processes and threads) and peak RSS as JSON, so runs can be compared for regressions.
+The extraction cache is disabled; scanned PDFs are skipped when Tesseract or Poppler is not installed.
+
+Usage: python benchmarks/bench_ingestion.py [--kinds docx,digital-pdf,scanned-pdf] [--pages 5,25,100]
+                                            [--files 4] [--workers N] [--embed-latency-ms 0] [--output results.json]
+"""
+import argparse
+import functools
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+os.environ.setdefault("LOADER_EXTRACTION_CACHE", "false") # Measure extraction, not cache hits (also applies to worker processes)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import Loader  # noqa: E402
+
+KINDS = ("docx", "digital-pdf", "scanned-pdf")
+STAGES = ("extract", "ocr", "clean", "chunk", "embed", "write")
+LINES_PER_PAGE = 45
+WORDS = ("trabajador empresa sindicato salario jornada vacaciones aguinaldo cláusula artículo "
+         "prestaciones contrato colectivo días descanso obligatorio prima dominical antigüedad "
+         "bono puntualidad asistencia reglamento interior sanción suspensión goce sueldo").split()
+
+
+class HashingEmbeddingFunction:
+    """
+    Deterministic offline stand-in for OpenAIEmbeddingFunction: signed feature hashing of the words,
+    L2-normalized. latency_ms adds a fixed delay per request to mimic the network round trip.
+    """
+    def __init__(self, dimensions: int = 256, latency_ms: float = 0.0):
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+
+    @functools.lru_cache(maxsize=65536)
+    def _feature(self, word: str) -> int:
+        return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        embeddings = []
+        for text in input:
+            vector = [0.0] * self.dimensions
+            for word in re.findall(r"\w+", text.lower()):
+                feature = self._feature(word)
+                vector[feature % self.dimensions] += 1.0 if feature >> 63 else -1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            embeddings.append([value / norm for value in vector])
+        return embeddings
+
+
+# --- Synthetic documents ---
+def synthetic_pages(page_count: int, seed: int) -> List[List[str]]:
+    """page_count pages of LINES_PER_PAGE lines: ARTÍCULO headings followed by paragraphs of wrapped prose."""
+    rng = random.Random(seed)
+    pages, lines, article = [], [], 1
+    while len(pages) < page_count:
+        if rng.random() < 0.15:
+            lines.append(f"ARTÍCULO {article}.")
+            article += 1
+        words = [rng.choice(WORDS) for _ in range(rng.randint(30, 120))]
+        words[0] = words[0].capitalize()
+        for start in range(0, len(words), 12):
+            lines.append(" ".join(words[start:start + 12]) + ("." if start + 12 >= len(words) else ""))
+        lines.append("")
+        while len(lines) >= LINES_PER_PAGE and len(pages) < page_count:
+            pages.append(lines[:LINES_PER_PAGE])
+            lines = lines[LINES_PER_PAGE:]
+    return pages
+
+
+def write_docx(path: Path, pages: List[List[str]]) -> None:
+    from docx import Document
+    doc = Document()
+    for page_number, lines in enumerate(pages):
+        if page_number:
+            doc.add_page_break()
+        for paragraph in " ".join(lines).split("  "): # Blank lines mark paragraph ends
+            if paragraph.strip():
+                doc.add_paragraph(paragraph.strip())
+    doc.save(path)
+
+
+def _pdf_string(text: str) -> bytes:
+    return b"(" + text.encode("cp1252").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_digital_pdf(path: Path, pages: List[List[str]]) -> None:
+    """Minimal PDF with a Helvetica text layer (WinAnsi, so Spanish accents survive pdfminer)."""
+    objects: List[bytes] = [b"", b"", b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for lines in pages:
+        stream = b"BT /F1 10 Tf 14 TL 50 800 Td\n" + b"".join(_pdf_string(line) + b" Tj T*\n" for line in lines) + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        page_ids.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    output, offsets = bytearray(b"%PDF-1.4\n"), []
+    for object_number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (object_number, body)
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    path.write_bytes(bytes(output))
+
+
+def write_scanned_pdf(path: Path, pages: List[List[str]]) -> None:
+    """Image-only PDF (A4 at 150 dpi), like a scanned document with no text layer."""
+    from PIL import Image, ImageDraw, ImageFont
+    try:
+        font = ImageFont.load_default(size=22)
+    except TypeError: # Pillow < 10.1
+        font = ImageFont.load_default()
+    images = []
+    for lines in pages:
+        image = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(image)
+        for line_number, line in enumerate(lines):
+            draw.text((100, 100 + line_number * 34), line, fill=0, font=font)
+        images.append(image)
+    images[0].save(path, "PDF", resolution=150, save_all=True, append_images=images[1:])
+
+
+WRITERS = {"docx": (".docx", write_docx), "digital-pdf": (".pdf", write_digital_pdf), "scanned-pdf": (".pdf", write_scanned_pdf)}
+
+
+def ocr_available() -> bool:
+    if not Loader.OCR_CAPABLE or not (Loader.POPPLER_PATH or shutil.which("pdftoppm")):
+        return False
+    try:
+        Loader.pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+
+def generate_documents(docs_dir: Path, kind: str, pages_per_file: int, files: int) -> None:
+    docs_dir.mkdir(parents=True, exist_ok=True)
+    suffix, writer = WRITERS[kind]
+    for file_number in range(files):
+        writer(docs_dir / f"{kind}-{pages_per_file}p-{file_number}{suffix}", synthetic_pages(pages_per_file, seed=file_number))
+
+
+# --- Scenario (runs in a subprocess) ---
+def peak_rss_mb() -> Dict[str, Optional[float]]:
+    try:
+        import resource
+    except ImportError: # Windows
+        return {"main": None, "workers": None}
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024 # ru_maxrss is bytes on macOS, KiB on Linux
+    return {
+        "main": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "workers": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1), # Largest single worker
+    }
+
+
+def run_scenario(docs_dir: Path, work_dir: Path, workers: int, embed_latency_ms: float) -> Dict[str, Any]:
+    Loader.logger.setLevel("WARNING")
+    Loader.HR_DOCS_DIR = docs_dir
+    Loader.CHROMA_DB_DIR = work_dir / "chroma"
+    Loader.MANIFEST_PATH = work_dir / "manifest.sqlite3"
+    embedding_fx = HashingEmbeddingFunction(latency_ms=embed_latency_ms)
+    # Not Loader.get_or_create_collection: the hashing stand-in is not a configured embedding backend.
+    collection = Loader.initialize_chroma_client().get_or_create_collection(Loader.COLLECTION_NAME, embedding_function=embedding_fx, metadata={"hnsw:space": "cosine"})
+
+    start = time.perf_counter()
+    stats = Loader.process_and_load_documents(collection, force_reprocess_all_files=True, max_workers=workers, embedding_fx=embedding_fx)
+    elapsed = time.perf_counter() - start
+    return {"elapsed_seconds": round(elapsed, 3), "stats": stats, "peak_rss_mb": peak_rss_mb()}
+
+
+def run_scenario_subprocess(docs_dir: Path, work_dir: Path, workers: int, embed_latency_ms: float) -> Dict[str, Any]:
+    completed = subprocess.run(
+        [sys.executable, __file__, "--run-scenario", str(docs_dir), str(work_dir), "--workers", str(workers), "--embed-latency-ms", str(embed_latency_ms)],
+        stdout=subprocess.PIPE, check=True, text=True
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kinds", default=",".join(KINDS))
+    parser.add_argument("--pages", default="5,25,100", help="Pages per document, comma separated")
+    parser.add_argument("--files", type=int, default=4, help="Documents per scenario")
+    parser.add_argument("--workers", type=int, default=Loader.LOADER_MAX_WORKERS)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0, help="Simulated latency per embedding request")
+    parser.add_argument("--output", type=Path, help="Write the JSON report here instead of stdout")
+    parser.add_argument("--run-scenario", nargs=2, metavar=("DOCS_DIR", "WORK_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(Path(args.run_scenario[0]), Path(args.run_scenario[1]), args.workers, args.embed_latency_ms)))
+        return
+
+    kinds = [kind.strip() for kind in args.kinds.split(",") if kind.strip()]
+    unknown_kinds = set(kinds) - set(KINDS)
+    if unknown_kinds:
+        parser.error(f"Unknown kinds: {', '.join(sorted(unknown_kinds))}. Choose from {', '.join(KINDS)}.")
+    report: Dict[str, Any] = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "workers": args.workers, "files_per_scenario": args.files, "embed_latency_ms": args.embed_latency_ms,
+        "scenarios": [], "skipped": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="bench_ingestion_") as tmp:
+        for kind in kinds:
+            if kind == "scanned-pdf" and not ocr_available():
+                report["skipped"].append({"kind": kind, "reason": "Tesseract/Poppler not available"})
+                continue
+            for pages_per_file in [int(pages) for pages in args.pages.split(",")]:
+                scenario_dir = Path(tmp) / f"{kind}-{pages_per_file}"
+                generate_documents(scenario_dir / "HR", kind, pages_per_file, args.files)
+                result = run_scenario_subprocess(scenario_dir / "HR", scenario_dir, args.workers, args.embed_latency_ms)
+                stats, elapsed = result["stats"], result["elapsed_seconds"]
+                pages = pages_per_file * args.files
+                chunks = stats.get("new_chunks_added", 0)
+                scenario = {
+                    "kind": kind, "pages_per_file": pages_per_file, "files": args.files, "pages": pages, "chunks": chunks,
+                    "pages_digital": stats.get("pages_digital", 0), "pages_ocr": stats.get("pages_ocr", 0), "elapsed_seconds": elapsed,
+                    "pages_per_second": round(pages / elapsed, 2) if elapsed else None,
+                    "chunks_per_second": round(chunks / elapsed, 2) if elapsed else None,
+                    "stage_seconds": {stage: round(stats.get(f"{stage}_seconds", 0.0), 3) for stage in STAGES},
+                    "embedding_failures": stats.get("embedding_failures", 0),
+                    "peak_rss_mb": result["peak_rss_mb"],
+                }
+                report["scenarios"].append(scenario)
+                print(f"{kind:<12} {pages_per_file:>4} pages x {args.files}: {elapsed:>8.2f}s  {scenario['pages_per_second']:>8} pages/s  "
+                      f"{scenario['chunks_per_second']:>8} chunks/s  peak RSS {result['peak_rss_mb']['main']} MB", file=sys.stderr)
+                shutil.rmtree(scenario_dir, ignore_errors=True)
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(report_json + "\n", encoding="utf-8")
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
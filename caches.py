@@ -0,0 +1,363 @@
+"""
+Caches used by HRAssistant on the query path.
+
+QueryEmbeddingCache: question embeddings keyed by normalized question text and embedding model. An
+in-process LRU sits in front of a SQLite file shared by every app worker process, so the questions asked
+all day (aguinaldo, vacaciones, retardos...) are embedded once instead of once per request. A second
+instance, in its own file, holds the sentence embeddings used for context compression.
+
+SemanticAnswerCache: generated answers keyed by question embedding, language and index version. A new
+question whose embedding is close enough to a cached one, and that mentions the same numbers, gets the
+stored answer without an LLM call.
+
+ClientPool: long-lived API clients (and their HTTP connection pools) keyed by a hash of the API key.
+"""
+import os
+import re
+import time
+import array
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np # Installed with chromadb
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent
+QUERY_EMBEDDING_CACHE_ENABLED = os.getenv("QUERY_EMBEDDING_CACHE", "true").lower() in ['true', '1', 't']
+QUERY_EMBEDDING_CACHE_PATH = BASE_DIR / "query_embedding_cache.sqlite3"
+QUERY_EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("QUERY_EMBEDDING_CACHE_MEMORY_ENTRIES", 1024))
+QUERY_EMBEDDING_CACHE_DISK_ENTRIES = int(os.getenv("QUERY_EMBEDDING_CACHE_DISK_ENTRIES", 50000))
+# Sentences of retrieved chunks, embedded for context compression. Chunks rarely change, so these repeat a lot.
+SENTENCE_EMBEDDING_CACHE_PATH = BASE_DIR / "sentence_embedding_cache.sqlite3"
+SENTENCE_EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("SENTENCE_EMBEDDING_CACHE_MEMORY_ENTRIES", 8192))
+SENTENCE_EMBEDDING_CACHE_DISK_ENTRIES = int(os.getenv("SENTENCE_EMBEDDING_CACHE_DISK_ENTRIES", 200000))
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "true").lower() in ['true', '1', 't']
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.92)) # Minimum cosine similarity between questions
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 500))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", 24 * 3600))
+
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", 32)) # Distinct API keys with a live client
+API_KEY_VALIDATION_TTL_SECONDS = float(os.getenv("API_KEY_VALIDATION_TTL_SECONDS", 3600))
+
+_QUESTION_EDGE_PUNCTUATION = "¿?¡!.,;: \"'"
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?|[^\W\d_]+")
+# Spelled-out quantities count as numbers too, so "dos años" and "2 años" compare equal
+_NUMBER_WORDS = {
+    "cero": "0", "uno": "1", "dos": "2", "tres": "3", "cuatro": "4", "cinco": "5", "seis": "6", "siete": "7", "ocho": "8",
+    "nueve": "9", "diez": "10", "once": "11", "doce": "12", "trece": "13", "catorce": "14", "quince": "15", "veinte": "20",
+    "treinta": "30", "cuarenta": "40", "cincuenta": "50", "sesenta": "60", "cien": "100",
+    "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "six": "6", "seven": "7", "eight": "8",
+    "nine": "9", "ten": "10", "eleven": "11", "twelve": "12", "fifteen": "15", "twenty": "20", "thirty": "30", "forty": "40",
+    "fifty": "50", "sixty": "60", "hundred": "100",
+}
+
+
+def normalize_question(question: str) -> str:
+    """Case, Unicode form, whitespace and surrounding punctuation do not change what is being asked."""
+    question = unicodedata.normalize("NFKC", question).lower()
+    return re.sub(r'\s+', ' ', question).strip(_QUESTION_EDGE_PUNCTUATION)
+
+
+def question_numbers(question: str) -> Tuple[str, ...]:
+    """
+    The quantities a question mentions ("con 5 años", "dos semanas"), sorted. Questions that differ only in a
+    number embed almost identically but have different answers, so the answer cache requires these to match.
+    """
+    numbers = []
+    for token in _NUMBER_PATTERN.findall(normalize_question(question)):
+        if token[0].isdigit():
+            numbers.append(token.replace(",", "."))
+        elif token in _NUMBER_WORDS:
+            numbers.append(_NUMBER_WORDS[token])
+    return tuple(sorted(numbers))
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache of question embeddings: an LRU dict in this process (memory_entries) backed by a SQLite
+    table (disk_entries, least recently used rows evicted first) that all app workers share. Keys combine
+    the embedding model with the normalized question. Tracks hits per tier and the embedding latency saved:
+    every entry keeps how long its embedding call took, which is what each hit on it avoids.
+    """
+    def __init__(self, db_path: Path, memory_entries: int, disk_entries: int, enabled: bool = True):
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[List[float], float]]" = OrderedDict() # key -> (embedding, embed_seconds)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._disk_writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.embed_seconds = 0.0 # Time spent embedding on misses
+        self.saved_seconds = 0.0 # Embedding time of the entries that were hit
+        self.lookup_seconds = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                " cache_key TEXT PRIMARY KEY, model TEXT NOT NULL, embedding BLOB NOT NULL, embed_seconds REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(model: str, question: str) -> str:
+        return hashlib.sha256(f"{model}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, embedding: List[float], embed_seconds: float) -> None:
+        self._memory[key] = (embedding, embed_seconds)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, model: str, question: str) -> Optional[List[float]]:
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        key = self.make_key(model, question)
+        with self._lock:
+            try:
+                entry = self._memory.get(key)
+                if entry is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    self.saved_seconds += entry[1]
+                    return entry[0]
+                try:
+                    conn = self._connection()
+                    row = conn.execute("SELECT embedding, embed_seconds FROM query_embeddings WHERE cache_key = ?", (key,)).fetchone()
+                    if row is not None:
+                        conn.execute("UPDATE query_embeddings SET last_access = ? WHERE cache_key = ?", (time.time(), key))
+                        conn.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"Query embedding cache read failed: {e}")
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                embedding = array.array("f", row[0]).tolist()
+                self._remember(key, embedding, row[1])
+                self.disk_hits += 1
+                self.saved_seconds += row[1]
+                return embedding
+            finally:
+                self.lookup_seconds += time.perf_counter() - start
+
+    def put(self, model: str, question: str, embedding: List[float], embed_seconds: float) -> None:
+        if not self.enabled:
+            return
+        key = self.make_key(model, question)
+        with self._lock:
+            self.embed_seconds += embed_seconds
+            self._remember(key, embedding, embed_seconds)
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?)",
+                    (key, model, array.array("f", embedding).tobytes(), embed_seconds, time.time())
+                )
+                self._disk_writes += 1
+                if self._disk_writes % 100 == 0: # Counting rows on every write would cost more than the lookup saves
+                    self._evict(conn)
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Query embedding cache write failed: {e}")
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        excess = conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0] - self.disk_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM query_embeddings WHERE cache_key IN (SELECT cache_key FROM query_embeddings ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+            logger.info(f"Query embedding cache: evicted {excess} least recently used entries.")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            average_embed_seconds = self.embed_seconds / self.misses if self.misses else 0.0 # Per miss that was embedded
+            return {
+                "enabled": self.enabled, "memory_entries": len(self._memory), "lookups": lookups,
+                "memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "average_embed_ms": round(average_embed_seconds * 1000, 2),
+                "latency_saved_seconds": round(max(0.0, self.saved_seconds - self.lookup_seconds), 3),
+            }
+
+
+class SemanticAnswerCache:
+    """
+    In-process cache of generated answers for paraphrased questions. Entries hold the normalized question
+    embedding, language, index version, the numbers in the question (question_numbers) and answer; a lookup
+    returns the answer of the most similar entry with the same language, index version and numbers if its
+    cosine similarity reaches similarity_threshold.
+    All entries are dropped when the index version changes (the loader changed the documents), and entries
+    expire after ttl_seconds; beyond max_entries the least recently used entry is evicted.
+    """
+    def __init__(self, similarity_threshold: float, max_entries: int, ttl_seconds: float, enabled: bool = True):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._index_version: Optional[int] = None
+        self._matrix_cache: Dict[str, Tuple[List[int], np.ndarray]] = {} # language -> (entry ids, stacked embeddings)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit_vector(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_index_version(self, index_version: int) -> None:
+        if self._index_version != index_version:
+            if self._entries:
+                logger.info(f"Index version changed ({self._index_version} -> {index_version}). Dropping {len(self._entries)} cached answers.")
+                self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._matrix_cache.clear()
+            self._index_version = index_version
+
+    def _drop(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        self._matrix_cache.pop(entry["language"], None)
+        self.evictions += 1
+
+    def _drop_expired(self) -> None:
+        expiry = time.time() - self.ttl_seconds
+        for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry["created_at"] < expiry]:
+            self._drop(entry_id)
+
+    def _matrix(self, language: str) -> Tuple[List[int], Optional[np.ndarray]]:
+        if language not in self._matrix_cache:
+            entry_ids = [entry_id for entry_id, entry in self._entries.items() if entry["language"] == language]
+            matrix = np.stack([self._entries[entry_id]["embedding"] for entry_id in entry_ids]) if entry_ids else None
+            self._matrix_cache[language] = (entry_ids, matrix)
+        return self._matrix_cache[language]
+
+    def get(self, query_embedding: List[float], language: str, index_version: int, question: str) -> Optional[Dict[str, Any]]:
+        """Returns {"answer", "question", "similarity"} of the closest cached answer, or None."""
+        if not self.enabled:
+            return None
+        numbers = question_numbers(question)
+        with self._lock:
+            self._check_index_version(index_version)
+            self._drop_expired()
+            entry_ids, matrix = self._matrix(language)
+            if matrix is None:
+                self.misses += 1
+                return None
+            similarities = matrix @ self._unit_vector(query_embedding)
+            # "con 2 años" and "con 5 años" are near neighbours; only entries asking about the same numbers can match
+            similarities[[self._entries[entry_id]["numbers"] != numbers for entry_id in entry_ids]] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.similarity_threshold:
+                self.misses += 1
+                return None
+            entry_id = entry_ids[best]
+            self._entries.move_to_end(entry_id)
+            self._entries[entry_id]["hits"] += 1
+            self.hits += 1
+            return {"answer": self._entries[entry_id]["answer"], "question": self._entries[entry_id]["question"], "similarity": similarity}
+
+    def put(self, query_embedding: List[float], language: str, index_version: int, question: str, answer: str) -> None:
+        if not self.enabled or not answer.strip():
+            return
+        with self._lock:
+            if self._index_version is not None and index_version < self._index_version:
+                return # The index changed while this answer was being generated
+            self._check_index_version(index_version)
+            self._entries[self._next_id] = {
+                "embedding": self._unit_vector(query_embedding), "language": language, "question": question,
+                "numbers": question_numbers(question), "answer": answer, "created_at": time.time(), "hits": 0,
+            }
+            self._next_id += 1
+            self._matrix_cache.pop(language, None)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled, "entries": len(self._entries), "index_version": self._index_version,
+                "lookups": lookups, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores, "evictions": self.evictions, "invalidations": self.invalidations,
+                "similarity_threshold": self.similarity_threshold, "ttl_seconds": self.ttl_seconds, "max_entries": self.max_entries,
+            }
+
+
+def hash_api_key(api_key: str) -> str:
+    """Pools and caches are keyed by this hash so API keys are never kept as dictionary keys or logged."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+
+
+class ClientPool:
+    """
+    Bounded LRU of clients built by factory(api_key), keyed by hash_api_key(api_key). Reusing a client
+    reuses its HTTP connection pool (no new TLS handshake per request). Evicted clients are not closed
+    explicitly, since a response may still be streaming through them; they are closed when garbage collected.
+    """
+    def __init__(self, name: str, factory: Callable[[str], Any], max_size: int):
+        self.name = name
+        self.factory = factory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._clients: "OrderedDict[str, Any]" = OrderedDict()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def get(self, api_key: str) -> Any:
+        key = hash_api_key(api_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                self.reused += 1
+                return client
+        client = self.factory(api_key) # Outside the lock: building a client can be slow
+        with self._lock:
+            if key in self._clients: # Another thread built one meanwhile; keep the first
+                self._clients.move_to_end(key)
+                self.reused += 1
+                return self._clients[key]
+            self._clients[key] = client
+            self.created += 1
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evicted += 1
+        return client
+
+    def discard(self, api_key: str) -> None:
+        with self._lock:
+            self._clients.pop(hash_api_key(api_key), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._clients), "max_size": self.max_size, "created": self.created, "reused": self.reused, "evicted": self.evicted}
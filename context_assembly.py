@@ -0,0 +1,390 @@
+"""
+Builds the "Context:" block of the prompt from ranked candidate chunks, within a token budget.
+
+HRAssistant over-fetches candidates (CONTEXT_CANDIDATES) and ContextAssembler:
+  - drops near-duplicate chunks (the same clause in two versions of a document),
+  - removes paragraphs already included: loader.py starts each chunk with the last paragraph of the
+    previous one, so two neighbouring chunks would otherwise repeat that paragraph,
+  - orders the rest by maximal marginal relevance (rank relevance vs. word overlap with what is already
+    selected), so the context is not three variations of the same passage,
+  - packs whole chunks into CONTEXT_TOKEN_BUDGET tiktoken tokens: a chunk that doesn't fit is skipped
+    instead of being cut mid-clause, and a shorter one further down may take its place.
+
+Before that, ContextCompressor can shrink each candidate to the sentences that answer the question
+(CONTEXT_COMPRESSION): sentences are scored by IDF-weighted overlap with the question's terms and by
+cosine similarity between their embedding and the (cached) question embedding. Only the
+CONTEXT_COMPRESSION_EMBED_SENTENCES best sentences by lexical score are embedded; the time spent embedding
+is logged and reported in the compression stats. The article/clause heading a kept sentence belongs to is
+kept too, so the model can still cite it.
+
+HistoryCompactor does the same for the conversation history: the most recent messages are kept verbatim
+within HISTORY_TOKEN_BUDGET, and the older ones are folded into a rolling summary. The summary is stored
+with the conversation (conversations.py, shared by every app worker and kept across restarts) together with
+the number of messages it covers, and extended with the messages that fell out of the window since, so
+earlier turns are summarized once instead of on every follow-up question.
+"""
+import os
+import re
+import logging
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np # Installed with chromadb
+import tiktoken
+
+import sections
+from lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 2500))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 12)) # Chunks retrieved before deduplication and packing
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7)) # 1.0 = rank order only, lower = more diversity
+NEAR_DUPLICATE_SIMILARITY = 0.85 # Word-set Jaccard similarity above which a chunk counts as a duplicate
+
+CONTEXT_COMPRESSION_ENABLED = os.getenv("CONTEXT_COMPRESSION", "true").lower() in ['true', '1', 't']
+CONTEXT_COMPRESSION_EMBEDDING_WEIGHT = float(os.getenv("CONTEXT_COMPRESSION_EMBEDDING_WEIGHT", 0.6)) # 0 = lexical only, no embedding calls
+CONTEXT_COMPRESSION_KEEP_RATIO = float(os.getenv("CONTEXT_COMPRESSION_KEEP_RATIO", 0.6)) # Keep sentences scoring >= ratio * best score
+CONTEXT_COMPRESSION_MAX_SENTENCES = int(os.getenv("CONTEXT_COMPRESSION_MAX_SENTENCES", 4)) # Per chunk, not counting headings kept for context
+CONTEXT_COMPRESSION_EMBED_SENTENCES = int(os.getenv("CONTEXT_COMPRESSION_EMBED_SENTENCES", 32)) # Best lexical candidates embedded per question
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1000)) # Conversation history in the prompt, summary included
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 250)) # Reserved for the summary when there is one
+
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+# Sentence ends followed by what starts a new sentence, and line breaks (list items such as "a) ...").
+_SENTENCE_BOUNDARY_PATTERN = re.compile(r'(?<=[.!?;:])\s+(?=[¿¡"(\dA-ZÁÉÍÓÚÑ])|\n+')
+
+
+def get_tokenizer(model_name: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        logger.warning(f"Encoding for {model_name} not found. Using o200k_base.")
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class ContextAssembler:
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int = CONTEXT_TOKEN_BUDGET, mmr_lambda: float = CONTEXT_MMR_LAMBDA):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.separator_tokens = count_tokens("\n\n")
+        self._lock = threading.Lock()
+        self.assembled = 0
+        self.tokens_used = 0
+        self.chunks_used = 0
+        self.dropped_duplicates = 0
+        self.dropped_over_budget = 0
+        self.overlap_paragraphs_removed = 0
+
+    def _mmr_order(self, term_sets: List[Set[str]]) -> Tuple[List[int], List[int]]:
+        """Candidate indexes in MMR order, and the indexes dropped as near-duplicates."""
+        remaining = list(range(len(term_sets)))
+        ordered: List[int] = []
+        duplicates: List[int] = []
+        while remaining:
+            best_index, best_score = None, float("-inf")
+            for index in remaining:
+                relevance = 1.0 - index / len(term_sets) # Candidates arrive best first
+                redundancy = max((_jaccard(term_sets[index], term_sets[chosen]) for chosen in ordered), default=0.0)
+                if redundancy >= NEAR_DUPLICATE_SIMILARITY:
+                    best_index, best_score = index, None
+                    break
+                score = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+                if score > best_score:
+                    best_index, best_score = index, score
+            remaining.remove(best_index)
+            if best_score is None:
+                duplicates.append(best_index)
+            else:
+                ordered.append(best_index)
+        return ordered, duplicates
+
+    def assemble(self, candidates: List[str], max_chunks: Optional[int] = None, diversify: bool = True) -> Tuple[str, Dict[str, Any]]:
+        """
+        Packs ranked candidate chunks (best first) into the token budget. diversify=False keeps the given
+        order (e.g. the chunks of a cited clause, in document order). Returns the context text and the stats
+        of this assembly (also logged).
+        """
+        candidates = [candidate for candidate in candidates if candidate and candidate.strip()]
+        if diversify:
+            ordered, duplicates = self._mmr_order([set(tokenize(candidate)) for candidate in candidates])
+        else:
+            ordered, duplicates = list(range(len(candidates))), []
+
+        seen_paragraphs: Set[str] = set()
+        parts: List[str] = []
+        tokens_used = 0
+        over_budget = 0
+        overlap_paragraphs = 0
+        for index in ordered:
+            if max_chunks is not None and len(parts) >= max_chunks:
+                over_budget += 1
+                continue
+            paragraphs = []
+            for paragraph in candidates[index].split("\n\n"):
+                key = _WHITESPACE_PATTERN.sub(" ", paragraph).strip()
+                if not key:
+                    continue
+                if key in seen_paragraphs:
+                    overlap_paragraphs += 1
+                    continue
+                paragraphs.append(paragraph.strip())
+            if not paragraphs: # Entirely contained in chunks already selected
+                duplicates.append(index)
+                continue
+            text = "\n\n".join(paragraphs)
+            text_tokens = self.count_tokens(text) + (self.separator_tokens if parts else 0)
+            if tokens_used + text_tokens > self.token_budget:
+                over_budget += 1
+                continue
+            seen_paragraphs.update(_WHITESPACE_PATTERN.sub(" ", paragraph).strip() for paragraph in paragraphs)
+            parts.append(text)
+            tokens_used += text_tokens
+
+        stats = {
+            "candidates": len(candidates), "chunks_used": len(parts), "tokens_used": tokens_used, "token_budget": self.token_budget,
+            "dropped_duplicates": len(duplicates), "dropped_over_budget": over_budget, "overlap_paragraphs_removed": overlap_paragraphs,
+        }
+        with self._lock:
+            self.assembled += 1
+            self.tokens_used += tokens_used
+            self.chunks_used += len(parts)
+            self.dropped_duplicates += len(duplicates)
+            self.dropped_over_budget += over_budget
+            self.overlap_paragraphs_removed += overlap_paragraphs
+        logger.info(f"Context: {tokens_used}/{self.token_budget} tokens from {len(parts)} of {len(candidates)} chunks "
+                    f"({len(duplicates)} duplicates, {over_budget} over budget dropped; {overlap_paragraphs} overlapping paragraphs removed).")
+        return "\n\n".join(parts), stats
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "token_budget": self.token_budget, "mmr_lambda": self.mmr_lambda, "assembled": self.assembled,
+                "avg_tokens_used": round(self.tokens_used / self.assembled, 1) if self.assembled else 0.0,
+                "avg_chunks_used": round(self.chunks_used / self.assembled, 2) if self.assembled else 0.0,
+                "dropped_duplicates": self.dropped_duplicates, "dropped_over_budget": self.dropped_over_budget,
+                "overlap_paragraphs_removed": self.overlap_paragraphs_removed,
+            }
+
+
+class ContextCompressor:
+    """
+    Query-focused extractive compression: keeps the best CONTEXT_COMPRESSION_MAX_SENTENCES sentences of each
+    chunk (those scoring at least CONTEXT_COMPRESSION_KEEP_RATIO of the best sentence among all candidates),
+    in their original order and paragraphs, plus the headings they fall under. Chunks with no such sentence
+    are dropped.
+    """
+    def __init__(self, count_tokens: Callable[[str], int], enabled: bool = CONTEXT_COMPRESSION_ENABLED,
+                 embedding_weight: float = CONTEXT_COMPRESSION_EMBEDDING_WEIGHT, keep_ratio: float = CONTEXT_COMPRESSION_KEEP_RATIO,
+                 max_sentences: int = CONTEXT_COMPRESSION_MAX_SENTENCES, embed_sentences: int = CONTEXT_COMPRESSION_EMBED_SENTENCES):
+        self.count_tokens = count_tokens
+        self.enabled = enabled
+        self.embedding_weight = embedding_weight
+        self.keep_ratio = keep_ratio
+        self.max_sentences = max_sentences
+        self.embed_sentences = embed_sentences
+        self._lock = threading.Lock()
+        self.compressions = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.sentences_before = 0
+        self.sentences_after = 0
+        self.sentences_embedded = 0
+        self.embedding_seconds = 0.0
+
+    @staticmethod
+    def split_sentences(paragraph: str) -> List[str]:
+        return [sentence.strip() for sentence in _SENTENCE_BOUNDARY_PATTERN.split(paragraph) if sentence.strip()]
+
+    def compress(self, question: str, chunks: List[str], idf: Callable[[str], float],
+                 question_embedding: Optional[List[float]] = None,
+                 embed_sentences: Optional[Callable[[List[str]], List[List[float]]]] = None) -> Tuple[List[str], Dict[str, Any]]:
+        """
+        Compresses ranked chunks for the question. idf(term) weighs the question's terms; embed_sentences
+        (e.g. backed by an embedding cache) is only called when the embedding weight is non-zero, and only for
+        the self.embed_sentences best sentences by lexical score (the others get no embedding similarity).
+        Returns the compressed chunks (empty ones removed) and the stats of this compression.
+        """
+        # chunk -> paragraphs -> (sentence, is_heading)
+        structure = [[[(sentence, index == 0 and sections.starts_with_section_heading(paragraph))
+                       for index, sentence in enumerate(self.split_sentences(paragraph))]
+                      for paragraph in chunk.split("\n\n") if paragraph.strip()] for chunk in chunks]
+        sentences = list(dict.fromkeys(sentence for chunk in structure for paragraph in chunk for sentence, _ in paragraph))
+
+        question_terms = set(tokenize(question))
+        question_weight = sum(idf(term) for term in question_terms) or 1.0
+        scores = {sentence: sum(idf(term) for term in question_terms & set(tokenize(sentence))) / question_weight for sentence in sentences}
+        embedded, embedding_seconds = [], 0.0
+        if self.embedding_weight > 0 and question_embedding is not None and embed_sentences is not None and sentences:
+            # Lexical pre-filter: a sentence sharing no weighty term with the question is rarely the one to keep,
+            # so embedding every sentence of every candidate (100+) is not worth the latency.
+            embedded = sorted(sentences, key=lambda sentence: scores[sentence], reverse=True)[:self.embed_sentences]
+            start = time.perf_counter()
+            try:
+                sentence_vectors = np.asarray(embed_sentences(embedded), dtype=np.float32)
+                question_vector = np.asarray(question_embedding, dtype=np.float32)
+                norms = np.linalg.norm(sentence_vectors, axis=1) * (np.linalg.norm(question_vector) or 1.0)
+                similarities = dict(zip(embedded, (sentence_vectors @ question_vector / np.where(norms == 0, 1.0, norms)).tolist()))
+                for sentence in sentences:
+                    scores[sentence] = (1 - self.embedding_weight) * scores[sentence] + self.embedding_weight * max(0.0, similarities.get(sentence, 0.0))
+            except Exception as e: # Lexical scores alone are still a usable ranking
+                logger.warning(f"Sentence embeddings unavailable for context compression, using lexical scores only: {e}")
+                embedded = []
+            embedding_seconds = time.perf_counter() - start
+        threshold = self.keep_ratio * max(scores.values(), default=0.0)
+
+        compressed = []
+        for chunk in structure:
+            ranked = sorted({sentence for paragraph in chunk for sentence, _ in paragraph}, key=lambda sentence: scores[sentence], reverse=True)
+            keep = {sentence for sentence in ranked[:self.max_sentences] if scores[sentence] > 0 and scores[sentence] >= threshold}
+            if not keep:
+                continue
+            paragraphs, heading = [], None
+            for paragraph in chunk:
+                if paragraph and paragraph[0][1]:
+                    heading = paragraph[0][0] # Applies to the following paragraphs until the next heading
+                kept = [sentence for sentence, _ in paragraph if sentence in keep]
+                if kept:
+                    if heading is not None and heading not in kept:
+                        if paragraph[0][0] == heading:
+                            kept.insert(0, heading) # Heading of this very paragraph
+                        else:
+                            paragraphs.append(heading)
+                    heading = None # Once per section
+                    paragraphs.append(" ".join(kept))
+            compressed.append("\n\n".join(paragraphs))
+
+        tokens_before = sum(self.count_tokens(chunk) for chunk in chunks)
+        tokens_after = sum(self.count_tokens(chunk) for chunk in compressed)
+        kept_sentences = sum(len(self.split_sentences(chunk)) for chunk in compressed)
+        stats = {"sentences_before": len(sentences), "sentences_after": kept_sentences, "tokens_before": tokens_before, "tokens_after": tokens_after,
+                 "compression_ratio": round(tokens_after / tokens_before, 3) if tokens_before else 1.0,
+                 "sentences_embedded": len(embedded), "embedding_seconds": round(embedding_seconds, 4)}
+        with self._lock:
+            self.compressions += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            self.sentences_before += len(sentences)
+            self.sentences_after += kept_sentences
+            self.sentences_embedded += len(embedded)
+            self.embedding_seconds += embedding_seconds
+        logger.info(f"Context compression: {tokens_before} -> {tokens_after} tokens (ratio {stats['compression_ratio']}), "
+                    f"{len(chunks)} -> {len(compressed)} chunks; {len(embedded)}/{len(sentences)} sentences embedded in {embedding_seconds * 1000:.0f} ms.")
+        return compressed, stats
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled, "embedding_weight": self.embedding_weight, "keep_ratio": self.keep_ratio, "compressions": self.compressions,
+                "tokens_before": self.tokens_before, "tokens_after": self.tokens_after,
+                "compression_ratio": round(self.tokens_after / self.tokens_before, 3) if self.tokens_before else 1.0,
+                "embed_sentences": self.embed_sentences, "sentences_embedded": self.sentences_embedded,
+                "embedding_seconds_total": round(self.embedding_seconds, 3),
+                "embedding_ms_avg": round(self.embedding_seconds * 1000 / self.compressions, 1) if self.compressions else 0.0,
+            }
+
+
+class HistoryCompactor:
+    """
+    Fits a conversation history into token_budget tokens: the newest messages verbatim (the newest one cut
+    short if it alone is over budget), and a summary of everything older. summarize(previous_summary,
+    messages) is called only for the messages not covered by the conversation's stored summary.
+    summary_store is the conversation store (conversations.py): get_summary(conversation_id) returns
+    (summary, messages covered, messages trimmed from the front) and set_summary(conversation_id, summary,
+    covered) saves it, both counting from the start of the conversation. Without it, older messages are dropped.
+    """
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int = HISTORY_TOKEN_BUDGET,
+                 summary_max_tokens: int = HISTORY_SUMMARY_MAX_TOKENS, summary_store: Optional[Any] = None):
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_store = summary_store
+        self._lock = threading.Lock()
+        self.compactions = 0
+        self.messages_summarized = 0
+        self.summary_calls = 0
+        self.summary_cache_hits = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    @staticmethod
+    def format_message(message: Dict[str, str]) -> str:
+        role = "User" if message.get('role') == 'user' else "Assistant"
+        return f"{role}: {message.get('content', '')}\n"
+
+    def _recent(self, messages: List[Dict[str, str]], budget: int) -> Tuple[List[Dict[str, str]], int]:
+        """The longest suffix of messages that fits in budget tokens, and its token count."""
+        recent, used = [], 0
+        for message in reversed(messages):
+            tokens = self.count_tokens(self.format_message(message))
+            if used + tokens > budget:
+                break
+            recent.insert(0, message)
+            used += tokens
+        return recent, used
+
+    def _truncate(self, message: Dict[str, str], budget: int) -> Dict[str, str]:
+        content = message.get('content', '')
+        while content and self.count_tokens(self.format_message({**message, 'content': content + " [...]"})) > budget:
+            content = content[:int(len(content) * 0.8)] # Tokens are roughly proportional to characters; a few passes at most
+        return {**message, 'content': content + " [...]" if content else ""}
+
+    def compact(self, messages: List[Dict[str, str]], conversation_id: Optional[str] = None,
+                summarize: Optional[Callable[[Optional[str], List[Dict[str, str]]], str]] = None) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """
+        Returns (summary of the older messages or None, recent messages to include verbatim). messages are the
+        conversation's stored messages, oldest first. Without a conversation ID, summarize function or summary
+        store, messages that don't fit are dropped.
+        """
+        tokens_before = sum(self.count_tokens(self.format_message(message)) for message in messages)
+        recent, used = self._recent(messages, self.token_budget)
+        summary = None
+        if len(recent) < len(messages):
+            can_summarize = conversation_id is not None and summarize is not None and self.summary_store is not None
+            recent, used = self._recent(messages, self.token_budget - (self.summary_max_tokens if can_summarize else 0))
+            if not recent and messages: # The newest message alone is over budget
+                recent = [self._truncate(messages[-1], self.token_budget - (self.summary_max_tokens if can_summarize else 0))]
+                used = self.count_tokens(self.format_message(recent[0]))
+            older = messages[:len(messages) - len(recent)]
+            if can_summarize and older:
+                summary, summary_covers, trimmed = self.summary_store.get_summary(conversation_id)
+                # messages[0] is message number `trimmed` of the conversation; the summary covers its first summary_covers
+                covered = min(max(summary_covers - trimmed, 0), len(older))
+                if covered < len(older):
+                    try:
+                        summary = summarize(summary, older[covered:])
+                        self.summary_store.set_summary(conversation_id, summary, trimmed + len(older))
+                        with self._lock:
+                            self.summary_calls += 1
+                            self.messages_summarized += len(older) - covered
+                    except Exception as e: # The stored summary (if any) is better than failing the question
+                        logger.warning(f"Conversation summary failed, using {'the previous summary' if summary else 'recent messages only'}: {e}")
+                else:
+                    with self._lock:
+                        self.summary_cache_hits += 1
+        tokens_after = used + (self.count_tokens(summary) if summary else 0)
+        with self._lock:
+            self.compactions += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+        if tokens_after < tokens_before:
+            logger.info(f"Conversation history: {tokens_before} -> {tokens_after} tokens ({len(recent)} of {len(messages)} messages verbatim"
+                        f"{', older ones summarized' if summary else ''}).")
+        return summary, recent
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "token_budget": self.token_budget, "compactions": self.compactions, "summary_store": self.summary_store is not None,
+                "summary_calls": self.summary_calls, "summary_cache_hits": self.summary_cache_hits, "messages_summarized": self.messages_summarized,
+                "tokens_before": self.tokens_before, "tokens_after": self.tokens_after,
+            }
@@ -0,0 +1,236 @@
+"""
+Server-side conversation history for app.py, keyed by an opaque session ID (the only conversation state in the
+session cookie). Keeping the history out of the cookie keeps every request small, avoids the ~4 KB browser cookie
+limit that long answers used to exceed, and lets the /ask stream save the answer after the headers are sent.
+
+CONVERSATION_STORE selects the backend:
+  - "sqlite" (default): a SQLite file shared by every app worker process; survives restarts.
+  - "memory": an LRU dict in this process, bounded by CONVERSATION_STORE_MAX_SESSIONS.
+Conversations not touched for CONVERSATION_TTL_SECONDS are dropped, and each keeps its last CONVERSATION_MAX_MESSAGES
+messages.
+
+Each conversation also holds the rolling summary of its older messages (context_assembly.HistoryCompactor) and
+how many messages it covers, counted from the start of the conversation: messages dropped from the front are
+counted in "trimmed", so the count stays valid as the stored window moves. Keeping the summary here lets every
+app worker, and the app after a restart, reuse it instead of summarizing the conversation again.
+"""
+import os
+import json
+import time
+import secrets
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "sqlite").lower() # sqlite or memory
+CONVERSATION_STORE_PATH = Path(os.getenv("CONVERSATION_STORE_PATH", BASE_DIR / "conversations.sqlite3"))
+CONVERSATION_STORE_MAX_SESSIONS = int(os.getenv("CONVERSATION_STORE_MAX_SESSIONS", 10000)) # Memory backend only
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", 7 * 24 * 3600)) # Same as the session cookie lifetime
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", 20))
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class MemoryConversationStore:
+    """Conversations in an LRU dict (session ID -> conversation dict); the least recently used one is evicted first."""
+    def __init__(self, max_sessions: int = CONVERSATION_STORE_MAX_SESSIONS, ttl_seconds: float = CONVERSATION_TTL_SECONDS,
+                 max_messages: int = CONVERSATION_MAX_MESSAGES):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        # session ID -> {"updated_at", "messages", "trimmed", "summary", "summary_covers"}
+        self._conversations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.reads = 0
+        self.writes = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _entry(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._conversations.get(session_id)
+        if entry is not None and entry["updated_at"] < time.time() - self.ttl_seconds:
+            del self._conversations[session_id]
+            self.expired += 1
+            return None
+        return entry
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        """The stored messages of a conversation, oldest first (empty if unknown or expired)."""
+        with self._lock:
+            self.reads += 1
+            entry = self._entry(session_id)
+            if entry is None:
+                return []
+            self._conversations.move_to_end(session_id)
+            return list(entry["messages"])
+
+    def append(self, session_id: str, *messages: Dict[str, Any]) -> None:
+        with self._lock:
+            self.writes += 1
+            entry = self._entry(session_id) or {"messages": [], "trimmed": 0, "summary": None, "summary_covers": 0}
+            combined = entry["messages"] + list(messages)
+            dropped = max(0, len(combined) - self.max_messages)
+            self._conversations.pop(session_id, None)
+            self._conversations[session_id] = {**entry, "updated_at": time.time(), "messages": combined[dropped:], "trimmed": entry["trimmed"] + dropped}
+            while len(self._conversations) > self.max_sessions:
+                self._conversations.popitem(last=False)
+                self.evicted += 1
+
+    def get_summary(self, session_id: str) -> Tuple[Optional[str], int, int]:
+        """(summary, messages it covers, messages trimmed from the front) of a conversation; (None, 0, 0) if unknown."""
+        with self._lock:
+            entry = self._entry(session_id)
+            if entry is None:
+                return None, 0, 0
+            return entry["summary"], entry["summary_covers"], entry["trimmed"]
+
+    def set_summary(self, session_id: str, summary: str, covers: int) -> None:
+        """Stores the summary of the first `covers` messages of the conversation (counting trimmed ones). No-op if it is gone."""
+        with self._lock:
+            entry = self._entry(session_id)
+            if entry is not None and covers >= entry["summary_covers"]:
+                entry["summary"], entry["summary_covers"] = summary, covers
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._conversations.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": "memory", "conversations": len(self._conversations), "max_sessions": self.max_sessions, "reads": self.reads,
+                    "writes": self.writes, "expired": self.expired, "evicted": self.evicted, "ttl_seconds": self.ttl_seconds}
+
+
+class SQLiteConversationStore:
+    """
+    Conversations in a SQLite table (one row per session: JSON messages, trimmed count and summary), shared by all
+    app workers. Expired rows are purged periodically.
+    """
+    PURGE_EVERY_WRITES = 100
+
+    def __init__(self, db_path: Path = CONVERSATION_STORE_PATH, ttl_seconds: float = CONVERSATION_TTL_SECONDS,
+                 max_messages: int = CONVERSATION_MAX_MESSAGES):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.reads = 0
+        self.writes = 0
+        self.expired = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations (session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL,"
+                " trimmed INTEGER NOT NULL DEFAULT 0, summary TEXT, summary_covers INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(conversations)")}
+            for column, definition in (("trimmed", "INTEGER NOT NULL DEFAULT 0"), ("summary", "TEXT"), ("summary_covers", "INTEGER NOT NULL DEFAULT 0")):
+                if column not in columns: # Table created before summaries were stored with the conversation
+                    self._conn.execute(f"ALTER TABLE conversations ADD COLUMN {column} {definition}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _load(self, conn: sqlite3.Connection, session_id: str) -> Optional[Tuple[List[Dict[str, Any]], int, Optional[str], int]]:
+        """(messages, trimmed, summary, summary_covers) of a live conversation, or None."""
+        row = conn.execute(
+            "SELECT messages, updated_at, trimmed, summary, summary_covers FROM conversations WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None or row[1] < time.time() - self.ttl_seconds:
+            return None
+        return json.loads(row[0]), row[2], row[3], row[4]
+
+    def get(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            self.reads += 1
+            try:
+                conversation = self._load(self._connection(), session_id)
+                return conversation[0] if conversation is not None else []
+            except (sqlite3.Error, ValueError) as e:
+                logger.warning(f"Conversation store read failed: {e}")
+                return []
+
+    def append(self, session_id: str, *messages: Dict[str, Any]) -> None:
+        with self._lock:
+            self.writes += 1
+            try:
+                conn = self._connection()
+                stored, trimmed, summary, summary_covers = self._load(conn, session_id) or ([], 0, None, 0)
+                combined = stored + list(messages)
+                dropped = max(0, len(combined) - self.max_messages)
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?)",
+                    (session_id, json.dumps(combined[dropped:], ensure_ascii=False), time.time(), trimmed + dropped, summary, summary_covers)
+                )
+                if self.writes % self.PURGE_EVERY_WRITES == 0:
+                    self._purge_expired(conn)
+                conn.commit()
+            except (sqlite3.Error, ValueError) as e:
+                logger.warning(f"Conversation store write failed: {e}")
+
+    def get_summary(self, session_id: str) -> Tuple[Optional[str], int, int]:
+        """(summary, messages it covers, messages trimmed from the front) of a conversation; (None, 0, 0) if unknown."""
+        with self._lock:
+            try:
+                conversation = self._load(self._connection(), session_id)
+            except (sqlite3.Error, ValueError) as e:
+                logger.warning(f"Conversation store read failed: {e}")
+                return None, 0, 0
+            if conversation is None:
+                return None, 0, 0
+            return conversation[2], conversation[3], conversation[1]
+
+    def set_summary(self, session_id: str, summary: str, covers: int) -> None:
+        """Stores the summary of the first `covers` messages of the conversation (counting trimmed ones). No-op if it is gone."""
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("UPDATE conversations SET summary = ?, summary_covers = ? WHERE session_id = ? AND summary_covers <= ?",
+                             (summary, covers, session_id, covers))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Conversation store write failed: {e}")
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Conversation store delete failed: {e}")
+
+    def _purge_expired(self, conn: sqlite3.Connection) -> None:
+        deleted = conn.execute("DELETE FROM conversations WHERE updated_at < ?", (time.time() - self.ttl_seconds,)).rowcount
+        if deleted:
+            self.expired += deleted
+            logger.info(f"Conversation store: purged {deleted} expired conversations.")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            try:
+                conversations = self._connection().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+            except sqlite3.Error:
+                conversations = None
+            return {"backend": "sqlite", "conversations": conversations, "reads": self.reads, "writes": self.writes,
+                    "expired": self.expired, "ttl_seconds": self.ttl_seconds}
+
+
+def get_conversation_store(backend: str = CONVERSATION_STORE):
+    if backend == "memory":
+        return MemoryConversationStore()
+    if backend != "sqlite":
+        logger.warning(f"Unknown CONVERSATION_STORE '{backend}'. Using sqlite.")
+    return SQLiteConversationStore()
@@ -0,0 +1,115 @@
+"""
+Embedding backends shared by Loader.py and query.py.
+
+The backend is chosen with the EMBEDDING_BACKEND environment variable (and optionally EMBEDDING_MODEL):
+  - "openai" (default): OpenAI text-embedding-3-large through the API. Needs an API key.
+  - "local": a sentence-transformers model on the CPU, offline once the model is downloaded
+    (pip install sentence-transformers). Defaults to a multilingual model, since the documents are Spanish.
+  - "onnx": ChromaDB's built-in all-MiniLM-L6-v2 ONNX model on the CPU, no extra dependencies (English-centric).
+Local models only read the first few hundred tokens of a chunk; text past their limit is ignored.
+
+Each collection records the backend, model and dimension it was built with in its metadata, and
+check_collection_backend refuses to load into or query a collection with a different backend.
+"""
+import os
+import logging
+from typing import Any, Dict, Optional
+
+import chromadb
+from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction, SentenceTransformerEmbeddingFunction, DefaultEmbeddingFunction
+from dotenv import load_dotenv
+
+load_dotenv() # Imported before Loader.py/app.py load their .env, and the backend is read at import time
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai").lower()
+DEFAULT_MODELS = {
+    "openai": "text-embedding-3-large",
+    "local": "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+    "onnx": "all-MiniLM-L6-v2",
+}
+OPENAI_MODEL_DIMENSIONS = {"text-embedding-3-large": 3072, "text-embedding-3-small": 1536, "text-embedding-ada-002": 1536}
+LOCAL_DEVICE = os.getenv("EMBEDDING_DEVICE", "cpu")
+
+# Collection metadata keys. Collections created before these were recorded were all built with OpenAI.
+BACKEND_METADATA_KEYS = ("embedding_backend", "embedding_model", "embedding_dimension")
+LEGACY_COLLECTION_SIGNATURE = {"embedding_backend": "openai", "embedding_model": "text-embedding-3-large", "embedding_dimension": 3072}
+
+_dimension_cache: Dict[str, int] = {}
+
+
+class EmbeddingBackendMismatchError(ValueError):
+    """The collection was built with a different embedding backend, model or dimension than the configured one."""
+
+
+def get_backend_name(backend: Optional[str] = None) -> str:
+    backend = (backend or EMBEDDING_BACKEND).lower()
+    if backend not in DEFAULT_MODELS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Choose one of: {', '.join(DEFAULT_MODELS)}.")
+    return backend
+
+
+def get_model_name(backend: Optional[str] = None) -> str:
+    backend = get_backend_name(backend)
+    if backend == EMBEDDING_BACKEND and os.getenv("EMBEDDING_MODEL"):
+        return os.getenv("EMBEDDING_MODEL")
+    return DEFAULT_MODELS[backend]
+
+
+def backend_requires_api_key(backend: Optional[str] = None) -> bool:
+    return get_backend_name(backend) == "openai"
+
+
+def get_embedding_function(api_key: Optional[str] = None, backend: Optional[str] = None) -> Any:
+    """Returns a ChromaDB embedding function for the configured backend."""
+    backend = get_backend_name(backend)
+    model_name = get_model_name(backend)
+    logger.debug(f"Creating embedding function for backend {backend} ({model_name}).")
+    if backend == "openai":
+        if not api_key:
+            raise ValueError("API key is required for the OpenAI embedding backend.")
+        return OpenAIEmbeddingFunction(api_key=api_key, model_name=model_name)
+    if backend == "local":
+        # Model instances are cached by SentenceTransformerEmbeddingFunction, so this is cheap after the first call.
+        return SentenceTransformerEmbeddingFunction(model_name=model_name, device=LOCAL_DEVICE, normalize_embeddings=True)
+    return DefaultEmbeddingFunction()
+
+
+def get_embedding_dimension(embedding_fx: Any, backend: Optional[str] = None) -> int:
+    backend = get_backend_name(backend)
+    model_name = get_model_name(backend)
+    if backend == "openai" and model_name in OPENAI_MODEL_DIMENSIONS:
+        return OPENAI_MODEL_DIMENSIONS[model_name]
+    cache_key = f"{backend}:{model_name}"
+    if cache_key not in _dimension_cache:
+        _dimension_cache[cache_key] = len(embedding_fx(["dimension probe"])[0])
+    return _dimension_cache[cache_key]
+
+
+def backend_signature(embedding_fx: Any, backend: Optional[str] = None) -> Dict[str, Any]:
+    """Collection metadata describing the embedding backend (see BACKEND_METADATA_KEYS)."""
+    backend = get_backend_name(backend)
+    return {"embedding_backend": backend, "embedding_model": get_model_name(backend), "embedding_dimension": get_embedding_dimension(embedding_fx, backend)}
+
+
+def collection_signature(collection: chromadb.Collection) -> Dict[str, Any]:
+    metadata = collection.metadata or {}
+    if not any(key in metadata for key in BACKEND_METADATA_KEYS):
+        return dict(LEGACY_COLLECTION_SIGNATURE)
+    return {key: metadata.get(key) for key in BACKEND_METADATA_KEYS}
+
+
+def check_collection_backend(collection: chromadb.Collection, embedding_fx: Any, backend: Optional[str] = None) -> None:
+    """Raises EmbeddingBackendMismatchError if the collection was not built with the configured backend and model."""
+    backend = get_backend_name(backend)
+    stored = collection_signature(collection)
+    if stored["embedding_backend"] == backend and stored["embedding_model"] == get_model_name(backend):
+        return
+    configured = backend_signature(embedding_fx, backend)
+    raise EmbeddingBackendMismatchError(
+        f"Collection '{collection.name}' was built with {stored['embedding_backend']}/{stored['embedding_model']} "
+        f"({stored['embedding_dimension']} dimensions) but the configured embedding backend is "
+        f"{configured['embedding_backend']}/{configured['embedding_model']} ({configured['embedding_dimension']} dimensions). "
+        "Set EMBEDDING_BACKEND/EMBEDDING_MODEL to match, or load the documents into another collection (HR_COLLECTION_NAME)."
+    )
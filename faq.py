@@ -0,0 +1,142 @@
+"""
+FAQ fast path: questions with a fixed, approved answer (sanciones, aguinaldo, bono de antigüedad...) are
+answered from faq.json instead of having the model regenerate the same text.
+
+Each entry of faq.json has:
+  - "questions": canonical phrasings (any language), compared by embedding similarity,
+  - "keywords": phrases of at least two words, all of which must appear in the question (accent/plural-insensitive,
+    see lexical_index.tokenize), tied to the canonical intent, e.g. "días de aguinaldo" rather than "aguinaldo",
+  - "answers": the stored answer per language ("spanish", "english"...).
+A question matches an entry if a keyword phrase matches and it is at least FAQ_KEYWORD_SIMILARITY similar to
+one of the canonical questions, or if it is at least FAQ_SIMILARITY similar without any keyword. The canonical
+questions are embedded in one batch when the assistant starts (or on first use if that fails).
+Without an embedding function (RETRIEVAL_MODE=lexical) similarity is the cosine of lexical_index.term_vector,
+and a keyword match needs FAQ_LEXICAL_KEYWORD_SIMILARITY instead.
+"""
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np # Installed with chromadb
+
+from lexical_index import term_vector, tokenize
+
+logger = logging.getLogger(__name__)
+
+FAQ_ENABLED = os.getenv("FAQ_FAST_PATH", "true").lower() in ['true', '1', 't']
+FAQ_PATH = Path(os.getenv("FAQ_PATH", Path(__file__).resolve().parent / "faq.json"))
+FAQ_SIMILARITY = float(os.getenv("FAQ_SIMILARITY", 0.85)) # Match on embedding similarity alone
+FAQ_KEYWORD_SIMILARITY = float(os.getenv("FAQ_KEYWORD_SIMILARITY", 0.8)) # Match when a keyword phrase is present too
+FAQ_LEXICAL_KEYWORD_SIMILARITY = float(os.getenv("FAQ_LEXICAL_KEYWORD_SIMILARITY", 0.5)) # Same, on term vectors (lexical mode)
+
+
+class FAQMatcher:
+    """Intent matcher over the entries of faq.json. Canonical question embeddings are computed once, in one batch (prepare)."""
+    def __init__(self, path: Path = FAQ_PATH, similarity: float = FAQ_SIMILARITY, keyword_similarity: float = FAQ_KEYWORD_SIMILARITY,
+                 lexical_keyword_similarity: float = FAQ_LEXICAL_KEYWORD_SIMILARITY, enabled: bool = FAQ_ENABLED):
+        self.path = path
+        self.similarity = similarity
+        self.keyword_similarity = keyword_similarity
+        self.lexical_keyword_similarity = lexical_keyword_similarity
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.entries: List[Dict[str, Any]] = []
+        self._keyword_sets: List[List[set]] = []
+        self._question_matrix: Optional[np.ndarray] = None # Normalized embeddings of all canonical questions
+        self._lexical_matrix: Optional[np.ndarray] = None # Normalized term vectors of the same questions
+        self._question_entries: List[int] = [] # Row of either matrix -> entry index
+        self.lookups = 0
+        self.hits = 0
+        self.hits_by_entry: Dict[str, int] = {}
+        if enabled:
+            self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)["entries"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"FAQ fast path disabled: could not load {self.path}: {e}")
+            entries = []
+        keyword_sets = []
+        for entry in entries:
+            entry_keyword_sets = []
+            for phrase in entry.get("keywords", []):
+                keywords = set(tokenize(phrase))
+                if len(keywords) < 2: # A single word ("aguinaldo") also appears in questions about something else
+                    logger.warning(f"FAQ entry '{entry.get('id')}': ignoring keyword '{phrase}', keyword phrases need at least two words.")
+                    continue
+                entry_keyword_sets.append(keywords)
+            keyword_sets.append(entry_keyword_sets)
+        questions = [question for entry in entries for question in entry.get("questions", [])]
+        with self._lock:
+            self.entries = entries
+            self._keyword_sets = keyword_sets
+            self._question_matrix = None
+            self._lexical_matrix = self._normalize_rows([term_vector(question) for question in questions])
+            self._question_entries = [index for index, entry in enumerate(entries) for _ in entry.get("questions", [])]
+        logger.info(f"Loaded {len(entries)} FAQ entries from {self.path}.")
+
+    def prepare(self, embed_batch: Callable[[List[str]], List[List[float]]]) -> np.ndarray:
+        """Embeds all canonical questions with one embed_batch(texts) call, unless already done."""
+        with self._lock:
+            if self._question_matrix is not None:
+                return self._question_matrix
+            entries = list(self.entries)
+        questions = [question for entry in entries for question in entry.get("questions", [])]
+        matrix = self._normalize_rows(embed_batch(questions) if questions else [])
+        with self._lock:
+            self._question_matrix = matrix
+        return matrix
+
+    @staticmethod
+    def _normalize_rows(rows: List[List[float]]) -> np.ndarray:
+        matrix = np.asarray(rows, dtype=np.float32).reshape(len(rows), -1)
+        if len(rows):
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1.0, norms)
+        return matrix
+
+    def match(self, question: str, embed: Optional[Callable[[str], List[float]]] = None,
+              embed_batch: Optional[Callable[[List[str]], List[List[float]]]] = None) -> Optional[Dict[str, Any]]:
+        """
+        The best matching entry for the question, as {"id", "answers", "similarity", "keyword"}, or None.
+        embed(text) returns the question's embedding (the callers pass the cached query embedding function);
+        embed_batch is used by prepare if the canonical questions have not been embedded yet. Without them
+        the match is lexical only.
+        """
+        if not self.enabled or not self.entries:
+            return None
+        self.lookups += 1
+        question_terms = set(tokenize(question))
+        keyword_entries = {index for index, keyword_sets in enumerate(self._keyword_sets)
+                           if any(keywords and keywords <= question_terms for keywords in keyword_sets)}
+        if embed is None or embed_batch is None:
+            matrix, question_vector, keyword_similarity = self._lexical_matrix, term_vector(question), self.lexical_keyword_similarity
+        else:
+            matrix, question_vector, keyword_similarity = self.prepare(embed_batch), embed(question), self.keyword_similarity
+        if matrix is None or not len(matrix):
+            return None
+        question_vector = np.asarray(question_vector, dtype=np.float32)
+        question_vector = question_vector / (np.linalg.norm(question_vector) or 1.0)
+        similarities = matrix @ question_vector
+
+        best: Dict[int, float] = {}
+        for row, entry_index in enumerate(self._question_entries):
+            best[entry_index] = max(best.get(entry_index, -1.0), float(similarities[row]))
+        matches = [(similarity, entry_index) for entry_index, similarity in best.items()
+                   if similarity >= (keyword_similarity if entry_index in keyword_entries else self.similarity)]
+        if not matches:
+            return None
+        similarity, entry_index = max(matches)
+        entry = self.entries[entry_index]
+        self.hits += 1
+        self.hits_by_entry[entry["id"]] = self.hits_by_entry.get(entry["id"], 0) + 1
+        return {"id": entry["id"], "answers": entry.get("answers", {}), "similarity": similarity, "keyword": entry_index in keyword_entries}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "entries": len(self.entries), "lookups": self.lookups, "hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0, "hits_by_entry": dict(self.hits_by_entry)}
@@ -0,0 +1,214 @@
+"""
+In-memory BM25 index over the chunks of the ChromaDB collection, used by HRAssistant for hybrid retrieval.
+
+Questions such as "Artículo 22", "cláusula trigésima novena" or "bono de puntualidad" hinge on exact terms
+that embeddings rank poorly. BM25Index scores chunks by those terms; reciprocal_rank_fusion merges its
+ranking with the vector search ranking.
+
+Tokenization is Spanish-aware: lowercase, accents folded (cláusula -> clausula, vacación -> vacacion),
+stopwords dropped and plurals reduced (vacaciones -> vacacion), so the user does not need to match the
+document's spelling. Numbers are kept as tokens ("22", "3.5").
+
+The index follows the collection incrementally: sync() compares chunk IDs (content hashes, so an edited
+chunk is a new ID) and only fetches the chunks that were added, which keeps re-indexing after a
+loader.py run cheap.
+"""
+import os
+import re
+import math
+import time
+import zlib
+import logging
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import chromadb
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower() # hybrid, vector or lexical
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 10)) # Hits taken from each retriever before fusion
+RRF_K = 60 # Reciprocal rank fusion constant (Cormack et al.); dampens the weight of the top ranks
+BM25_K1 = 1.2
+BM25_B = 0.75
+TERM_VECTOR_DIMENSIONS = 1024
+SYNC_FETCH_BATCH = 500 # Chunks fetched per collection.get() call when (re)building
+
+_TOKEN_PATTERN = re.compile(r'\d+(?:[.,]\d+)*|[a-zñ]+')
+_SPANISH_STOPWORDS = frozenset("""
+a al algo algun alguna algunas alguno algunos ante antes aqui asi aun cada como con contra cual cuales cuando de del desde
+donde dos el ella ellas ello ellos en entre era eran es esa esas ese eso esos esta estan estas este esto estos fue fueron
+ha hay la las le les lo los mas me mi mis muy nos o otra otras otro otros para pero por que quien se ser si sin sobre
+son su sus tal tambien te tiene tienen todo todos tu tus un una unas uno unos y ya yo
+the of and to in is are what how when which for on with do does my i
+""".split())
+
+
+def fold_accents(text: str) -> str:
+    """Lowercases and strips diacritics, keeping ñ (año and ano are different words)."""
+    text = text.lower().replace("ñ", "\0")
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return text.replace("\0", "ñ")
+
+
+def _stem(token: str) -> str:
+    """Light plural reduction, applied the same way to documents and questions."""
+    if token[0].isdigit():
+        return token
+    if len(token) > 5 and token.endswith("es") and token[-3] in "nrldjz":
+        return token[:-2] # vacaciones -> vacacion, trabajadores -> trabajador
+    if len(token) > 3 and token.endswith("s") and token[-2] in "aeiou":
+        return token[:-1] # dias -> dia, clausulas -> clausula
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    return [_stem(token) for token in _TOKEN_PATTERN.findall(fold_accents(text)) if token not in _SPANISH_STOPWORDS]
+
+
+def term_vector(text: str, dimensions: int = TERM_VECTOR_DIMENSIONS) -> List[float]:
+    """
+    Term counts of tokenize(text), feature-hashed into a fixed-size vector. Their cosine similarity is the
+    stand-in for embedding similarity in RETRIEVAL_MODE=lexical, which makes no embedding calls.
+    """
+    vector = [0.0] * dimensions
+    for token in tokenize(text):
+        vector[zlib.crc32(token.encode("utf-8")) % dimensions] += 1.0
+    return vector
+
+
+class BM25Index:
+    """
+    Inverted index (term -> {chunk ID: term frequency}) with Okapi BM25 scoring. Documents and metadata
+    are kept so lexical hits can be returned without going back to ChromaDB.
+    """
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._postings: Dict[str, Dict[str, int]] = {}
+        self._doc_lengths: Dict[str, int] = {}
+        self._doc_terms: Dict[str, Counter] = {} # Needed to remove a chunk from the postings
+        self._documents: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self._total_length = 0
+        self.index_version: Optional[int] = None # Index version of the collection at the last sync
+        self.syncs = 0
+        self.added = 0
+        self.removed = 0
+        self.last_sync_seconds = 0.0
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def _add(self, chunk_id: str, document: str, metadata: Dict[str, Any]) -> None:
+        terms = Counter(tokenize(document or ""))
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[chunk_id] = frequency
+        length = sum(terms.values())
+        self._doc_terms[chunk_id] = terms
+        self._doc_lengths[chunk_id] = length
+        self._documents[chunk_id] = (document, metadata or {})
+        self._total_length += length
+
+    def _remove(self, chunk_id: str) -> None:
+        for term in self._doc_terms.pop(chunk_id, ()):
+            postings = self._postings[term]
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._doc_lengths.pop(chunk_id, 0)
+        self._documents.pop(chunk_id, None)
+
+    def add_documents(self, ids: Sequence[str], documents: Sequence[str], metadatas: Optional[Sequence[Dict[str, Any]]] = None) -> None:
+        metadatas = metadatas or [{}] * len(ids)
+        with self._lock:
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                if chunk_id in self._doc_lengths:
+                    self._remove(chunk_id)
+                self._add(chunk_id, document, metadata)
+            self.added += len(ids)
+
+    def remove_documents(self, ids: Iterable[str]) -> None:
+        with self._lock:
+            for chunk_id in ids:
+                if chunk_id in self._doc_lengths:
+                    self._remove(chunk_id)
+                    self.removed += 1
+
+    def sync(self, collection: chromadb.Collection, index_version: int) -> bool:
+        """
+        Brings the index in line with the collection if the index version changed since the last sync (or
+        on the first call). Only new chunks are fetched. Returns True if the index was synced.
+        """
+        if index_version == self.index_version:
+            return False
+        start = time.perf_counter()
+        current_ids = set(collection.get(include=[])["ids"])
+        with self._lock:
+            known_ids = set(self._doc_lengths)
+        stale_ids = known_ids - current_ids
+        new_ids = sorted(current_ids - known_ids)
+        self.remove_documents(stale_ids)
+        for batch_start in range(0, len(new_ids), SYNC_FETCH_BATCH):
+            batch = collection.get(ids=new_ids[batch_start:batch_start + SYNC_FETCH_BATCH], include=["documents", "metadatas"])
+            self.add_documents(batch["ids"], batch["documents"], batch["metadatas"])
+        self.index_version = index_version
+        self.syncs += 1
+        self.last_sync_seconds = time.perf_counter() - start
+        logger.info(f"Lexical index synced to index version {index_version}: +{len(new_ids)} / -{len(stale_ids)} chunks, "
+                    f"{len(self)} total, {len(self._postings)} terms ({self.last_sync_seconds:.2f}s).")
+        return True
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        """(chunk ID, BM25 score) of the best top_k chunks for the query, best first."""
+        start = time.perf_counter()
+        query_terms = set(tokenize(query))
+        scores: Dict[str, float] = {}
+        with self._lock:
+            doc_count = len(self._doc_lengths)
+            if doc_count and query_terms:
+                average_length = self._total_length / doc_count
+                for term in query_terms:
+                    postings = self._postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for chunk_id, frequency in postings.items():
+                        length_norm = 1 - self.b + self.b * self._doc_lengths[chunk_id] / average_length
+                        scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - start
+        return ranked
+
+    def idf(self, term: str) -> float:
+        """BM25 IDF of a (tokenized) term; terms not in the index get the maximum."""
+        with self._lock:
+            doc_count = len(self._doc_lengths)
+            frequency = len(self._postings.get(term, ()))
+        return math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+
+    def get_document(self, chunk_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            return self._documents.get(chunk_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "documents": len(self._doc_lengths), "terms": len(self._postings), "index_version": self.index_version,
+                "syncs": self.syncs, "added": self.added, "removed": self.removed, "last_sync_seconds": round(self.last_sync_seconds, 3),
+                "searches": self.searches, "avg_search_microseconds": round(self.search_seconds / self.searches * 1e6, 1) if self.searches else 0.0,
+            }
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Merges rankings of chunk IDs (best first) by summing 1 / (k + rank). Returns (chunk ID, score), best first."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
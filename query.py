@@ -1,21 +1,64 @@
 import chromadb
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
-from openai import OpenAI, Timeout
+from openai import OpenAI, AsyncOpenAI, Timeout
 import os
-from typing import Generator, Union, List, Dict # Added Dict for type hinting
+import re
+import asyncio
+import functools
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import Executor
+from typing import Any, AsyncGenerator, AsyncIterator, Generator, Optional, Tuple, Union, List, Dict # Added Dict for type hinting
 from pathlib import Path # Import the Path object from pathlib import Path # Added for DB_DIR consistency
 import logging # Added for logging
 
+import embeddings # Embedding backend shared with loader.py (EMBEDDING_BACKEND: openai, local, onnx)
+import sections # Article/clause references, shared with loader.py
+from caches import QueryEmbeddingCache, QUERY_EMBEDDING_CACHE_ENABLED, QUERY_EMBEDDING_CACHE_PATH, QUERY_EMBEDDING_CACHE_MEMORY_ENTRIES, QUERY_EMBEDDING_CACHE_DISK_ENTRIES
+from caches import SENTENCE_EMBEDDING_CACHE_PATH, SENTENCE_EMBEDDING_CACHE_MEMORY_ENTRIES, SENTENCE_EMBEDDING_CACHE_DISK_ENTRIES
+from caches import SemanticAnswerCache, ANSWER_CACHE_ENABLED, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS
+from caches import ClientPool, hash_api_key, CLIENT_POOL_SIZE, API_KEY_VALIDATION_TTL_SECONDS
+from lexical_index import BM25Index, reciprocal_rank_fusion, term_vector, RETRIEVAL_MODE, HYBRID_CANDIDATES
+from context_assembly import ContextAssembler, ContextCompressor, HistoryCompactor, get_tokenizer, CONTEXT_TOKEN_BUDGET, CONTEXT_CANDIDATES
+from context_assembly import HISTORY_SUMMARY_MAX_TOKENS
+from faq import FAQMatcher
+
 # --- Setup Logging ---
 # Consistent logging setup with loader.py for easier debugging if needed
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Static instructions, sent once as the system message. Nothing request-specific goes in here: an identical
+# prefix on every request lets the provider reuse its prompt cache (and it is counted only once, at startup).
+SYSTEM_PROMPT = """Eres un asistente especializado en Recursos Humanos de HISENSE ELECTRÓNICA MÉXICO, S.A. DE C.V.
+Tu función es responder preguntas basándote exclusivamente en la información contenida en los siguientes documentos:
+- Contrato Colectivo de Trabajo 2024.
+- Reglamento Interno de Trabajo (RIT) 2024.
+Los fragmentos relevantes de esos documentos se incluyen en el mensaje del usuario, después de "Contexto:".
+
+Instrucciones:
+1. Responde de manera clara, precisa y fundamentada en los documentos mencionados.
+2. Si la respuesta no se encuentra en los documentos, indica claramente que no hay información disponible.
+3. Siempre responde en el mismo idioma en que se formuló la pregunta (español o inglés).
+4. Evita suposiciones o información externa a los documentos proporcionados.
+5. En caso de preguntas sobre procedimientos, derechos u obligaciones, cita la cláusula o artículo correspondiente.
+6. Si la pregunta es sobre un documento específico, menciona el nombre del documento y la sección relevante.
+7. Mencionar en que parte del documento se encuentra la respuesta.
+8. Cuando pregunte de beneficios dime todos los que esten en el contrato colectivo.
+9. **Formato:**
+   - Organiza la respuesta de manera clara.
+   - Usa listas cuando sea necesario para darle forma a las respuestas.
+   - Decirme al ultimo la fuente de la respuesta, SOLO con el nombre del documento doxc o pdf, NO MENCIONAR LA SECCIÓN. NO MENCIONAR EL CAPITULO.
+10. **Contexto:**
+   Si pregunto ¿Qué hago si creo que mi jefe está incumpliendo el contrato colectivo? anadir tambien el nombre de la persona."""
+
 
 class HRAssistant:
     # MODIFICACIÓN: El constructor ahora requiere una clave para Chroma y opcionalmente una para chat.
-    def __init__(self, chroma_api_key: str, default_chat_api_key: str = None):
-        if not chroma_api_key:
+    def __init__(self, chroma_api_key: str = None, default_chat_api_key: str = None, conversation_store: Any = None):
+        # Only the OpenAI embedding backend needs a key; local backends embed queries on the CPU.
+        if not chroma_api_key and embeddings.backend_requires_api_key():
             raise ValueError("A ChromaDB API key (chroma_api_key) is required for initialization.")
         
         # Configuration
@@ -23,186 +66,470 @@ class HRAssistant:
         self.BASE_DIR = Path(__file__).resolve().parent # Consistent path definition
         self.DB_DIR = str(self.BASE_DIR / "chroma_db_hr_ocr") # MATCHES loader.py CHROMA_DB_DIR
         self.OPENAI_CHAT_MODEL = "gpt-4.1-mini-2025-04-14" # Chat model
-        self.OPENAI_EMBEDDING_MODEL = "text-embedding-3-large" # MATCHES loader.py EMBEDDING_MODEL_NAME
-        self.collection_name = "hr_documents_ocr_production_v1" # MATCHES loader.py COLLECTION_NAME
+        self.EMBEDDING_BACKEND = embeddings.get_backend_name() # MATCHES loader.py (same EMBEDDING_BACKEND setting)
+        self.OPENAI_EMBEDDING_MODEL = embeddings.get_model_name() # MATCHES loader.py EMBEDDING_MODEL_NAME
+        self.collection_name = os.getenv("HR_COLLECTION_NAME", "hr_documents_ocr_production_v1") # MATCHES loader.py COLLECTION_NAME
+        self.MANIFEST_PATH = self.BASE_DIR / "ingestion_manifest.sqlite3" # MATCHES loader.py MANIFEST_PATH
+        self.WATCHER_STALE_SECONDS = 60 # A watcher without a heartbeat for this long is reported as not running
 
         # Initialize ChromaDB client (does not require API key for this step)
         # This assumes the DB directory and collection will be created/populated by loader.py
         self.client_chroma = chromadb.PersistentClient(path=self.DB_DIR)
+        self._client_lock = threading.Lock()
+        self._backend_checked = False # Set once the collection's embedding backend has been verified
+        self._collection = None # Collection handle reused across requests; reset when the client is reloaded
+        self.collection_lookups = 0
+        self.collection_reuses = 0
+        # Long-lived clients per API key: reusing them keeps their HTTP connections (and TLS sessions) open.
+        self.openai_clients = ClientPool("openai", lambda key: OpenAI(api_key=key, timeout=Timeout(30.0, connect=5.0)), CLIENT_POOL_SIZE)
+        self.async_openai_clients = ClientPool( # For ask_question_async; only used from the server's event loop
+            "async_openai", lambda key: AsyncOpenAI(api_key=key, timeout=Timeout(30.0, connect=5.0)), CLIENT_POOL_SIZE
+        )
+        self.embedding_functions = ClientPool(
+            "embedding", lambda key: embeddings.get_embedding_function(api_key=key or None, backend=self.EMBEDDING_BACKEND), CLIENT_POOL_SIZE
+        )
+        self._validated_keys: Dict[str, float] = {} # hash_api_key(key) -> time of the last successful models.list()
+        self._validated_keys_lock = threading.Lock()
+        self.key_validations = 0
+        self.key_validation_cache_hits = 0
+        self.RETRIEVAL_MODE = RETRIEVAL_MODE # hybrid (BM25 + vector, fused), vector or lexical
+        self.lexical_index = BM25Index()
+        self.tokenizer = get_tokenizer(self.OPENAI_CHAT_MODEL)
+        self.context_assembler = ContextAssembler(lambda text: len(self.tokenizer.encode(text)), CONTEXT_TOKEN_BUDGET)
+        self.context_compressor = ContextCompressor(lambda text: len(self.tokenizer.encode(text))) # CONTEXT_COMPRESSION turns it off
+        # HISTORY_TOKEN_BUDGET; summaries of older turns are kept in the web app's conversation store (conversations.py)
+        self.history_compactor = HistoryCompactor(lambda text: len(self.tokenizer.encode(text)), summary_store=conversation_store)
+        self.system_prompt_tokens = len(self.tokenizer.encode(SYSTEM_PROMPT)) # Same on every request, so counted once
+        self.prompt_requests = 0
+        self.prompt_tokens_total = 0
+        self.prompt_cached_tokens = 0 # Prompt tokens the provider served from its prefix cache (usage.prompt_tokens_details)
+        self._section_index: Dict[str, List[str]] = {} # "clausula:39" -> chunk IDs, from loader.py's manifest
+        self._section_index_state = None # (index version, last run) the section index was read at
+        self.section_lookups = 0
+        self.query_embedding_cache = QueryEmbeddingCache(
+            QUERY_EMBEDDING_CACHE_PATH, QUERY_EMBEDDING_CACHE_MEMORY_ENTRIES, QUERY_EMBEDDING_CACHE_DISK_ENTRIES, enabled=QUERY_EMBEDDING_CACHE_ENABLED
+        )
+        self.sentence_embedding_cache = QueryEmbeddingCache(
+            SENTENCE_EMBEDDING_CACHE_PATH, SENTENCE_EMBEDDING_CACHE_MEMORY_ENTRIES, SENTENCE_EMBEDDING_CACHE_DISK_ENTRIES, enabled=QUERY_EMBEDDING_CACHE_ENABLED
+        )
+        self.answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS, enabled=ANSWER_CACHE_ENABLED)
+        self.faq = FAQMatcher() # Canned answers from faq.json (FAQ_PATH); FAQ_FAST_PATH turns it off
+        self._index_version = self.get_index_state()["index_version"]
         
         # MODIFICACIÓN: Almacenamos las claves con nombres claros
         self._chroma_api_key = chroma_api_key
         self._default_chat_api_key = default_chat_api_key
 
+        if self.RETRIEVAL_MODE != "vector":
+            try: # Build the lexical index now so the first question doesn't pay for it
+                self._sync_lexical_index(self._get_chroma_collection(api_key=chroma_api_key))
+            except Exception as e: # Collection not created yet, etc.; retried on the first question
+                logger.warning(f"Lexical index not built at startup: {e}")
+        if self.faq.enabled and self.RETRIEVAL_MODE != "lexical":
+            try: # One batched call for the canonical FAQ questions (kept in the sentence embedding cache across restarts)
+                self.faq.prepare(lambda texts: self._embed_sentences(texts, chroma_api_key))
+            except Exception as e: # No embedding key yet, etc.; retried on the first question
+                logger.warning(f"FAQ questions not embedded at startup: {e}")
+
         logger.info(f"HRAssistant initialized. ChromaDB path: {self.DB_DIR}, Collection: {self.collection_name}")
         logger.info(f"Expecting collection '{self.collection_name}' to be populated by loader.py.")
 
 
     def _get_openai_client(self, api_key: str) -> OpenAI:
-        """Helper to get an OpenAI client instance with a timeout."""
+        """Helper to get the pooled OpenAI client (30-second timeout) for an API key."""
         if not api_key:
             raise ValueError("API key is required to initialize OpenAI client.")
-        # Add a 30-second timeout to API calls
-        return OpenAI(api_key=api_key, timeout=Timeout(30.0, connect=5.0))
+        return self.openai_clients.get(api_key)
 
-    def _get_embedding_function(self, api_key: str) -> OpenAIEmbeddingFunction:
-        """Helper to get an OpenAIEmbeddingFunction instance."""
+    def get_openai_client(self, api_key: str) -> OpenAI:
+        """Pooled OpenAI client for other routes (e.g. translation); use with_options() to change the timeout."""
+        return self._get_openai_client(api_key)
+
+    def get_async_openai_client(self, api_key: str) -> AsyncOpenAI:
+        """Pooled AsyncOpenAI client, for routes served by asgi_app.py."""
         if not api_key:
+            raise ValueError("API key is required to initialize OpenAI client.")
+        return self.async_openai_clients.get(api_key)
+
+    def validate_api_key(self, api_key: str) -> None:
+        """
+        Checks an API key with models.list(). Keys that passed within API_KEY_VALIDATION_TTL_SECONDS are
+        not checked again. Raises the OpenAI error if the key is invalid.
+        """
+        key_hash = hash_api_key(api_key)
+        with self._validated_keys_lock:
+            validated_at = self._validated_keys.get(key_hash)
+            if validated_at is not None and time.time() - validated_at < API_KEY_VALIDATION_TTL_SECONDS:
+                self.key_validation_cache_hits += 1
+                return
+        try:
+            self._get_openai_client(api_key).with_options(timeout=Timeout(15.0, connect=5.0)).models.list()
+        except Exception:
+            self.openai_clients.discard(api_key) # Don't keep a client for a key that doesn't work
+            self.embedding_functions.discard(api_key)
+            with self._validated_keys_lock:
+                self._validated_keys.pop(key_hash, None)
+            raise
+        with self._validated_keys_lock:
+            self.key_validations += 1
+            self._validated_keys[key_hash] = time.time()
+            if len(self._validated_keys) > CLIENT_POOL_SIZE * 4: # Forget the oldest validations
+                for old_hash, _ in sorted(self._validated_keys.items(), key=lambda item: item[1])[:len(self._validated_keys) // 2]:
+                    del self._validated_keys[old_hash]
+
+    def _get_embedding_function(self, api_key: str) -> Any:
+        """Helper to get the embedding function of the configured backend (OpenAI or CPU-local)."""
+        if not api_key and embeddings.backend_requires_api_key(self.EMBEDDING_BACKEND):
             raise ValueError("API key is required to initialize OpenAIEmbeddingFunction.")
-        return OpenAIEmbeddingFunction(
-            api_key=api_key,
-            model_name=self.OPENAI_EMBEDDING_MODEL
-        )
+        # Local backends ignore the key, so they share a single pooled instance.
+        return self.embedding_functions.get(api_key if embeddings.backend_requires_api_key(self.EMBEDDING_BACKEND) else "")
+
+    def get_index_state(self) -> Dict[str, Any]:
+        """
+        Reads the index state that loader.py records in its manifest: the index version (bumped whenever
+        a load or watch-mode run changes the collection), the last run and whether a watcher is running.
+        """
+        state = {"index_version": 0, "changed_at": None, "last_run_at": None, "last_run_stats": None, "watcher_running": False, "watcher_heartbeat_at": None}
+        if not self.MANIFEST_PATH.exists():
+            return state
+        try:
+            conn = sqlite3.connect(f"file:{self.MANIFEST_PATH}?mode=ro", uri=True, timeout=5)
+            try:
+                row = conn.execute(
+                    "SELECT index_version, changed_at, last_run_at, last_run_stats, watcher_pid, watcher_heartbeat_at FROM index_state WHERE collection_name = ?",
+                    (self.collection_name,)
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e: # Manifest from before index_state existed, or locked
+            logger.debug(f"Could not read index state from {self.MANIFEST_PATH}: {e}")
+            return state
+        if row:
+            heartbeat_at = row[5]
+            state.update(
+                index_version=row[0], changed_at=row[1], last_run_at=row[2], last_run_stats=json.loads(row[3]) if row[3] else None,
+                watcher_running=bool(row[4] and heartbeat_at and time.time() - heartbeat_at < self.WATCHER_STALE_SECONDS),
+                watcher_heartbeat_at=heartbeat_at
+            )
+        return state
+
+    def _refresh_client_if_index_changed(self) -> None:
+        """
+        Reconnects to ChromaDB when the loader (e.g. running in watch mode) has changed the index since we
+        connected: the persistent client keeps its vector index in memory and does not see writes made by
+        another process.
+        """
+        index_version = self.get_index_state()["index_version"]
+        if index_version == self._index_version:
+            return
+        with self._client_lock:
+            if index_version == self._index_version:
+                return
+            logger.info(f"Index version changed ({self._index_version} -> {index_version}). Reloading ChromaDB client.")
+            self.client_chroma.clear_system_cache()
+            self.client_chroma = chromadb.PersistentClient(path=self.DB_DIR)
+            self._index_version = index_version
+            self._collection = None # The handle belongs to the old client
+            self._backend_checked = False # The collection may have been rebuilt
 
     def _get_chroma_collection(self, api_key: str) -> chromadb.Collection:
         """
         Helper to get the ChromaDB collection using the provided API key
         for the embedding function (needed for querying).
         """
-        if not api_key:
+        if not api_key and embeddings.backend_requires_api_key(self.EMBEDDING_BACKEND):
             raise ValueError("API key is required to access ChromaDB collection with embeddings.")
         
-        embedding_fn = self._get_embedding_function(api_key=api_key)
-        
-        # Get the collection. It's assumed loader.py created it.
-        # If it doesn't exist, this will create an empty one, leading to "no documents found".
-        try:
-            collection = self.client_chroma.get_collection( # Use get_collection; loader handles creation
-                name=self.collection_name,
-                embedding_function=embedding_fn # Pass embedding function for query compatibility
-            )
-            logger.debug(f"Successfully retrieved collection: {self.collection_name}")
+        self._refresh_client_if_index_changed()
+        collection = self._collection
+        if collection is not None:
+            self.collection_reuses += 1
             return collection
-        except Exception as e: # Catch if collection doesn't exist or other issues
-            logger.error(f"Error getting collection '{self.collection_name}': {e}", exc_info=True)
-            logger.error(f"Please ensure 'loader.py' has been run successfully to create and populate the collection.")
-            # Raising an error might be better than returning None or an empty shell.
-            raise ConnectionError(f"Could not access ChromaDB collection '{self.collection_name}'. "
-                                  "Ensure it has been created and populated by the loader script.") from e
-
 
-    def _build_prompt(self, question: str, context: str, conversation_history: List[Dict[str, str]], language: str) -> str:
-        """Construct the prompt with context and conversation history."""
+        with self._client_lock:
+            if self._collection is not None:
+                self.collection_reuses += 1
+                return self._collection
+            # Queries pass precomputed query_embeddings, so the handle's embedding function is only used for the
+            # backend check; whichever key opens the collection first is fine for every user.
+            embedding_fn = self._get_embedding_function(api_key=api_key)
+
+            # Get the collection. It's assumed loader.py created it.
+            # If it doesn't exist, this will create an empty one, leading to "no documents found".
+            try:
+                collection = self.client_chroma.get_collection( # Use get_collection; loader handles creation
+                    name=self.collection_name,
+                    embedding_function=embedding_fn # Pass embedding function for query compatibility
+                )
+                self.collection_lookups += 1
+                logger.debug(f"Successfully retrieved collection: {self.collection_name}")
+            except Exception as e: # Catch if collection doesn't exist or other issues
+                logger.error(f"Error getting collection '{self.collection_name}': {e}", exc_info=True)
+                logger.error(f"Please ensure 'loader.py' has been run successfully to create and populate the collection.")
+                # Raising an error might be better than returning None or an empty shell.
+                raise ConnectionError(f"Could not access ChromaDB collection '{self.collection_name}'. "
+                                      "Ensure it has been created and populated by the loader script.") from e
+
+            if not self._backend_checked:
+                try:
+                    # Query vectors from another model would silently return unrelated chunks (or fail on dimension).
+                    embeddings.check_collection_backend(collection, embedding_fn, backend=self.EMBEDDING_BACKEND)
+                except embeddings.EmbeddingBackendMismatchError as e:
+                    logger.error(str(e))
+                    raise ConnectionError(str(e)) from e
+                self._backend_checked = True
+            self._collection = collection
+        return collection
+
+
+    def _build_prompt(self, question: str, context: str, conversation_history: List[Dict[str, str]], language: str,
+                      history_summary: Optional[str] = None) -> Dict[str, str]:
+        """
+        The variable parts of the user message: retrieved context, conversation history (summary of the older
+        turns, then the recent ones) and question. They follow SYSTEM_PROMPT in this order, so requests share
+        the longest possible prefix.
+        """
         history_prompt = ""
+        if history_summary:
+            history_prompt += f"Summary of the earlier conversation:\n{history_summary}\n\n"
         if conversation_history: # Ensure conversation_history is not None
-            history_prompt = "\n\nPrevious conversation:\n"
-            for msg in conversation_history:
-                role = "User" if msg.get('role') == 'user' else "Assistant" # Use .get for safety
-                content = msg.get('content', '')
-                history_prompt += f"{role}: {content}\n"
-
-        # This is the prompt template from your original query.py
-        return f"""Eres un asistente especializado en Recursos Humanos de HISENSE ELECTRÓNICA MÉXICO, S.A. DE C.V. 
-        Tu función es responder preguntas basándote exclusivamente en la información contenida en los siguientes documentos:
-        - Contrato Colectivo de Trabajo 2024.
-        - Reglamento Interno de Trabajo (RIT) 2024.
-
-        Instrucciones:
-        1. Responde de manera clara, precisa y fundamentada en los documentos mencionados.
-        2. Si la respuesta no se encuentra en los documentos, indica claramente que no hay información disponible.
-        3. Siempre responde en el mismo idioma en que se formuló la pregunta (español o inglés).
-        4. Evita suposiciones o información externa a los documentos proporcionados.
-        5. En caso de preguntas sobre procedimientos, derechos u obligaciones, cita la cláusula o artículo correspondiente.
-        6. Si la pregunta es sobre un documento específico, menciona el nombre del documento y la sección relevante.
-        7. Mencionar en que parte del documento se encuentra la respuesta.
-        8. Cuando pregunte de beneficios dime todos los que esten en el contrato colectivo 
-        
-        8. **Formato:** - Organiza la respuesta de manera clara. 
-           - Usa listas cuando sea necesario para darle forma a las respuestas
-           - Decirme al ultimo la fuente de la respuesta, SOLO con el nombre del documento doxc o pdf, NO MNENCIONAR LA SECCIÓN. NO MENCIONAR EL CAPITULO.  
-           
-        9. **Contexto:**
-        Si me preguntan ¿Cuáles son las sanciones por llegar tarde, ausentarse o incumplir con mis deberes? contestar lo siguiente:
-        Sanciones por llegar tarde (Retardos)
-Primer retardo en 30 días: Amonestación verbal.
-Segundo retardo en 30 días: Suspensión de 1 día sin goce de sueldo.
-Tercer retardo en 30 días: Suspensión de 2 días sin goce de sueldo.
-Cuarto retardo en 30 días: Suspensión de 3 días sin goce de sueldo.
-Acumular 3 suspensiones por retardos en 6 meses: Suspensión de hasta 8 días sin goce de sueldo.
-Más de 5 minutos de retardo: Se considera falta injustificada (Artículo 22).
-Además, se reduce el bono de puntualidad proporcionalmente a los retardos incurridos durante la semana (Artículo 79).
-
-Sanciones por ausentarse (Faltas injustificadas)
-Primera falta en 30 días: Amonestación por escrito.
-Segunda falta en 30 días: Suspensión de hasta 4 días sin goce de sueldo.
-Tercera falta en 30 días: Suspensión de hasta 8 días sin goce de sueldo.
-Cuarta falta en 30 días: Terminación de la relación laboral sin responsabilidad para la empresa (Artículo 47, Fracción X de la LFT).
-Faltar un día antes o después de días de descanso/vacaciones: Suspensión de hasta 5 días sin goce de sueldo (Artículo 80).
-El trabajador pierde la parte proporcional del bono de asistencia por cada falta (Artículo 80).
-
-Sanciones por incumplir con los deberes
-Las sanciones varían según la gravedad de la falta:
-Faltas leves:
-Amonestación verbal (primera vez).
-Amonestación por escrito (segunda vez).
-Suspensión de 1 día (tercera vez).
-Suspensión de 2 días (cuarta vez).
-Suspensión de 3 a 8 días (quinta vez en adelante).
-Faltas graves:
-Suspensión de hasta 8 días sin goce de sueldo desde la primera ocasión (Artículo 70).
-Causas de rescisión (sin responsabilidad para la empresa):
-Negligencia grave, daños a equipos, robo, acoso, violencia laboral, revelar secretos industriales, entre otras (Artículo 83).
-
-Procedimiento para justificar faltas
-Para evitar que una ausencia sea considerada injustificada, el trabajador debe:
-En caso de permiso: Obtener autorización por escrito del supervisor.
-En caso de enfermedad/accidente: Presentar incapacidad del IMSS el mismo día de su expedición (Artículo 72).
-
-Nota importante
-Las sanciones se aplican considerando la gravedad de la falta y el historial del trabajador. El trabajador tiene derecho a ser escuchado en su defensa antes de cualquier sanción (Artículo 77).
-
-Fuente: Capítulos XII y XIII del Reglamento Interno de Trabajo 2024.
-
-Si pregunto ¿Qué hago si creo que mi jefe está incumpliendo el contrato colectivo? anadir tambien el nombre de la persona.
-
-Si pregunto: Cuantos dias de aguinaldo me corresponden? Contestar lo siguiente: 
-El aguinaldo que te corresponde según el Contrato Colectivo de Trabajo 2024 es:
-Un aguinaldo anual equivalente a 16 días de salario.
-Este pago debe realizarse antes del día 20 de diciembre de cada año.
-Para quienes no hayan cumplido un año completo de servicio, el aguinaldo se paga proporcionalmente al tiempo trabajado.
-Fuente: Contrato Colectivo de Trabajo 2024, cláusula Décima Sexta
-
-Si pregunto: Como funciona el bono de antiguedad? contestar lo siguiente:
-El bono de antigüedad en HISENSE ELECTRÓNICA MÉXICO, S.A. DE C.V. funciona de la siguiente manera, según el Contrato Colectivo de Trabajo 2024:
-
-A los trabajadores que superen 3 meses de antigüedad se les otorga un bono único de $50.00 pesos.
-A los que superen 6 meses de antigüedad, un bono único de $70.00 pesos.
-A los que superen 9 meses de antigüedad, un bono único de $90.00 pesos.
-A los que superen 12 meses de antigüedad, un bono único de $100.00 pesos.
-A los que superen 24 meses de antigüedad, un bono único de $120.00 pesos.
-A los que superen 36 meses de antigüedad, un bono único de $140.00 pesos.
-A los que superen del cuarto al octavo año de antigüedad, un bono único anual de $160.00 pesos.
-Este bono se paga de manera proporcional conforme a la antigüedad del trabajador.
-
-Fuente: Contrato Colectivo de Trabajo 2024, cláusula trigésima novena
-{context}
-{history_prompt}
-
-Question:
-{question}
-
-Answer in {language}:
-"""
-
-    def _get_context_from_db(self, question: str, api_key: str, top_k: int = 3) -> Union[str, None]:
-        """Retrieve relevant context from ChromaDB using the provided API key for embeddings."""
-        if not api_key:
+            history_prompt += "Previous conversation:\n"
+            history_prompt += "".join(HistoryCompactor.format_message(msg) for msg in conversation_history)
+            history_prompt += "\n"
+        return {
+            "context": f"Contexto:\n{context}\n\n",
+            "history": history_prompt,
+            "question": f"Question:\n{question}\n\nAnswer in {language}:\n",
+        }
+
+    def _build_messages(self, question: str, context: str, conversation_history: List[Dict[str, str]], language: str,
+                        history_summary: Optional[str] = None) -> List[Dict[str, str]]:
+        """Chat messages for a question (SYSTEM_PROMPT, then the user message). Logs the prompt's token breakdown."""
+        parts = self._build_prompt(question, context, conversation_history, language, history_summary)
+        part_tokens = {name: len(self.tokenizer.encode(text)) for name, text in parts.items()}
+        total_tokens = self.system_prompt_tokens + sum(part_tokens.values())
+        self.prompt_requests += 1
+        self.prompt_tokens_total += total_tokens
+        logger.info(f"Prompt tokens: {total_tokens} (system {self.system_prompt_tokens}, context {part_tokens['context']}, "
+                    f"history {part_tokens['history']}, question {part_tokens['question']}).")
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": "".join(parts.values())},
+        ]
+
+    def _embed_query(self, question: str, api_key: str) -> List[float]:
+        """Question embedding from the query embedding cache, or from the embedding backend on a miss."""
+        cache_model = f"{self.EMBEDDING_BACKEND}:{self.OPENAI_EMBEDDING_MODEL}"
+        query_embedding = self.query_embedding_cache.get(cache_model, question)
+        if query_embedding is not None:
+            logger.debug(f"Query embedding cache hit for: '{question}'")
+            return query_embedding
+        start = time.perf_counter()
+        query_embedding = [float(value) for value in self._get_embedding_function(api_key=api_key)([question])[0]]
+        self.query_embedding_cache.put(cache_model, question, query_embedding, time.perf_counter() - start)
+        return query_embedding
+
+    def _question_vector(self, question: str) -> List[float]:
+        """Vector for the FAQ match and the answer cache key: the query embedding, or a term vector in lexical mode (no embedding call)."""
+        if self.RETRIEVAL_MODE == "lexical":
+            return term_vector(question)
+        return self._embed_query(question, self._chroma_api_key)
+
+    def _embed_sentences(self, sentences: List[str], api_key: str) -> List[List[float]]:
+        """Sentence embeddings for context compression: cached ones from the sentence cache, the rest in one batch."""
+        cache_model = f"{self.EMBEDDING_BACKEND}:{self.OPENAI_EMBEDDING_MODEL}"
+        sentence_embeddings = [self.sentence_embedding_cache.get(cache_model, sentence) for sentence in sentences]
+        missing = [index for index, embedding in enumerate(sentence_embeddings) if embedding is None]
+        if missing:
+            start = time.perf_counter()
+            new_embeddings = self._get_embedding_function(api_key=api_key)([sentences[index] for index in missing])
+            embed_seconds = (time.perf_counter() - start) / len(missing)
+            for index, embedding in zip(missing, new_embeddings):
+                sentence_embeddings[index] = [float(value) for value in embedding]
+                self.sentence_embedding_cache.put(cache_model, sentences[index], sentence_embeddings[index], embed_seconds)
+        return sentence_embeddings
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return {"query_embedding": self.query_embedding_cache.stats(), "sentence_embedding": self.sentence_embedding_cache.stats(), "answer": self.answer_cache.stats(),
+                "faq": self.faq.stats()}
+
+    def get_retrieval_stats(self) -> Dict[str, Any]:
+        return {"mode": self.RETRIEVAL_MODE, "hybrid_candidates": HYBRID_CANDIDATES, "lexical_index": self.lexical_index.stats(),
+                "section_index": {"sections": len(self._section_index), "lookups": self.section_lookups},
+                "compression": self.context_compressor.stats(), "context": self.context_assembler.stats(),
+                "history": self.history_compactor.stats(),
+                "prompt": {"system_tokens": self.system_prompt_tokens, "requests": self.prompt_requests, "cached_tokens": self.prompt_cached_tokens,
+                           "avg_tokens": round(self.prompt_tokens_total / self.prompt_requests, 1) if self.prompt_requests else 0.0}}
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """Sizes and reuse counts of the client pools, the collection handle and the API key validation cache."""
+        with self._validated_keys_lock:
+            validated_keys = len(self._validated_keys)
+        return {
+            "openai_clients": self.openai_clients.stats(),
+            "async_openai_clients": self.async_openai_clients.stats(),
+            "embedding_functions": self.embedding_functions.stats(),
+            "collection_handle": {"lookups": self.collection_lookups, "reused": self.collection_reuses},
+            "api_key_validation": {"validated_keys": validated_keys, "validations": self.key_validations,
+                                   "cache_hits": self.key_validation_cache_hits, "ttl_seconds": API_KEY_VALIDATION_TTL_SECONDS},
+        }
+
+    def _summarize_history(self, previous_summary: Optional[str], messages: List[Dict[str, str]], api_key: str) -> str:
+        """Rolling summary: the previous summary (if any) extended with messages that no longer fit in the history budget."""
+        transcript = "".join(HistoryCompactor.format_message(msg) for msg in messages)
+        prompt = (f"Resumen previo de la conversación:\n{previous_summary}\n\n" if previous_summary else "") + f"Mensajes nuevos:\n{transcript}"
+        start = time.perf_counter()
+        response = self._get_openai_client(api_key).chat.completions.create(
+            model=self.OPENAI_CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": "Resume la conversación entre un trabajador y el asistente de Recursos Humanos en pocas líneas, "
+                                              "en el idioma de la conversación. Conserva los temas consultados, los datos del trabajador y las "
+                                              "cifras, artículos o cláusulas mencionados. Responde solo con el resumen."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.0,
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS
+        )
+        logger.info(f"Summarized {len(messages)} older messages in {time.perf_counter() - start:.2f}s.")
+        return response.choices[0].message.content.strip()
+
+    @staticmethod
+    def _has_prior_turns(question: str, conversation_history: List[Dict[str, str]]) -> bool:
+        """True if the history holds anything besides the question being asked (follow-ups depend on it)."""
+        return any(not (msg.get('role') == 'user' and msg.get('content') == question) for msg in conversation_history)
+
+    def _sync_lexical_index(self, collection: chromadb.Collection) -> None:
+        """Updates the BM25 index with the chunks loader.py added or removed since the last sync (no-op if none)."""
+        self.lexical_index.sync(collection, self._index_version)
+
+    def lexical_search(self, question: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        """BM25-only search: no embedding call and no ChromaDB query, so it answers in microseconds."""
+        hits = []
+        for chunk_id, score in self.lexical_index.search(question, top_k):
+            document, metadata = self.lexical_index.get_document(chunk_id) or ("", {})
+            hits.append({"id": chunk_id, "score": score, "document": document, "metadata": metadata})
+        return hits
+
+    def _get_section_index(self) -> Dict[str, List[str]]:
+        """The article/clause -> chunk IDs index loader.py writes to its manifest, re-read after each loader run."""
+        index_state = self.get_index_state()
+        state_key = (index_state["index_version"], index_state["last_run_at"])
+        if state_key == self._section_index_state:
+            return self._section_index
+        section_index: Dict[str, List[str]] = {}
+        try:
+            conn = sqlite3.connect(f"file:{self.MANIFEST_PATH}?mode=ro", uri=True, timeout=5)
+            try:
+                for section, chunk_id in conn.execute("SELECT section, chunk_id FROM sections WHERE collection_name = ?", (self.collection_name,)):
+                    section_index.setdefault(section, []).append(chunk_id)
+            finally:
+                conn.close()
+        except sqlite3.Error as e: # No manifest, or one from before the section index
+            logger.debug(f"Could not read the section index from {self.MANIFEST_PATH}: {e}")
+        self._section_index, self._section_index_state = section_index, state_key
+        return section_index
+
+    def _lookup_section_documents(self, question: str, collection: chromadb.Collection, max_chunks: int) -> Tuple[List[str], bool]:
+        """
+        Chunks of the articles/clauses the question cites ("¿Qué dice la cláusula trigésima novena?"), fetched
+        by ID: exact, and without an embedding call or a vector search. Returns the chunks and whether every
+        cited section was found; if not (nothing cited, or a section missing from the index), search is needed too.
+        """
+        section_keys = sections.find_section_references(question)
+        if not section_keys:
+            return [], False
+        section_index = self._get_section_index()
+        section_rank: Dict[str, int] = {} # chunk ID -> position of the first cited section it belongs to
+        for rank, key in enumerate(section_keys):
+            for chunk_id in section_index.get(key, []):
+                section_rank.setdefault(chunk_id, rank)
+        if not section_rank:
+            logger.info(f"Question cites {', '.join(section_keys)}, which is not in the section index. Using search instead.")
+            return [], False
+        missing_keys = [key for key in section_keys if not section_index.get(key)]
+        results = collection.get(ids=list(section_rank), include=["documents", "metadatas"])
+        # Sections in the order the question cites them, each section's chunks in document order.
+        rows = sorted(zip(results["ids"], results["documents"], results["metadatas"]),
+                      key=lambda row: (section_rank[row[0]], row[2].get("file_name", ""), row[2].get("chunk_number", 0)))
+        self.section_lookups += 1
+        logger.info(f"Section lookup for {', '.join(section_keys)}: {len(rows)} chunks."
+                    + (f" {', '.join(missing_keys)} not in the section index; adding search results." if missing_keys else ""))
+        documents = [document for _, document, _ in rows[:max_chunks]]
+        return documents, bool(documents) and not missing_keys
+
+    def _retrieve_documents(self, question: str, collection: chromadb.Collection, api_key: str, top_k: int) -> List[str]:
+        """
+        Best top_k chunks for the question, best first. In hybrid mode the BM25 and vector rankings are merged
+        with reciprocal rank fusion, so exact terms ("Artículo 22", "bono de puntualidad") and paraphrases both count.
+        """
+        lexical_ids: List[str] = []
+        if self.RETRIEVAL_MODE != "vector":
+            try:
+                self._sync_lexical_index(collection)
+                lexical_ids = [chunk_id for chunk_id, _ in self.lexical_index.search(question, HYBRID_CANDIDATES)]
+            except Exception as e: # Fall back to vector search alone
+                logger.warning(f"Lexical search failed, using vector search only: {e}", exc_info=True)
+            if self.RETRIEVAL_MODE == "lexical" and lexical_ids:
+                return [self.lexical_index.get_document(chunk_id)[0] for chunk_id in lexical_ids[:top_k]]
+
+        n_results = top_k if self.RETRIEVAL_MODE == "vector" else max(top_k, HYBRID_CANDIDATES)
+        results = collection.query(query_embeddings=[self._embed_query(question, api_key)], n_results=n_results, include=["documents"])
+        if not results or not results["ids"] or not results["ids"][0]:
+            vector_documents = {}
+            vector_ids = []
+        else:
+            vector_ids = results["ids"][0]
+            vector_documents = dict(zip(vector_ids, results["documents"][0]))
+        if not lexical_ids:
+            return [vector_documents[chunk_id] for chunk_id in vector_ids[:top_k]]
+
+        documents = []
+        for chunk_id, _ in reciprocal_rank_fusion([lexical_ids, vector_ids])[:top_k]:
+            document = vector_documents.get(chunk_id)
+            if document is None:
+                document = self.lexical_index.get_document(chunk_id)[0]
+            documents.append(document)
+        logger.debug(f"Hybrid retrieval: {len(lexical_ids)} lexical + {len(vector_ids)} vector candidates, "
+                     f"{len(set(lexical_ids) & set(vector_ids))} in both.")
+        return documents
+
+    def _get_context_from_db(self, question: str, api_key: str, top_k: Optional[int] = None) -> Union[str, None]:
+        """
+        Retrieve relevant context from ChromaDB using the provided API key for embeddings. CONTEXT_CANDIDATES
+        chunks are retrieved and packed into CONTEXT_TOKEN_BUDGET tokens; top_k, if given, caps the chunk count.
+        """
+        if not api_key and embeddings.backend_requires_api_key(self.EMBEDDING_BACKEND):
             # This should ideally be caught before calling this method by ask_question.
             raise ValueError("API key is required to get context from ChromaDB.")
         
         try:
             collection = self._get_chroma_collection(api_key=api_key) # API key needed for embedding function
-            logger.debug(f"Querying collection '{self.collection_name}' for: '{question}' (top_k={top_k})")
-            results = collection.query(query_texts=[question], n_results=top_k)
+            logger.debug(f"Querying collection '{self.collection_name}' for: '{question}' (candidates={CONTEXT_CANDIDATES}, mode={self.RETRIEVAL_MODE})")
+            # Questions that cite an article or clause get that section's chunks directly, in document order. If some
+            # cited section is not indexed, search results follow them instead of being dropped.
+            section_documents, sections_complete = self._lookup_section_documents(question, collection, CONTEXT_CANDIDATES)
+            documents = []
+            if not sections_complete:
+                documents = [document for document in self._retrieve_documents(question, collection, api_key, CONTEXT_CANDIDATES)
+                             if document not in section_documents]
             
-            if not results or not results["documents"] or not results["documents"][0]:
+            if not documents and not section_documents:
                 logger.warning(f"No documents found in ChromaDB for the query: '{question}'")
                 return None
             
-            # Limit context size (approx 6000 chars as in original)
-            context_str = "\n\n".join(results["documents"][0])
-            logger.debug(f"Retrieved {len(results['documents'][0])} document chunks. Total context char length: {len(context_str)}. Preview: '{context_str[:200]}...'")
-            return context_str[:6000] 
+            if documents and self.context_compressor.enabled:
+                # Keep only the sentences that answer the question (cited sections are passed whole).
+                # Lexical mode scores sentences by term overlap only, without embedding calls.
+                use_embeddings = self.context_compressor.embedding_weight > 0 and self.RETRIEVAL_MODE != "lexical"
+                question_embedding = self._embed_query(question, api_key) if use_embeddings else None
+                compressed, _ = self.context_compressor.compress(
+                    question, documents, self.lexical_index.idf, question_embedding, lambda sentences: self._embed_sentences(sentences, api_key)
+                )
+                documents = compressed or documents
+            documents = section_documents + documents
+            context_str, _ = self.context_assembler.assemble(documents, max_chunks=top_k, diversify=not section_documents)
+            logger.debug(f"Retrieved {len(documents)} document chunks. Context char length: {len(context_str)}. Preview: '{context_str[:200]}...'")
+            return context_str or None
         except ConnectionError: # Propagate error from _get_chroma_collection
             raise
         except Exception as e:
@@ -215,17 +542,89 @@ Answer in {language}:
         question: str,
         language: str = 'english', # Default from your original file
         conversation_history: List[Dict[str, str]] = None, # Type hint for clarity
-        top_k: int = 3,
+        top_k: Optional[int] = None, # Max chunks in the context; by default only CONTEXT_TOKEN_BUDGET limits it
         # MODIFICACIÓN: El parámetro se renombra para mayor claridad
-        chat_api_key: str = None
+        chat_api_key: str = None,
+        conversation_id: Optional[str] = None # Session ID of conversation_history in the conversation store; enables the stored summary of older turns
     ) -> Union[str, Generator[str, None, None]]:
         """
         Ask a question and get a streaming response.
         Uses the instance's chroma_api_key for context retrieval and the provided
-        chat_api_key for response generation.
+        chat_api_key for response generation. conversation_history holds the earlier messages; it is
+        trimmed to HISTORY_TOKEN_BUDGET (see HistoryCompactor).
+        """
+        prepared = self._prepare_question(question, language, conversation_history, top_k, chat_api_key, conversation_id)
+        if not isinstance(prepared, dict): # Error message, or a stored answer (FAQ / answer cache)
+            return prepared
+        try:
+            response_stream = self._get_openai_client(prepared["chat_api_key"]).chat.completions.create(**self._completion_arguments(prepared["messages"]))
+            return self._stream_response(response_stream, prepared["answer_cache_key"])
+        except Exception as e:
+            return self._generation_error(e, language)
+
+    async def ask_question_async(
+        self,
+        question: str,
+        language: str = 'english',
+        conversation_history: List[Dict[str, str]] = None,
+        top_k: Optional[int] = None,
+        chat_api_key: str = None,
+        conversation_id: Optional[str] = None,
+        executor: Optional[Executor] = None
+    ) -> Union[str, AsyncGenerator[str, None]]:
+        """
+        ask_question for asyncio servers (asgi_app.py). Retrieval (embeddings, ChromaDB, history summary) is
+        blocking and runs in executor, which bounds how many run at once; the answer streams from AsyncOpenAI
+        without holding a thread.
+        """
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(
+            executor, functools.partial(self._prepare_question, question, language, conversation_history, top_k, chat_api_key, conversation_id)
+        )
+        if isinstance(prepared, str):
+            return prepared
+        if not isinstance(prepared, dict):
+            return self._iterate_async(prepared)
+        try:
+            response_stream = await self.get_async_openai_client(prepared["chat_api_key"]).chat.completions.create(
+                **self._completion_arguments(prepared["messages"])
+            )
+            return self._stream_response_async(response_stream, prepared["answer_cache_key"])
+        except Exception as e:
+            return self._generation_error(e, language)
+
+    def _completion_arguments(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        return dict(
+            model=self.OPENAI_CHAT_MODEL,
+            messages=messages,
+            temperature=0.3, # As per your original file
+            max_tokens=2000, # As per your original file
+            stream=True,
+            stream_options={"include_usage": True} # Last chunk reports prompt tokens, including cached ones
+        )
+
+    @staticmethod
+    def _generation_error(e: Exception, language: str) -> str:
+        logger.error(f"Unexpected exception in ask_question: {e}", exc_info=True)
+        return f"❌ Error generating response: {str(e)}" if language == 'english' else f"❌ Error al generar respuesta: {str(e)}"
+
+    def _prepare_question(
+        self,
+        question: str,
+        language: str,
+        conversation_history: Optional[List[Dict[str, str]]],
+        top_k: Optional[int],
+        chat_api_key: Optional[str],
+        conversation_id: Optional[str]
+    ) -> Union[str, Generator[str, None, None], Dict[str, Any]]:
+        """
+        Everything before generation: FAQ and answer cache lookups, retrieval and prompt building. Returns an
+        error message, a stored answer stream, or {"messages", "answer_cache_key", "chat_api_key"} to generate from.
         """
         if conversation_history is None:
             conversation_history = []
+        if conversation_history and conversation_history[-1].get('role') == 'user' and conversation_history[-1].get('content') == question:
+            conversation_history = conversation_history[:-1] # Callers that store the question first also pass it here
 
         # MODIFICACIÓN: Lógica para determinar la clave de CHAT
         current_chat_api_key = chat_api_key or self._default_chat_api_key
@@ -235,11 +634,41 @@ Answer in {language}:
             return err_msg_en if language == 'english' else err_msg_es
 
         try:
-            # MODIFICACIÓN: Usamos la clave de CHAT solo para el cliente de chat
-            current_openai_client = self._get_openai_client(api_key=current_chat_api_key)
-            
+            # FAQ fast path: questions with an approved answer in faq.json get it straight away, without retrieval or
+            # generation. Only for standalone questions; a follow-up may look like an FAQ but ask about something else.
+            faq_match = None
+            if self.faq.enabled and not self._has_prior_turns(question, conversation_history):
+                if self.RETRIEVAL_MODE == "lexical":
+                    faq_match = self.faq.match(question)
+                else:
+                    faq_match = self.faq.match(question, lambda text: self._embed_query(text, self._chroma_api_key),
+                                               lambda texts: self._embed_sentences(texts, self._chroma_api_key))
+                if faq_match is not None:
+                    faq_answer = faq_match["answers"].get(language)
+                    logger.info(f"FAQ match '{faq_match['id']}' (similarity {faq_match['similarity']:.3f}, keyword: {faq_match['keyword']}) for '{question}'"
+                                + ("" if faq_answer else f"; no stored answer in {language}, generating a translation"))
+                    if faq_answer:
+                        return self._stream_cached_answer(faq_answer)
+
+            # Semantic answer cache: paraphrases of an already answered question get the stored answer.
+            # Skipped for follow-up questions, whose answer depends on the conversation, and for questions citing
+            # an article/clause: "artículo 22" and "artículo 23" embed almost identically. For the same reason the
+            # cache only returns answers to questions with the same numbers ("con 2 años" vs "con 5 años").
+            answer_cache_key = None
+            if self.answer_cache.enabled and not self._has_prior_turns(question, conversation_history) and not sections.find_section_references(question):
+                self._refresh_client_if_index_changed()
+                answer_cache_key = (self._question_vector(question), language, self._index_version, question)
+                cached_answer = self.answer_cache.get(*answer_cache_key)
+                if cached_answer is not None:
+                    logger.info(f"Answer cache hit (similarity {cached_answer['similarity']:.3f}) for '{question}' <- '{cached_answer['question']}'")
+                    return self._stream_cached_answer(cached_answer["answer"])
+
             # MODIFICACIÓN CRÍTICA: Usamos la clave de CHROMA para obtener el contexto de la base de datos
-            context = self._get_context_from_db(question, api_key=self._chroma_api_key, top_k=top_k)
+            if faq_match is not None: # No stored answer in this language: the model translates the approved one
+                reference_answer = faq_match["answers"].get("spanish") or next(iter(faq_match["answers"].values()), "")
+                context = f"Respuesta aprobada para esta pregunta (tradúcela al idioma solicitado sin cambiar su contenido):\n{reference_answer}"
+            else:
+                context = self._get_context_from_db(question, api_key=self._chroma_api_key, top_k=top_k)
             
             if not context:
                 # Check if the collection exists and is empty
@@ -261,91 +690,14 @@ Answer in {language}:
                 return "⚠️ No relevant documents found for your query." if language == 'english' else "⚠️ No se encontraron documentos relevantes para su consulta."
 
 
-            # Build the user prompt
-            user_prompt_content = self._build_prompt(question, context, conversation_history, language)
-
-            # System prompt (from your original query.py, with the instruction 8 variation)
-            system_prompt_content = (
-"""Eres un asistente especializado en Recursos Humanos de HISENSE ELECTRÓNICA MÉXICO, S.A. DE C.V. 
-        Tu función es responder preguntas basándote exclusivamente en la información contenida en los siguientes documentos:
-        - Contrato Colectivo de Trabajo 2024.
-        - Reglamento Interno de Trabajo (RIT) 2024.
-
-        Instrucciones:
-        1. Responde de manera clara, precisa y fundamentada en los documentos mencionados.
-        2. Si la respuesta no se encuentra en los documentos, indica claramente que no hay información disponible.
-        3. Siempre responde en el mismo idioma en que se formuló la pregunta (español o inglés).
-        4. Evita suposiciones o información externa a los documentos proporcionados.
-        5. En caso de preguntas sobre procedimientos, derechos u obligaciones, cita la cláusula o artículo correspondiente.
-        6. Si la pregunta es sobre un documento específico, menciona el nombre del documento y la sección relevante.
-        7. Mencionar en que parte del documento se encuentra la respuesta.
-        8. Cuando pregunte de beneficios dime todos los que esten en el contrato colectivo 
-        
-        8. **Formato:** - Organiza la respuesta de manera clara. 
-           - Usa listas cuando sea necesario para darle forma a las respuestas
-           - Decirme al ultimo la fuente de la respuesta, con el nombre del documento doxc o pdf y la sección relevante. 
-           
-        9. **Contexto:**
-        Si me preguntan ¿Cuáles son las sanciones por llegar tarde, ausentarse o incumplir con mis deberes? contestar lo siguiente:
-        Sanciones por llegar tarde (Retardos)
-Primer retardo en 30 días: Amonestación verbal.
-Segundo retardo en 30 días: Suspensión de 1 día sin goce de sueldo.
-Tercer retardo en 30 días: Suspensión de 2 días sin goce de sueldo.
-Cuarto retardo en 30 días: Suspensión de 3 días sin goce de sueldo.
-Acumular 3 suspensiones por retardos en 6 meses: Suspensión de hasta 8 días sin goce de sueldo.
-Más de 5 minutos de retardo: Se considera falta injustificada (Artículo 22).
-Además, se reduce el bono de puntualidad proporcionalmente a los retardos incurridos durante la semana (Artículo 79).
-
-Sanciones por ausentarse (Faltas injustificadas)
-Primera falta en 30 días: Amonestación por escrito.
-Segunda falta en 30 días: Suspensión de hasta 4 días sin goce de sueldo.
-Tercera falta en 30 días: Suspensión de hasta 8 días sin goce de sueldo.
-Cuarta falta en 30 días: Terminación de la relación laboral sin responsabilidad para la empresa (Artículo 47, Fracción X de la LFT).
-Faltar un día antes o después de días de descanso/vacaciones: Suspensión de hasta 5 días sin goce de sueldo (Artículo 80).
-El trabajador pierde la parte proporcional del bono de asistencia por cada falta (Artículo 80).
-
-Sanciones por incumplir con los deberes
-Las sanciones varían según la gravedad de la falta:
-Faltas leves:
-Amonestación verbal (primera vez).
-Amonestación por escrito (segunda vez).
-Suspensión de 1 día (tercera vez).
-Suspensión de 2 días (cuarta vez).
-Suspensión de 3 a 8 días (quinta vez en adelante).
-Faltas graves:
-Suspensión de hasta 8 días sin goce de sueldo desde la primera ocasión (Artículo 70).
-Causas de rescisión (sin responsabilidad para la empresa):
-Negligencia grave, daños a equipos, robo, acoso, violencia laboral, revelar secretos industriales, entre otras (Artículo 83).
-
-Procedimiento para justificar faltas
-Para evitar que una ausencia sea considerada injustificada, el trabajador debe:
-En caso de permiso: Obtener autorización por escrito del supervisor.
-En caso de enfermedad/accidente: Presentar incapacidad del IMSS el mismo día de su expedición (Artículo 72).
-
-Nota importante
-Las sanciones se aplican considerando la gravedad de la falta y el historial del trabajador. El trabajador tiene derecho a ser escuchado en su defensa antes de cualquier sanción (Artículo 77).
-
-Fuente: Capítulos XII y XIII del Reglamento Interno de Trabajo 2024.
-
-Si pregunto ¿Qué hago si creo que mi jefe está incumpliendo el contrato colectivo? anadir tambien el nombre de la persona."""
-            )
-            
-            logger.debug(f"System Prompt (start): {system_prompt_content[:200]}...")
-            logger.debug(f"User Prompt (start): {user_prompt_content[:200]}...")
-
-            # Create streaming response
-            response_stream = current_openai_client.chat.completions.create(
-                model=self.OPENAI_CHAT_MODEL,
-                messages=[
-                    {"role": "system", "content": system_prompt_content},
-                    {"role": "user", "content": user_prompt_content}
-                ],
-                temperature=0.3, # As per your original file
-                max_tokens=2000, # As per your original file
-                stream=True
+            history_summary, recent_history = self.history_compactor.compact(
+                conversation_history, conversation_id, lambda summary, older: self._summarize_history(summary, older, current_chat_api_key)
             )
+            messages = self._build_messages(question, context, recent_history, language, history_summary)
+            logger.debug(f"User Prompt (start): {messages[1]['content'][:200]}...")
 
-            return self._stream_response(response_stream)
+            # MODIFICACIÓN: Usamos la clave de CHAT solo para el cliente de chat
+            return {"messages": messages, "answer_cache_key": answer_cache_key, "chat_api_key": current_chat_api_key}
         
         except ValueError as ve: # Catch API key or configuration errors from helper methods
             error_message = f"Configuration Error: {str(ve)}" if language == 'english' else f"Error de Configuración: {str(ve)}"
@@ -355,15 +707,63 @@ Si pregunto ¿Qué hago si creo que mi jefe está incumpliendo el contrato colec
             logger.error(f"Database connection error: {ce}", exc_info=True)
             return f"⚠️ Database Error: {ce}" if language == 'english' else f"⚠️ Error de Base de Datos: {ce}"
         except Exception as e:
-            logger.error(f"Unexpected exception in ask_question: {e}", exc_info=True)
-            error_message = f"❌ Error generating response: {str(e)}" if language == 'english' else f"❌ Error al generar respuesta: {str(e)}"
-            return error_message
+            return self._generation_error(e, language)
 
-    def _stream_response(self, response_stream: Generator) -> Generator[str, None, None]:
-        """Yield tokens from the OpenAI stream."""
+    def _stream_response(self, response_stream: Generator, answer_cache_key: Optional[tuple] = None) -> Generator[str, None, None]:
+        """Yield tokens from the OpenAI stream. Complete answers are stored in the answer cache under answer_cache_key."""
+        answer_parts = []
+        finish_reason = None
         for chunk in response_stream:
-            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+            token, chunk_finish_reason = self._read_chunk(chunk)
+            finish_reason = chunk_finish_reason or finish_reason
+            if token:
+                answer_parts.append(token)
+                yield token
+        self._store_answer(answer_cache_key, finish_reason, answer_parts)
+
+    async def _stream_response_async(self, response_stream: AsyncIterator, answer_cache_key: Optional[tuple] = None) -> AsyncGenerator[str, None]:
+        """_stream_response for an AsyncOpenAI stream. The stream is closed if the client disconnects, which stops generation."""
+        answer_parts = []
+        finish_reason = None
+        try:
+            async for chunk in response_stream:
+                token, chunk_finish_reason = self._read_chunk(chunk)
+                finish_reason = chunk_finish_reason or finish_reason
+                if token:
+                    answer_parts.append(token)
+                    yield token
+        finally:
+            await response_stream.close()
+        self._store_answer(answer_cache_key, finish_reason, answer_parts)
+
+    def _read_chunk(self, chunk: Any) -> Tuple[Optional[str], Optional[str]]:
+        """(content token or None, finish reason or None) of a stream chunk; logs the usage chunk that ends the stream."""
+        usage = getattr(chunk, "usage", None)
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", 0) or 0
+            self.prompt_cached_tokens += cached_tokens
+            logger.info(f"Usage: {usage.prompt_tokens} prompt tokens ({cached_tokens} cached), {usage.completion_tokens} completion tokens.")
+        if not chunk.choices:
+            return None, None
+        choice = chunk.choices[0]
+        return (choice.delta.content if choice.delta else None), choice.finish_reason
+
+    def _store_answer(self, answer_cache_key: Optional[tuple], finish_reason: Optional[str], answer_parts: List[str]) -> None:
+        # Only answers that ran to completion are cached (not ones cut at max_tokens or by a disconnect)
+        if answer_cache_key is not None and finish_reason == "stop":
+            query_embedding, language, index_version, question = answer_cache_key
+            self.answer_cache.put(query_embedding, language, index_version, question, "".join(answer_parts))
+
+    def _stream_cached_answer(self, answer: str) -> Generator[str, None, None]:
+        """Yields a stored answer word by word, like a model stream, so callers handle both the same way."""
+        for token in re.findall(r'\S+\s*|\s+', answer):
+            yield token
+
+    @staticmethod
+    async def _iterate_async(tokens: Generator[str, None, None]) -> AsyncGenerator[str, None]:
+        for token in tokens:
+            yield token
 
 # --- Main Execution Block (Example Usage) ---
 if __name__ == "__main__":
@@ -397,7 +797,7 @@ if __name__ == "__main__":
     print("Assistant Response (streaming):")
     
     # In this local test, we don't pass chat_api_key, so it uses the default one from init.
-    response_gen1 = assistant.ask_question(question1_es, language='español') 
+    response_gen1 = assistant.ask_question(question1_es, language='spanish') 
     if isinstance(response_gen1, str):
         print(response_gen1)
     else:
@@ -405,11 +805,11 @@ if __name__ == "__main__":
             print(chunk_content, end="", flush=True)
         print("\n------------------------------------")
 
-    # Example 2: Question that might trigger a canned response (Spanish)
+    # Example 2: Question answered from faq.json without calling the model (Spanish)
     question2_es = "¿Cuáles son las sanciones por llegar tarde?"
     print(f"\nUser Query (español): {question2_es}")
     print("Assistant Response (streaming):")
-    response_gen2 = assistant.ask_question(question2_es, language='español')
+    response_gen2 = assistant.ask_question(question2_es, language='spanish')
     if isinstance(response_gen2, str):
         print(response_gen2)
     else:
@@ -0,0 +1,126 @@
+"""
+Article and clause references, shared by Loader.py (headings in chunks) and query.py (references in questions).
+
+The RIT is numbered by "Artículo N" and the contrato colectivo by "Cláusula <ordinal>" (or a bare uppercase
+ordinal heading such as "TRIGÉSIMA NOVENA.-"). Both are reduced to a section key "articulo:22" /
+"clausula:39", so a question about "la cláusula 39" finds the chunk headed "CLÁUSULA TRIGÉSIMA NOVENA".
+"""
+import re
+import unicodedata
+from typing import List, Optional
+
+ARTICLE = "articulo"
+CLAUSE = "clausula"
+
+_ORDINAL_UNITS = {"primer": 1, "segund": 2, "tercer": 3, "cuart": 4, "quint": 5, "sext": 6, "septim": 7, "setim": 7, "octav": 8, "noven": 9}
+_ORDINAL_TENS = {"decim": 10, "vigesim": 20, "trigesim": 30, "cuadragesim": 40, "quincuagesim": 50,
+                 "sexagesim": 60, "septuagesim": 70, "octogesim": 80, "nonagesim": 90}
+_ORDINAL_SPECIAL = {"undecim": 11, "duodecim": 12}
+
+_UNIT_WORDS = r'PRIMER[OA]?|SEGUND[OA]|TERCER[OA]?|CUART[OA]|QUINT[OA]|SEXT[OA]|SE?PTIM[OA]|OCTAV[OA]|NOVEN[OA]'
+_TENS_WORDS = '|'.join(_ORDINAL_TENS).upper()
+# Accents are stripped before matching, so only unaccented spellings are needed (DECIMA for DÉCIMA).
+_ORDINAL = rf'(?:(?:{_TENS_WORDS})[OA](?:\s*(?:{_UNIT_WORDS}))?|UNDECIM[OA]|DUODECIM[OA]|(?:{_UNIT_WORDS}))\b'
+
+# Headings at the start of a line (clean_text starts a paragraph at each one). Uppercase or "Artículo 22." so
+# that a wrapped line starting with "artículo 22 de la Ley..." inside a paragraph is not taken for a heading.
+_HEADING_PATTERN = re.compile(
+    rf'^[ \t]*(?:ARTICULO\s+(?P<article>\d+)\b|Articulo\s+(?P<article_mixed>\d+)\s*\.'
+    rf'|CLAUSULA\s+(?P<clause>\d+\b|{_ORDINAL})|Clausula\s+(?P<clause_mixed>\d+|{_ORDINAL})\s*\.'
+    rf'|(?P<bare_clause>{_ORDINAL})\s*\.)',
+    re.MULTILINE
+)
+# Any line that opens a section, for Loader.clean_text: the headings above, chapters ("CAPÍTULO III"; OCR may give
+# "CAPíTULO") and unnumbered clauses ("CLÁUSULA TRANSITORIA"). Matched against accent-stripped text, see starts_section.
+_SECTION_START_PATTERN = re.compile(rf'{_HEADING_PATTERN.pattern}|^[ \t]*(?:CAP[Ii]TULO|CLAUSULA)\b', re.MULTILINE)
+_SECTION_START_LOOKAHEAD = 80 # Characters enough to hold any heading prefix
+# References in a question, matched case-insensitively, in Spanish or English: "artículo 22", "art. 22",
+# "artículo primero", "artículos 5 y 6", "cláusula 39", "cláusulas trigésima octava y cuadragésima",
+# "article 22", "articles 5 and 6", "clause 39".
+_NUMBER_OR_ORDINAL = rf'(?:\d+|{_ORDINAL})'
+_LIST_SEPARATOR = r'(?:,|\by\b|\be\b|\band\b)'
+_REFERENCE_PATTERN = re.compile(
+    rf'\b(?:(?P<article_word>articulos?|articles?|arts?\.?)|clausulas?|clauses?)\s*(?:n(?:o|um)?\.?\s*)?'
+    rf'(?P<numbers>{_NUMBER_OR_ORDINAL}(?:\s*{_LIST_SEPARATOR}\s*{_NUMBER_OR_ORDINAL})*)',
+    re.IGNORECASE
+)
+_REFERENCE_LIST_SEPARATOR = re.compile(rf'\s*{_LIST_SEPARATOR}\s*', re.IGNORECASE)
+# A list item followed by a unit or counted noun is a quantity, not a section: "artículo 22 y 3 días".
+_QUANTITY_FOLLOWS = re.compile(
+    r'\s*(?:%|\$|(?:dias?|semanas?|mes(?:es)?|anos?|horas?|minutos?|pesos|salarios?|veces|vez|faltas?|retardos?'
+    r'|trabajadore?s|personas?|days?|weeks?|months?|years?|hours?|minutes?|times)\b)',
+    re.IGNORECASE
+)
+
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def ordinal_value(words: str) -> Optional[int]:
+    """"trigésima novena" -> 39, "DECIMOSEXTA" -> 16, "39" -> 39. None if the words are not an ordinal."""
+    words = strip_accents(words).lower().strip()
+    if words.isdigit():
+        return int(words)
+    for stem, value in _ORDINAL_SPECIAL.items():
+        if words.startswith(stem):
+            return value
+    value = 0
+    for stem, tens in _ORDINAL_TENS.items():
+        if words.startswith(stem):
+            value, words = tens, words[len(stem) + 1:].strip()
+            break
+    for stem, units in _ORDINAL_UNITS.items():
+        if words.startswith(stem):
+            return value + units
+    return value or None
+
+
+def section_key(kind: str, number: int) -> str:
+    return f"{kind}:{number}"
+
+
+def find_section_headings(text: str) -> List[str]:
+    """Section keys of the article/clause headings in a chunk, in order of appearance."""
+    keys = []
+    for match in _HEADING_PATTERN.finditer(strip_accents(text)):
+        article = match.group("article") or match.group("article_mixed")
+        if article:
+            keys.append(section_key(ARTICLE, int(article)))
+            continue
+        number = ordinal_value(match.group("clause") or match.group("clause_mixed") or match.group("bare_clause"))
+        if number:
+            keys.append(section_key(CLAUSE, number))
+    return keys
+
+
+def starts_with_section_heading(text: str) -> bool:
+    return _HEADING_PATTERN.match(strip_accents(text.lstrip())) is not None
+
+
+def starts_section(text: str, pos: int = 0) -> bool:
+    """Whether the line at text[pos] opens an article, clause or chapter (clean_text starts a paragraph there)."""
+    return _SECTION_START_PATTERN.match(strip_accents(text[pos:pos + _SECTION_START_LOOKAHEAD])) is not None
+
+
+def find_section_references(question: str) -> List[str]:
+    """
+    Section keys of the articles/clauses a question names explicitly ("¿Qué dice el artículo 22?"). In a list
+    ("artículos 5 y 6") the items after the first stop at the first one followed by a unit or counted noun.
+    """
+    keys = []
+    question = strip_accents(question)
+    for match in _REFERENCE_PATTERN.finditer(question):
+        kind = ARTICLE if match.group("article_word") else CLAUSE
+        item_start = match.start("numbers")
+        for index, words in enumerate(_REFERENCE_LIST_SEPARATOR.split(match.group("numbers"))):
+            item_start = question.index(words, item_start)
+            item_end = item_start + len(words)
+            if index > 0 and _QUANTITY_FOLLOWS.match(question, item_end):
+                break
+            item_start = item_end
+            number = int(words) if words.isdigit() else ordinal_value(words) # "artículo primero" as well as "cláusula primera"
+            key = section_key(kind, number) if number else None
+            if key and key not in keys:
+                keys.append(key)
+    return keys